@@ -0,0 +1,113 @@
+"""
+This script converts the json chunk files in data/ to the binary chunk format of localutils/chunkfile.py
+"""
+from localutils import chunkfile as cf
+import multiprocessing
+import ConfigParser
+import argparse
+import itertools
+import logging
+import traceback
+import json
+import time
+import os
+import re
+
+# json chunk files are named chunkid_msmid.json
+CHUNK_NAME = re.compile(r'^(\d+)_(\d+)\.json$')
+
+
+def convert(fn, rtt_scale, compress, remove):
+    """ convert one json chunk file to a binary chunk file next to it
+
+    Args:
+        fn (string): path to the json chunk file, e.g. data/0_1010.json
+        rtt_scale (int): RTTs are stored in 1/rtt_scale msec, 0 to keep them in float64
+        compress (bool): compress the columns
+        remove (bool): remove the json file once converted
+
+    Returns:
+        int: number of probes converted; None if the json file can not be read
+    """
+    t1 = time.time()
+    try:
+        with open(fn, 'r') as fp:
+            mes = json.load(fp)
+    except (IOError, ValueError) as e:
+        logging.error("%s not converted: %s" % (fn, e))
+        return None
+    by_probe = cf.buffers_from_records(mes)
+    cf.write_chunk(os.path.splitext(fn)[0] + cf.EXT, by_probe, rtt_scale=rtt_scale, compress=compress)
+    if remove:
+        os.remove(fn)
+    t2 = time.time()
+    logging.info("%s converted in %.2f sec." % (fn, (t2 - t1)))
+    return len(by_probe)
+
+
+def convert_wrapper(args):
+    """ wrapper for convert() that enables trouble shooting in worker and multiple args"""
+    try:
+        return convert(*args)
+    except Exception:
+        logging.critical("Exception in worker.")
+        traceback.print_exc()
+        raise
+
+
+def main():
+    # log to chunk_convert.log file
+    logging.basicConfig(filename='chunk_convert.log', level=logging.DEBUG,
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S %z')
+
+    # load data collection configuration from config file in the same folder
+    config = ConfigParser.ConfigParser()
+    if not config.read('./config'):
+        logging.critical("Config file ./config is missing.")
+        return
+
+    # load the configured directory where collected data is saved
+    try:
+        data_dir = config.get("dir", "data")
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        logging.critical("Config for data storage is not right.")
+        return
+
+    if not os.path.exists(data_dir):
+        logging.critical("Repository %s storing measurement data is missing" % data_dir)
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--rtt-scale",
+                        help="RTTs are stored in 1/RTT_SCALE msec, %d by default; "
+                             "0 keeps them in double precision." % cf.DEFAULT_RTT_SCALE,
+                        type=int, default=cf.DEFAULT_RTT_SCALE)
+    parser.add_argument("-z", "--compress",
+                        help="compress the columns, smaller files but no more memory mapped when read.",
+                        action="store_true")
+    parser.add_argument("-r", "--remove",
+                        help="remove the json files once converted.",
+                        action="store_true")
+    args = parser.parse_args()
+
+    file_chunk = [os.path.join(data_dir, fn) for fn in sorted(os.listdir(data_dir)) if CHUNK_NAME.match(fn)]
+    logging.info("%d json chunk files to convert." % len(file_chunk))
+    t1 = time.time()
+
+    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+    # one chunk per task, so that no worker queues several chunks behind a slow one
+    res = pool.map(convert_wrapper,
+                   itertools.izip(file_chunk, itertools.repeat(args.rtt_scale),
+                                  itertools.repeat(args.compress), itertools.repeat(args.remove)),
+                   chunksize=1)
+
+    failed = [fn for fn, r in zip(file_chunk, res) if r is None]
+    if failed:
+        logging.error("%d files not converted: %s" % (len(failed), ', '.join(failed)))
+    t2 = time.time()
+    logging.info("All chunks converted in %.2f sec." % (t2 - t1))
+
+
+if __name__ == '__main__':
+    main()
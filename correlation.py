@@ -9,7 +9,7 @@ import multiprocessing
 import itertools
 import json
 import time
-from localutils import benchmark as bch, misc as ms
+from localutils import benchmark as bch, misc as ms, prefetch as pf
 
 
 METHOD = ['cpt_normal', 'cpt_np', 'cpt_poisson']
@@ -18,12 +18,23 @@ PATH_CH_M = ['as_path_change', 'as_path_change_ixp', 'ifp_simple', 'ifp_bck']
 WINDOW = 1800  # interval of traceroute measurement
 
 
-def worker(rtt_ch_fn, path_ch_fn, rtt_ch_m):
+def load(files):
+    """ load the rtt analysis and the path analysis outputs of a chunk """
+    rtt_ch_fn, path_ch_fn = files
+    with open(rtt_ch_fn, 'r') as fp:
+        rtt_ch = json.load(fp)
+    with open(path_ch_fn, 'r') as fp:
+        path_ch = json.load(fp)
+    return rtt_ch, path_ch
+
+
+def worker(rtt_ch_fn, path_ch_fn, loaded, rtt_ch_m):
     """ correlates the RTT changes and path changes in the given file
 
     Args:
         rtt_ch_fn (string): path to the rtt analysis output
         path_ch_fn (string): path to the path analysis output
+        loaded (tuple): the two outputs as returned by load(), None if they could not be read
         rtt_ch_m (string): the method used for RTT change detection
 
     Returns:
@@ -34,19 +45,9 @@ def worker(rtt_ch_fn, path_ch_fn, rtt_ch_m):
     rtt_change_res = []
     overview = []
 
-    try:  # load rtt analysis
-        with open(rtt_ch_fn, 'r') as fp:
-            rtt_ch = json.load(fp)
-    except IOError as e:
-        logging.error(e)
-        return [], []
-
-    try:  # load path analysis
-        with open(path_ch_fn, 'r') as fp:
-            path_ch = json.load(fp)
-    except IOError as e:
-        logging.error(e)
+    if loaded is None:
         return [], []
+    rtt_ch, path_ch = loaded
 
     pbs = set(rtt_ch.keys()) & set(path_ch.keys())
     logging.info("%d probes in common in %s (%d) and %s (%d)" % (len(pbs), rtt_ch_fn, len(rtt_ch),
@@ -101,9 +102,22 @@ def worker(rtt_ch_fn, path_ch_fn, rtt_ch_m):
     return rtt_change_res, overview
 
 
+def correlate(f, rtt_ch_m):
+    """ read the analysis outputs of a chunk and correlate them, see load() and worker()
+
+    Args:
+        f ((string, string)): paths to the rtt and path analysis outputs of the chunk
+        rtt_ch_m (string): the method used for RTT change detection
+
+    Returns:
+        ((string, string), tuple): the paths and what worker() returns for them
+    """
+    return f, worker(f[0], f[1], pf.load_item(f, load=load), rtt_ch_m)
+
+
 def worker_wrapper(args):
     try:
-        return worker(*args)
+        return correlate(*args)
     except Exception:
         logging.critical("Exception in worker.")
         traceback.print_exc()
@@ -156,12 +170,15 @@ def main():
         logging.critical("Repository %s storing path analysis is missing" % path_alyz_dir)
         return
 
+    depth, max_bytes = pf.read_config(config)
+
     logging.info("Finished loading libs and config.")
     t1 = time.time()
 
     task = (((1010, 5010), 'v4'), ((2010, 6010), 'v6'))
 
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+    processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes=processes)
 
     for (ping_msm, trace_msm), tid in task:
         # get total number of chunks for each tid
@@ -176,7 +193,15 @@ def main():
         path_files = [os.path.join(path_alyz_dir, "%d_%d.json" % (i, trace_msm)) for i in xrange(chunk_count)]
 
         for rtt_ch_m in [m + '&' + p for m in METHOD for p in PENALTY]:
-            res = pool.map(worker_wrapper, itertools.izip(rtt_files, path_files, itertools.repeat(rtt_ch_m)))
+            # one task per chunk, taken by the first worker free; the next outputs are read ahead meanwhile
+            files = zip(rtt_files, path_files)
+            res = dict()
+            with pf.TaskFeed(files, processes, depth, max_bytes) as feed:
+                for f, r in pool.imap_unordered(worker_wrapper, itertools.izip(feed, itertools.repeat(rtt_ch_m)),
+                                                chunksize=1):
+                    res[f] = r
+                    feed.done()
+            res = [res[f] for f in files]
             # save result to csv in data dir
             file_suf = rtt_ch_m.split('&')[0]
             rtt_change_res = []
@@ -1,8 +1,9 @@
 """
 This script collects measurement results from RIPE Atlas and store to data/
 """
-from localutils import atlas as at, timetools as tt, misc as ms
-import json
+from localutils import atlas as at, timetools as tt, buffers as bf, manifest as mf, fetcher as fc
+from localutils import planner as pl, chunkfile as cf, probestore as ps
+from multiprocessing.pool import ThreadPool
 import os
 import time
 import multiprocessing
@@ -11,58 +12,154 @@ import logging
 import itertools
 import traceback
 import argparse
-from ast import literal_eval
 
 
-def mes_fetcher(chunk_id, msm, probe_list, start, end, suffix, save_dir, fromfile=False):
+def store_chunk(save_file, downloads, keep=()):
+    """ parse downloaded measurement results and store them in a chunk file
+
+    it runs in the pool of parser processes. the chunk file holds for each probe the columns of
+    a buffers.PingBuffer, TraceBuffer or ConnectionBuffer, see localutils/chunkfile.py
+
+    Args:
+        save_file (string): path to the chunk file
+        downloads (list of string): files written by fetcher.AtlasFetcher.download(), removed once parsed
+        keep (collection of int): probes whose records in the existing save_file are merged with the downloads
+
+    Returns:
+        dict: probe id (int) to number of measurements stored;
+        None if the existing save_file can not be decoded, nothing is then stored
+    """
+    try:
+        if not keep and len(downloads) == 1:
+            # nothing to be merged, results are parsed and written one probe at a time
+            mes = at.stream_group_by_probe(fc.read_results(downloads[0]))
+            cf.write_chunk(save_file, mes)
+            return {pb: len(buf) for pb, buf in mes.items()}
+        mes = dict()
+        if keep:
+            try:
+                with cf.ChunkReader(save_file) as saved:
+                    mes = {pb: rec for pb, rec in saved.items() if pb in keep}
+            except (IOError, cf.ChunkError) as e:
+                logging.warning("decoding %s failed: %s" % (save_file, e))
+                return None
+        ip_table = bf.IpTable()
+        for fn in downloads:
+            for pb, buf in at.stream_group_by_probe(fc.read_results(fn), ip_table).items():
+                rec = buf.to_dict()
+                mes[pb] = mf.merge_records(mes[pb], rec) if pb in mes else rec
+        cf.write_chunk(save_file, cf.buffers_from_records(mes))
+        return {pb: mf.record_count(rec) for pb, rec in mes.items()}
+    finally:
+        for fn in downloads:
+            if os.path.isfile(fn):
+                os.remove(fn)
+
+
+def store_chunk_wrapper(args):
+    """ a wrapper for store_chunk that enables trouble shooting in parser processes """
+    try:
+        return store_chunk(*args)
+    except Exception:
+        logging.critical("Exception in parser.")
+        traceback.print_exc()
+        raise
+
+
+def mes_fetcher(chunk_id, msm, probe_list, start, end, suffix, save_dir, fetcher, parsers,
+                fromfile=False, stored=None):
     """" worker for measurement retrieval
 
-    it fetches the measurement results for a given chunk/list of probes,
-    and stores them in json format file, where key is the probe id, value is a dict
-    if ping: dict(epoch=[int], min_rtt=[float], all_rtt=[tuple of float])
-    if connection: dict(connect=[int], disconnect=[int])
-    if traceroute: dict(epoch=[int], paris_id=[int], path=[tuple of hops])
+    it runs in a thread, downloads the measurement results for a given chunk/list of probes,
+    and hands them to a parser process that stores them in a chunk file, see store_chunk()
 
     Args:
         chunk_id (int): the sequential/ID for a chunk of probe IDs
         msm (int): the ID of measurements meant to be fetched
         probe_list (list of int): a chunk of probe IDs
-        start (int): epoch time for the beginning of observation window
-        end (int): epoch time for the end of observation window
+        start (datetime): the beginning of observation window
+        end (datetime): the end of observation window
         suffix (string): a string to identify the measurement
         save_dir (string): where the fetched measurement shall be saved
-        fromfile (bool): if set to true, the worker will check if the same file exists and contains the same probe ids
+        fetcher (fetcher.AtlasFetcher): downloads results with retries
+        parsers (multiprocessing.Pool): pool of processes parsing the downloaded results
+        fromfile (bool): if set to true, the worker only fetches the time ranges missing in the existing file
+        stored (dict): probe id (int) to (start, end, chunk id, count) already stored according to the manifest
+
+    Returns:
+        dict: probe id (int) to (start, end, chunk id, count) stored after this call, to be recorded in the manifest;
+        None if nothing has been stored
     """
 
-    save_file = os.path.join(save_dir, '%d_%s.json' % (chunk_id, suffix))
-
-    if fromfile:
-        if os.path.isfile(save_file):
-            with open(save_file, 'r') as fp:
-                try:
-                    saved_probes = [literal_eval(i) for i in json.load(fp).keys()]
-                except ValueError:
-                    logging.warning("decoding %s failed." % save_file)
-                    saved_probes = []
-                if set(saved_probes) == set(probe_list):
-                    logging.info(
-                        "chunk %d skipped, as %s exists already and contains same probe IDs." % (chunk_id, save_file))
-                    return
-    # for all the other cases, download measurements
+    save_file = cf.chunk_file(save_dir, chunk_id, suffix)
+    start_epc = tt.datetime_to_epoch(start)
+    end_epc = tt.datetime_to_epoch(end)
+    stored = stored if (stored and fromfile and os.path.isfile(save_file)) else dict()
+
+    # file from a collection without manifest
+    if fromfile and not stored and os.path.isfile(save_file):
+        try:
+            with cf.ChunkReader(save_file) as saved:
+                saved_probes = saved.probes
+        except cf.ChunkError as e:
+            logging.warning("decoding %s failed: %s" % (save_file, e))
+            saved_probes = []
+        if set(saved_probes) == set(probe_list):
+            logging.info(
+                "chunk %d skipped, as %s exists already and contains same probe IDs." % (chunk_id, save_file))
+            return None
+
+    # time ranges to be fetched for each probe
+    missing = {pb: mf.missing_ranges(stored.get(pb), chunk_id, start_epc, end_epc) for pb in probe_list}
+    if not any(missing.values()):
+        logging.info("chunk %d skipped, as %s already covers the time window." % (chunk_id, save_file))
+        return None
+
     t1 = time.time()
     logging.debug("Starting working on chunk %d of measurement %s." % (chunk_id, suffix))
-    mes = at.get_ms_by_pb_msm_id(msm_id=msm, pb_id=probe_list, start=start, end=end)
-    if mes:
-        with open(os.path.join(save_dir, '%d_%s.json' % (chunk_id, suffix)), 'w') as fp:
-            json.dump(mes, fp)
+    # probes whose stored records can be extended
+    trusted = set([pb for pb, rg in stored.items() if rg[2] == chunk_id])
+    # probes missing the same time ranges are fetched together
+    by_ranges = dict()
+    for pb, rgs in missing.items():
+        if rgs:
+            by_ranges.setdefault(tuple(rgs), []).append(pb)
+
+    downloads = []
+    try:
+        for rgs, pbs in by_ranges.items():
+            for rg_start, rg_end in rgs:
+                downloads.append(os.path.join(save_dir, '.%d_%s.%d.part' % (chunk_id, suffix, len(downloads))))
+                fetcher.download(msm, pbs, rg_start, rg_end, downloads[-1])
+        counts = parsers.apply(store_chunk_wrapper, ((save_file, downloads, trusted),))
+        if counts is None:
+            # stored records are lost, start over with the entire window
+            trusted = set()
+            downloads = [os.path.join(save_dir, '.%d_%s.0.part' % (chunk_id, suffix))]
+            fetcher.download(msm, probe_list, start_epc, end_epc, downloads[0])
+            counts = parsers.apply(store_chunk_wrapper, ((save_file, downloads),))
+    except fc.FetchError as e:
+        logging.error("Chunk %d of measurement %s failed: %s" % (chunk_id, suffix, e))
+        for fn in downloads:
+            if os.path.isfile(fn):
+                os.remove(fn)
+        return None
+
+    covered = dict()
+    for pb in probe_list:
+        if pb in trusted:
+            covered[pb] = (min(start_epc, stored[pb][0]), max(end_epc, stored[pb][1]), chunk_id, counts.get(pb, 0))
+        else:
+            covered[pb] = (start_epc, end_epc, chunk_id, counts.get(pb, 0))
     t2 = time.time()
     logging.info("Chunk %d of measurement %s fetched in %s sec." % (chunk_id, suffix, (t2 - t1)))
+    return covered
 
 
 def mes_fetcher_wrapper(args):
     """ a wrapper for mes_fetcher
 
-    multiprocessing.Pool.map() doesn't take multiple args, therefore this wrapper
+    multiprocessing.pool.ThreadPool.imap_unordered() doesn't take multiple args, therefore this wrapper
     """
     try:
         return mes_fetcher(*args)
@@ -107,34 +204,67 @@ def main():
         logging.critical("config for data collection is not right.")
         return
 
+    # number of probes per chunk is optional
+    try:
+        chunk_size = config.getint("collection", "chunk_size")
+    except ConfigParser.NoOptionError:
+        chunk_size = 20
+    except ValueError:
+        logging.critical("config for data collection is not right.")
+        return
+
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--fromfile",
-                        help="read ./data/pb.csv for probes and "
+                        help="use the probes already in ./data/pb.cache (or ./data/pb.csv) and "
                              "only fetch measurements not yet present in the repository.",
                         action="store_true")
+    parser.add_argument("-r", "--refresh-probes",
+                        help="list all the probes from Atlas, instead of only the new ones "
+                             "when the last complete listing is less than a day old.",
+                        action="store_true")
+    parser.add_argument("-c", "--concurrency",
+                        help="number of requests to Atlas kept in flight, 8 by default.",
+                        type=int, default=8)
+    parser.add_argument("-p", "--parsers",
+                        help="number of processes parsing downloaded measurements, 2 by default.",
+                        type=int, default=2)
+    parser.add_argument("--server",
+                        help="Atlas API to query, e.g. a local stand-in; %s by default." % fc.ATLAS_SERVER,
+                        default=fc.ATLAS_SERVER)
     args = parser.parse_args()
 
+    fetcher = fc.AtlasFetcher(server=args.server)
+    start_epc = tt.datetime_to_epoch(start)
+    end_epc = tt.datetime_to_epoch(end)
     if args.fromfile:
-        probes = ms.read_probe(os.path.join(data_dir, "pb.csv"))
+        store = ps.load_store(data_dir)
     else:
-        # fetch probes/anchors and their meta data
+        # fetch probes/anchors and their meta data, only new and changed probes are merged to the cache
         t1 = time.time()
-        probes = at.get_pb(date=tt.datetime_to_epoch(start))
-        probes.extend(at.get_pb(is_anchor=True, date=tt.datetime_to_epoch(start)))
+        store = ps.ProbeStore(os.path.join(data_dir, ps.CACHE))
+        try:
+            store.refresh(fetcher, max_age=0 if args.refresh_probes else ps.FULL_REFRESH_AGE)
+        except fc.FetchError as e:
+            logging.critical("Probe query failed: %s" % e)
+            return
+        store.save()
         t2 = time.time()
         logging.info("Probe query finished in %d sec." % (t2-t1))
 
         # save probe meta info
         with open(os.path.join(data_dir, "pb.csv"), 'w') as fp:
-            fp.write("probe_id;address_v4;prefix_v4;asn_v4;address_v6;prefix_v6;asn_v6;is_anchor;country_code;system_tags\n")
-            for tup in probes:
+            fp.write("probe_id;address_v4;prefix_v4;asn_v4;address_v6;prefix_v6;asn_v6;"
+                     "is_anchor;country_code;first_connected;system_tags\n")
+            for tup in store.records(store.select(start_epc)):
                 fp.write(';'.join([str(i) for i in tup]) + '\n')
 
     # filter probes with system tags or with network attributes such as ASN and prefixes
-    pb_netv4 = [i[0] for i in probes if (i[2] is not None and i[3] is not None)]
-    pb_tagv4 = [i[0] for i in probes if 'system-ipv4-works' in i[-1]]
-    pb_netv6 = [i[0] for i in probes if (i[5] is not None and i[6] is not None)]
-    pb_tagv6 = [i[0] for i in probes if 'system-ipv6-works' in i[-1]]
+    selected = store.select(start_epc)
+    probes = store.ids(selected)
+    pb_netv4 = store.ids(selected & store.has_network(4))
+    pb_tagv4 = store.ids(selected & store.tagged('system-ipv4-works'))
+    pb_netv6 = store.ids(selected & store.has_network(6))
+    pb_tagv6 = store.ids(selected & store.tagged('system-ipv6-works'))
 
     # compare the two ways of filtering
     logging.info("%d/%d probes with not-None v4 ASN and prefixes." % (len(pb_netv4), len(probes)))
@@ -151,15 +281,24 @@ def main():
     logging.info("%d v6 tag - net" % len(set(pb_tagv6).difference(set(pb_netv6))))
 
     # collect measurements
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+    manifest = mf.Manifest(os.path.join(data_dir, 'manifest.json'))
+    # collection is bound by network latency: threads wait on HTTP, a few processes parse
+    parsers = multiprocessing.Pool(processes=max(1, min(args.parsers, multiprocessing.cpu_count())))
+    pool = ThreadPool(processes=max(1, args.concurrency))
     # v4 probes for v4 measurements
     task = ((pb_tagv4, msmv4, 'v4'), (pb_tagv6, msmv6, 'v6'))
+    first_connected = {i[0]: i[9] for i in store.records(selected)}
     for pbs, msm, tid in task:
-        # cut the entire list into chunks, each process will work on a chunk
-        id_chunks = [pbs[i:i+20] for i in xrange(0, len(pbs), 20)]
+        # cut the entire list into chunks of about equal measurement volume, each thread will work on a chunk
+        volume = pl.estimate_volume(pbs, start_epc, end_epc, msm, first_connected,
+                                    {mid: manifest.entries(mid, pbs) for mid in msm})
+        index_file = os.path.join(data_dir, "pb_chunk_index_%s.csv" % tid)
+        # keep probes in the chunks they are stored in, so that only missing time ranges are fetched
+        fixed = pl.read_chunk_index(index_file) if (args.fromfile and os.path.isfile(index_file)) else None
+        id_chunks = pl.plan_chunks(volume, chunk_size, fixed)
         chunk_count = len(id_chunks)
         # probe id to chunk id mapping
-        with open(os.path.join(data_dir, "pb_chunk_index_%s.csv" % tid), 'w') as fp:
+        with open(index_file, 'w') as fp:
             fp.write("probe_id;chunk_id\n")
             for chunk_id, probe_list in enumerate(id_chunks):
                 for pb in probe_list:
@@ -167,11 +306,17 @@ def main():
         # iterate over all measurement ids in this task, v4 or v6
         for mid in msm:
             t1 = time.time()
-            pool.map(mes_fetcher_wrapper,
-                     itertools.izip(xrange(chunk_count), itertools.repeat(mid),
-                                    id_chunks, itertools.repeat(start), itertools.repeat(end),
-                                    itertools.repeat(str(mid)), itertools.repeat(data_dir),
-                                    itertools.repeat(args.fromfile)))
+            stored = [manifest.entries(mid, probe_list) for probe_list in id_chunks]
+            # record the time range of each chunk in manifest as soon as it is stored
+            for covered in pool.imap_unordered(mes_fetcher_wrapper,
+                                               itertools.izip(xrange(chunk_count), itertools.repeat(mid),
+                                                              id_chunks, itertools.repeat(start), itertools.repeat(end),
+                                                              itertools.repeat(str(mid)), itertools.repeat(data_dir),
+                                                              itertools.repeat(fetcher), itertools.repeat(parsers),
+                                                              itertools.repeat(args.fromfile), stored)):
+                if covered:
+                    manifest.update(mid, covered)
+                    manifest.save()
             t2 = time.time()
             logging.info("%s Measurements %d fetched in %d sec." % (tid, mid, (t2-t1)))
 
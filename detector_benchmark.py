@@ -0,0 +1,252 @@
+"""
+This script benchmarks the IFP and AS path change detectors of localutils/pathtools.py on synthetic traceroute
+sequences whose changes are known, reporting for each detector the runtime, the peak memory and the agreement of the
+changes detected with the ground truth, e.g. to compare two versions of localutils/pathtools.py
+"""
+from localutils import pathtools as pt
+import multiprocessing
+import argparse
+import resource
+import timeit
+import bisect
+import random
+
+IXPS = ['AMS-IX', 'DE-CIX Frankfurt', 'LINX Juniper LAN', 'France-IX Paris']
+NOISE = ['Invalid IP address', 'private']
+
+
+def synthetic(n, size=16, width=4, change_rate=1e-3, as_rate=0.5, dev_rate=1e-3, dev_len=2, noise=1e-3, seed=None):
+    """ generate a traceroute sequence of a probe along with its ground truth changes
+
+    Paris id rotates over range(size). Each route is an IFP with width load balanced IP paths sharing the same AS path,
+    each paris id taking one of them. At each traceroute, the route changes with probability change_rate, the AS path
+    changing as well with probability as_rate, by one ASN or by the IXP crossed. Otherwise, with probability dev_rate,
+    the next 1 to dev_len traceroutes deviate to an IP path outside the IFP, the AS path unchanged.
+    The AS path of a traceroute is replaced with probability noise by a path ending with 'Invalid IP address' or
+    having a 'private' hop, as unresponsive destinations and private addresses do; such noise is not a change.
+
+    Args:
+        n (int): number of traceroutes
+        size (int): number of different paris id
+        width (int): number of IP paths per IFP, i.e. the load balancing width
+        change_rate (float): probability of a route change at each traceroute
+        as_rate (float): probability of a route change to change the AS path
+        dev_rate (float): probability of a short deviation beginning at each traceroute
+        dev_len (int): maximum length of a short deviation
+        noise (float): probability of a noisy AS path at each traceroute
+        seed (int): seed of the random generator
+
+    Returns:
+        dict: paris_id: list of int; paths: list of IP paths, list of string; as_paths: list of AS paths;
+        ifp: ground truth IFP changes, i.e. route changes, beginning and end of deviations;
+        as: ground truth AS path changes; ixp: AS path changes involving an IXP; all sorted lists of indexes
+    """
+    rnd = random.Random(seed)
+    start = rnd.randrange(size)
+    paris_id = [(start + i) % size for i in xrange(n)]
+    paths, as_paths = [], []
+    truth = {'ifp': [], 'as': [], 'ixp': []}
+    state = dict(route=-1, asn=[3333, 1299, 174], ixp=None)
+
+    def new_route():
+        """ the IP paths taken by each paris id, the AS path of the new route """
+        state['route'] += 1
+        hops = len(state['asn']) + 3
+        ip_paths = [['%d.%d.%d' % (state['route'], k, h) for h in xrange(hops)] for k in xrange(width)]
+        asp = [3333] + state['asn'] + [15169]
+        if state['ixp'] is not None:
+            asp.insert(2, state['ixp'])
+        return [ip_paths[rnd.randrange(width)] for _ in xrange(size)], asp
+
+    pattern, as_path = new_route()
+    dev_end, dev_path = 0, None
+    for i in xrange(n):
+        if i > 0 and rnd.random() < change_rate:
+            truth['ifp'].append(i)
+            dev_end = i  # a route change ends ongoing deviations
+            if rnd.random() < as_rate:
+                truth['as'].append(i)
+                if rnd.random() < 0.5:
+                    truth['ixp'].append(i)
+                    if state['ixp'] is None:
+                        state['ixp'] = rnd.choice(IXPS)
+                    else:
+                        state['ixp'] = rnd.choice([None] + [x for x in IXPS if x != state['ixp']])
+                else:
+                    state['asn'][rnd.randrange(len(state['asn']))] = rnd.randrange(1, 64000)
+            pattern, as_path = new_route()
+        elif i > 0 and i >= dev_end and rnd.random() < dev_rate:
+            dev_end = i + rnd.randint(1, dev_len)
+            dev_path = ['dev.%d.%d' % (i, h) for h in xrange(len(as_path) + 1)]
+            truth['ifp'].append(i)
+            if dev_end < n:
+                truth['ifp'].append(dev_end)
+        paths.append(dev_path if i < dev_end else pattern[paris_id[i]])
+        if rnd.random() < noise:
+            noisy = list(as_path)
+            if rnd.random() < 0.5:
+                noisy[-1] = NOISE[0]
+            else:
+                noisy.insert(1, NOISE[1])
+            as_paths.append(noisy)
+        else:
+            as_paths.append(as_path)
+    truth['ifp'] = sorted(set(truth['ifp']))
+    truth.update(paris_id=paris_id, paths=paths, as_paths=as_paths)
+    return truth
+
+
+def _segment_changes(seg):
+    """ beginnings of segments but the first one """
+    return [s.begin for s in seg[1:]]
+
+
+def _marked(change):
+    """ indexes set to 1 """
+    return [i for i, c in enumerate(change) if c]
+
+
+def _online(data, size):
+    """ IfpChangeDetector with bck_ext method fed with one traceroute at a time """
+    detector = pt.IfpChangeDetector(size, 'bck_ext')
+    return sorted(set(detector.extend(data['paris_id'], data['paths']) + detector.pending()))
+
+
+def _ip_path_changes(data, size):
+    """ ip_path_changes(), no agreement being given for several detectors """
+    pt.ip_path_changes(data['paris_id'], data['paths'], size)
+
+
+def _as_path_changes(data, size):
+    """ as_path_changes(), no agreement being given for several detectors """
+    pt.as_path_changes(data['as_paths'])
+
+
+# detector name to (ground truth, func(data, size) returning the indexes of changes)
+DETECTORS = [
+    ('ip_path_change_simple', ('ifp', lambda d, s: _segment_changes(pt.ip_path_change_simple(d['paris_id'],
+                                                                                              d['paths'], s)))),
+    ('ip_path_change_bck_ext', ('ifp', lambda d, s: _segment_changes(pt.ip_path_change_bck_ext(d['paris_id'],
+                                                                                                d['paths'], s)))),
+    ('ip_path_change_split', ('ifp', lambda d, s: _segment_changes(pt.ip_path_change_split(d['paris_id'],
+                                                                                            d['paths'], s)))),
+    ('ip_path_changes', ('ifp', _ip_path_changes)),
+    ('IfpChangeDetector', ('ifp', _online)),
+    ('as_path_change', ('as', lambda d, s: _marked(pt.as_path_change(d['as_paths'])))),
+    ('as_path_change_cl', ('as', lambda d, s: _marked(pt.as_path_change_cl(d['as_paths'])))),
+    ('as_path_change_cs', ('as', lambda d, s: _marked(pt.as_path_change_cs(d['as_paths'])))),
+    ('as_path_change_ixp', ('ixp', lambda d, s: _marked(pt.as_path_change_ixp(d['as_paths'])))),
+    ('as_path_change_ixp_cs', ('ixp', lambda d, s: _marked(pt.as_path_change_ixp_cs(d['as_paths'])))),
+    ('as_path_change_ixp_pu', ('ixp', lambda d, s: _marked(pt.as_path_change_ixp_pu(d['as_paths'])))),
+    ('as_path_changes', ('as', _as_path_changes)),
+]
+DETECTOR_NAMES = [name for name, _ in DETECTORS]
+DETECTORS = dict(DETECTORS)
+
+
+def agreement(truth, detected, tolerance):
+    """ precision and recall of detected changes, a change being matched if within tolerance of the other
+
+    Args:
+        truth (list of int): sorted indexes of ground truth changes
+        detected (list of int): sorted indexes of detected changes
+        tolerance (int): maximum distance between matching changes
+
+    Returns:
+        (float, float): precision and recall, None if there is nothing to match
+    """
+    def matched(x, ref):
+        cnt = 0
+        for i in x:
+            k = bisect.bisect_left(ref, i - tolerance)
+            if k < len(ref) and ref[k] <= i + tolerance:
+                cnt += 1
+        return cnt
+
+    precision = float(matched(detected, truth)) / len(detected) if detected else None
+    recall = float(matched(truth, detected)) / len(truth) if truth else None
+    return precision, recall
+
+
+def run_detector(name, data, size, tolerance, queue):
+    """ time a detector, measure its peak memory and agreement; meant to run in a forked process
+
+    The peak memory is the growth of the maximum resident set size of the process during the run,
+    the traceroute sequence being already in memory.
+
+    Args:
+        name (string): in DETECTORS
+        data (dict): see synthetic()
+        size (int): number of different paris id
+        tolerance (int): see agreement()
+        queue (multiprocessing.Queue): receives (time in sec, peak memory in MB, precision, recall)
+    """
+    truth, func = DETECTORS[name]
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t1 = timeit.default_timer()
+    detected = func(data, size)
+    t = timeit.default_timer() - t1
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024.0
+    precision, recall = (None, None) if detected is None else agreement(data[truth], detected, tolerance)
+    queue.put((t, peak, precision, recall))
+
+
+def measure(name, data, size, tolerance):
+    """ run_detector() in a process of its own, so that the peak memory of each detector is measured apart
+
+    Returns:
+        (float, float, float, float): see run_detector()
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=run_detector, args=(name, data, size, tolerance, queue))
+    proc.start()
+    res = queue.get()
+    proc.join()
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--length", type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="numbers of traceroutes in the sequences; 10000 100000 1000000 by default.")
+    parser.add_argument("-d", "--detector", nargs='+', choices=DETECTOR_NAMES, default=DETECTOR_NAMES,
+                        help="detectors to benchmark; all by default.")
+    parser.add_argument("--size", type=int, default=16,
+                        help="number of different paris id; 16 by default.")
+    parser.add_argument("--width", type=int, default=4,
+                        help="load balancing width, i.e. IP paths per IFP; 4 by default.")
+    parser.add_argument("--change-rate", type=float, default=1e-3,
+                        help="probability of route change per traceroute; 0.001 by default.")
+    parser.add_argument("--as-rate", type=float, default=0.5,
+                        help="probability of a route change to change AS path as well; 0.5 by default.")
+    parser.add_argument("--dev-rate", type=float, default=1e-3,
+                        help="probability of short deviation per traceroute; 0.001 by default.")
+    parser.add_argument("--dev-len", type=int, default=2,
+                        help="maximum length of short deviations; 2 by default.")
+    parser.add_argument("--noise", type=float, default=1e-3,
+                        help="probability of noisy AS path per traceroute; 0.001 by default.")
+    parser.add_argument("-t", "--tolerance", type=int, default=None,
+                        help="maximum distance between a detected change and a ground truth one; --size by default.")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="seed of the synthetic sequences; 0 by default.")
+    args = parser.parse_args()
+    tolerance = args.size if args.tolerance is None else args.tolerance
+
+    def fmt(x):
+        return '%10s' % '-' if x is None else '%10.3f' % x
+
+    for n in args.length:
+        data = synthetic(n, args.size, args.width, args.change_rate, args.as_rate, args.dev_rate, args.dev_len,
+                         args.noise, args.seed)
+        print "%d traceroutes: %d IFP, %d AS, %d IXP changes" % (n, len(data['ifp']), len(data['as']),
+                                                                  len(data['ixp']))
+        print "%-24s %10s %12s %10s %10s %10s" % ('detector', 'sec', 'usec/trace', 'peak MB', 'precision', 'recall')
+        for name in [i for i in DETECTOR_NAMES if i in args.detector]:
+            t, peak, precision, recall = measure(name, data, args.size, tolerance)
+            print "%-24s %10.3f %12.2f %10.1f %s %s" % (name, t, t / max(n, 1) * 1e6, peak, fmt(precision),
+                                                        fmt(recall))
+        print
+
+
+if __name__ == '__main__':
+    main()
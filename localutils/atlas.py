@@ -2,8 +2,10 @@
 atlas.py provides functions to handle with atlas measurements
 """
 from ripe.atlas.cousteau import AtlasResultsRequest, ProbeRequest
-from error import MES_ERR, TIMEOUT_ERR, UNKNOWN_ERR, LATE_ERR, IP_ERR
+from error import MES_ERR, TIMEOUT_ERR, UNKNOWN_ERR, LATE_ERR, IP_ERR, MISS_ERR
+from buffers import BUFFER, IpTable, TraceBuffer
 import logging
+import numpy as np
 import timetools as tt
 
 
@@ -17,7 +19,8 @@ def get_pb(pb_tag="system-v3", is_anchor=False, date=None, asn=None):
         asn (int) :  Autonomous System Number, default to None, all probes will be fetched
 
     Returns:
-        pb_id (list of tuple): [(id, asn_v4, ans_v6,...),]
+        pb_id (list of tuple): [(id, address_v4, prefix_v4, asn_v4, address_v6, prefix_v6, asn_v6,
+                                 is_anchor, country_code, first_connected, system_tags),]
 
     Notes:
         By default only v3 probes are selected.
@@ -36,18 +39,31 @@ def get_pb(pb_tag="system-v3", is_anchor=False, date=None, asn=None):
         if date and pb["first_connected"] > date:
             pass
         else:
-            # get all the system tags
-            tags = []
-            for d in pb["tags"]:
-                if 'system-' in d["slug"]:
-                    tags.append(str(d["slug"]))
-            tags = tuple(tags)
-            pb_id.append((pb["id"], pb['address_v4'], pb['prefix_v4'], pb['asn_v4'],
-                          pb['address_v6'], pb['prefix_v6'], pb['asn_v6'],
-                          pb['is_anchor'], pb['country_code'], tags))
+            pb_id.append(probe_tuple(pb))
     return pb_id
 
 
+def probe_tuple(pb):
+    """ extract the probe meta data used in the project from a probe returned by Atlas probe API
+
+    Args:
+        pb (dict): probe as returned by the Atlas API
+
+    Returns:
+        tuple: (id, address_v4, prefix_v4, asn_v4, address_v6, prefix_v6, asn_v6,
+                is_anchor, country_code, first_connected, system_tags)
+    """
+    # get all the system tags
+    tags = []
+    for d in pb["tags"]:
+        if 'system-' in d["slug"]:
+            tags.append(str(d["slug"]))
+    tags = tuple(tags)
+    return (pb["id"], pb['address_v4'], pb['prefix_v4'], pb['asn_v4'],
+            pb['address_v6'], pb['prefix_v6'], pb['asn_v6'],
+            pb['is_anchor'], pb['country_code'], pb['first_connected'], tags)
+
+
 def get_ms_by_pb_msm_id(msm_id, pb_id, start, end):
     """ fetch atlas measurements by measurement id and probe id.
 
@@ -71,6 +87,10 @@ def get_ms_by_pb_msm_id(msm_id, pb_id, start, end):
         return group_by_probe(results)
 
 
+# number of ping measurements parsed at once by stream_group_by_probe()
+PING_BATCH = 4096
+
+
 # TODO: if elif else structure kind of redundant
 def group_by_probe(results):
     """ Given a list of Atlas measurements in JSON format, parse them and group them by probe id
@@ -119,6 +139,61 @@ def group_by_probe(results):
     return by_probe
 
 
+def stream_group_by_probe(results, ip_table=None):
+    """ Given an iterable of Atlas measurements in JSON format, parse them and append them to per-probe buffers
+
+    Same as group_by_probe() except that results are consumed one by one and stored in typed buffers,
+    therefore results can be a generator reading from network or disk.
+
+    Args:
+        results (iterable of dict): each dict is an Atlas measurement in JSON format
+        ip_table (buffers.IpTable): where traceroute hops are interned, a new one if not given
+
+    Returns:
+        by_probe (dict): key is the probe id in int, item is a PingBuffer, TraceBuffer or ConnectionBuffer
+    """
+    by_probe = dict()
+    ip_table = ip_table if ip_table is not None else IpTable()
+    pings = []
+    for mes in results:
+        if isinstance(mes, dict):
+            probe_id = mes.get('prb_id', -1)
+            type_ = mes.get('type', None)
+            if type_ not in PARSER:
+                logging.warning("%d had unsupported type of measurements %s" % (probe_id, str(type_)))
+                continue
+            if probe_id not in by_probe:
+                by_probe[probe_id] = TraceBuffer(ip_table) if type_ == 'traceroute' else BUFFER[type_]()
+            if type_ == 'ping' and by_probe[probe_id].kind == 'ping':
+                pings.append(mes)
+                if len(pings) >= PING_BATCH:
+                    _flush_pings(pings, by_probe)
+                    pings = []
+            else:
+                if pings:  # keep the order of measurements
+                    _flush_pings(pings, by_probe)
+                    pings = []
+                by_probe[probe_id].append(PARSER[type_](mes))
+        else:
+            logging.warning("Encountered an abnormal measurement: %s" % mes)
+    if pings:
+        _flush_pings(pings, by_probe)
+    return by_probe
+
+
+def _flush_pings(pings, by_probe):
+    """ parse a batch of ping measurements and append them to the buffers of their probes
+
+    RTTs are parsed in double precision so that the buffers hold exactly what parser_of_ping() returns.
+    """
+    batch = parse_ping_batch(pings, dtype=np.float64)
+    order = np.argsort(batch['prb_id'], kind='mergesort')  # stable, measurements of a probe stay in order
+    pbs = batch['prb_id'][order]
+    bounds = np.flatnonzero(np.diff(pbs)) + 1
+    for rows in np.split(order, bounds):
+        by_probe[int(batch['prb_id'][rows[0]])].extend(batch, rows)
+
+
 def parser_of_connection(data):
     """ Parse the special measurement id for connection events
 
@@ -163,6 +238,59 @@ def parser_of_ping(data):
     return rtt
 
 
+def parse_ping_batch(results, dtype=np.float32):
+    """ Given a list of ping measurements, extract probe ids, timestamps and RTTs into contiguous arrays
+
+    Semantics are the same as parser_of_ping() applied to each measurement, yet values are
+    collected in one flat buffer and the smallest positive RTTs are computed for all measurements at once.
+
+    Args:
+        results (list of dict): each dict is a ping measurement, see parser_of_ping()
+        dtype (numpy.dtype): type of RTT values; numpy.float64 keeps exactly the values of parser_of_ping()
+
+    Returns:
+        dict(prb_id=numpy.int64 array of N, epoch=numpy.int64 array of N, min_rtt=array of N,
+        all_rtt=N*k array, rtt_count=numpy.int32 array of N)
+        all_rtt[i, :rtt_count[i]] are the RTTs of i-th measurement with negative error codes of error.py,
+        the rest of the row is filled with MISS_ERR;
+        k is the largest rtt_count; a measurement without result has rtt_count 0, NaN min_rtt and a row of NaN
+    """
+    n = len(results)
+    prb_id = np.empty(n, dtype=np.int64)
+    epoch = np.empty(n, dtype=np.int64)
+    ends = np.zeros(n, dtype=np.int64)  # all_rtt of i-th measurement ends at ends[i] in flat
+    flat = []
+    append = flat.append
+    for i, data in enumerate(results):
+        pb_id = prb_id[i] = data['prb_id']
+        tstp = epoch[i] = data['timestamp']
+        for res in data.get('result', None) or []:
+            if len(res) == 1 and 'rtt' in res:  # the common case
+                append(float(res['rtt']))
+            else:
+                flat.extend(rtt_of_ping(pb_id, tstp, [res]))
+        ends[i] = len(flat)
+    rtt_count = np.diff(np.concatenate(([0], ends))).astype(np.int32)
+
+    k = int(rtt_count.max()) if n else 0
+    flat = np.array(flat, dtype=np.float64)
+    all_rtt = np.full((n, k), MISS_ERR, dtype=np.float64)
+    rows = np.repeat(np.arange(n), rtt_count)
+    cols = np.arange(len(flat)) - np.repeat(ends - rtt_count, rtt_count)
+    all_rtt[rows, cols] = flat
+
+    min_rtt = np.full(n, np.nan, dtype=np.float64)
+    if k:
+        valid = np.arange(k) < rtt_count[:, None]
+        pos = np.where(valid & (all_rtt > 0), all_rtt, np.inf).min(axis=1)
+        neg = np.where(valid, all_rtt, -np.inf).max(axis=1)
+        min_rtt = np.where(np.isinf(pos), neg, pos)
+        min_rtt[rtt_count == 0] = np.nan
+    all_rtt[rtt_count == 0] = np.nan
+    return dict(prb_id=prb_id, epoch=epoch, min_rtt=min_rtt.astype(dtype), all_rtt=all_rtt.astype(dtype),
+                rtt_count=rtt_count)
+
+
 def parser_of_trace(data):
     """ Given a dict of traceroute measurement, extract timestamps, valide hops and rtts to each hop
 
@@ -240,12 +368,12 @@ def rtt_of_ping(pb_id, tstp, results):
             elif key == 'error':
                 if 'unreachable' not in value:
                     logging.debug(
-                        "%d had measurement error other than unreachable at %s : %s" % (pb_id, tt.epoch_to_string(tstp), value))
+                        "%d had measurement error other than unreachable at %s : %s", pb_id, tt.LazyEpochString(tstp), value)
                 rtt_in_res.append(MES_ERR)
             elif key == 'x':
                 rtt_in_res.append(TIMEOUT_ERR)
             else:
-                logging.debug("%d had optional fields %s:%s in results at %s" % (pb_id, key, value, tt.epoch_to_string(tstp)))
+                logging.debug("%d had optional fields %s:%s in results at %s", pb_id, key, value, tt.LazyEpochString(tstp))
                 rtt_in_res.append(UNKNOWN_ERR)
     return rtt_in_res
 
@@ -292,18 +420,18 @@ def hops_of_trace(pb_id, tstp, results):
         else:
             n_hop = None
             logging.warning(
-                "%d had a traceroute measurement without hop field at %s" % (pb_id, tt.epoch_to_string(tstp)))
+                "%d had a traceroute measurement without hop field at %s", pb_id, tt.LazyEpochString(tstp))
 
         if 'result' in rec:
             from_ip, rtt = get_hop(pb_id, tstp, rec['result'])
             hops.append((n_hop, from_ip, rtt))  # normal return cases
         elif 'error' in rec:
             hops.append((n_hop, IP_ERR, MES_ERR))
-            logging.debug("%d had measurement error at %s : %s" % (pb_id, tt.epoch_to_string(tstp), rec['error']))
+            logging.debug("%d had measurement error at %s : %s", pb_id, tt.LazyEpochString(tstp), rec['error'])
         else:
             hops.append((n_hop, IP_ERR, UNKNOWN_ERR))
             logging.warning(
-                "%d had a traceroute measurement without error or result field at %s" % (pb_id, tt.epoch_to_string(tstp)))
+                "%d had a traceroute measurement without error or result field at %s", pb_id, tt.LazyEpochString(tstp))
     return tuple(hops)
 
 
@@ -345,6 +473,16 @@ def get_hop(pb_id, tstp, hop_result):
         u'timestamp': 1483229317,
         u'type': u'traceroute'}
     """
+    # fast path for the most frequent cases: all replies from the same IP, or all timed out
+    first = hop_result[0] if hop_result else None
+    if first and 'from' in first:
+        ip = first['from']
+        if all(['rtt' in rec and rec.get('from') == ip for rec in hop_result]):
+            return ip, min_pos([rec['rtt'] for rec in hop_result])
+    elif first and 'x' in first:
+        if all(['x' in rec and 'from' not in rec for rec in hop_result]):
+            return 'x', TIMEOUT_ERR
+
     mes = dict()
     for rec in hop_result:
         if 'from' in rec:
@@ -355,15 +493,15 @@ def get_hop(pb_id, tstp, hop_result):
             elif 'err' in rec:
                 mes[rec['from']].append(MES_ERR)
                 logging.debug(
-                        "%d had traceroute measurement error at %s: %s" % (pb_id, tt.epoch_to_string(tstp), rec['err']))
+                        "%d had traceroute measurement error at %s: %s", pb_id, tt.LazyEpochString(tstp), rec['err'])
             elif 'late' in rec:
                 mes[rec['from']].append(LATE_ERR)
                 logging.debug(
-                        "%d had %d late packets in traceroute at %s" % (pb_id, rec['late'], tt.epoch_to_string(tstp)))
+                        "%d had %d late packets in traceroute at %s", pb_id, rec['late'], tt.LazyEpochString(tstp))
             else:
                 mes[rec['from']].append(UNKNOWN_ERR)
                 logging.warning(
-                        "%d had traceroute measurement w/o rtt,err,late flied at %s" % (pb_id, tt.epoch_to_string(tstp)))
+                        "%d had traceroute measurement w/o rtt,err,late flied at %s", pb_id, tt.LazyEpochString(tstp))
         elif 'x' in rec:
             if 'x' not in mes:
                 mes['x'] = []
@@ -374,22 +512,25 @@ def get_hop(pb_id, tstp, hop_result):
             if 'err' in rec:
                 mes[IP_ERR].append(MES_ERR)
                 logging.debug(
-                    "%d had traceroute measurement error at %s: %s" % (pb_id, tt.epoch_to_string(tstp), rec['err']))
+                    "%d had traceroute measurement error at %s: %s", pb_id, tt.LazyEpochString(tstp), rec['err'])
             elif 'error' in rec:
                 mes[IP_ERR].append(MES_ERR)
                 logging.debug(
-                    "%d had traceroute measurement error at %s: %s" % (pb_id, tt.epoch_to_string(tstp), rec['error']))
+                    "%d had traceroute measurement error at %s: %s", pb_id, tt.LazyEpochString(tstp), rec['error'])
             else:
                 mes[IP_ERR].append(UNKNOWN_ERR)
                 logging.warning(
-                    "%d had UNKNOWN traceroute measurement error at %s: No from, err, x is present" % (pb_id, tt.epoch_to_string(tstp)))
+                    "%d had UNKNOWN traceroute measurement error at %s: No from, err, x is present", pb_id, tt.LazyEpochString(tstp))
 
-    # get the IP hop with most presence in one traceroute measurement
-    ip_hop = sorted(mes.items(), key=lambda s: len(s[1]), reverse=True)[0][0]
+    # get the IP hop with most presence in one traceroute measurement, the first one met in case of tie
+    ip_hop = max(mes.items(), key=lambda s: len(s[1]))[0]
     rtt = min_pos(mes[ip_hop])  # get non-negative RTT of that hop
     return ip_hop, rtt
 
 
+PARSER = {'ping': parser_of_ping, 'traceroute': parser_of_trace, 'connection': parser_of_connection}
+
+
 def min_pos(x):
     """ return the smallest positive number in a given numeric list;
     in the case all values are negative, return the biggest one (generally the err code for timeout)
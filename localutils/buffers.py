@@ -0,0 +1,255 @@
+"""
+buffers.py provides typed columnar buffers that hold the parsed measurements of one probe
+"""
+from array import array
+import math
+
+# placeholders for fields that can be absent in a parsed measurement
+NONE_INT = -1
+NONE_FLOAT = float('nan')
+
+
+def _float_or_nan(x):
+    """ map None to NaN so that it fits in an array of double """
+    return NONE_FLOAT if x is None else x
+
+
+def _restore_rtt(x):
+    """ map a value stored in a double array back to what the parsers return
+
+    NaN is translated back to None, negative error codes back to int, valid RTTs are left untouched.
+    """
+    if math.isnan(x):
+        return None
+    elif x < 0:
+        return int(x)
+    else:
+        return x
+
+
+def _restore_int(x):
+    """ map NONE_INT back to None """
+    return None if x == NONE_INT else x
+
+
+class PingBuffer:
+    """ PingBuffer accumulates parsed ping measurements of one probe in typed arrays
+
+    Attributes:
+        epoch (array of long): timestamp of each measurement
+        min_rtt (array of double): smallest positive RTT of each measurement, NaN if no result
+        all_rtt (array of double): RTTs of all the measurements concatenated
+        rtt_offset (array of long): all_rtt[rtt_offset[i]:rtt_offset[i+1]] are the RTTs of the i-th measurement
+    """
+    kind = 'ping'
+
+    def __init__(self):
+        self.epoch = array('l')
+        self.min_rtt = array('d')
+        self.all_rtt = array('d')
+        self.rtt_offset = array('l', [0])
+
+    def __len__(self):
+        return len(self.epoch)
+
+    def append(self, rec):
+        """ append one measurement
+
+        Args:
+            rec (dict): output of atlas.parser_of_ping()
+        """
+        self.epoch.append(rec['epoch'])
+        self.min_rtt.append(_float_or_nan(rec['min_rtt']))
+        self.all_rtt.extend([_float_or_nan(i) for i in rec['all_rtt']])
+        self.rtt_offset.append(len(self.all_rtt))
+
+    def extend(self, batch, rows):
+        """ append measurements from the output of atlas.parse_ping_batch()
+
+        Args:
+            batch (dict): output of atlas.parse_ping_batch()
+            rows (numpy.array of int): indexes of the measurements to be appended, in order
+        """
+        self.epoch.extend(batch['epoch'][rows].tolist())
+        self.min_rtt.extend(batch['min_rtt'][rows].tolist())
+        all_rtt, rtt_count = batch['all_rtt'], batch['rtt_count']
+        for i in rows:
+            n = rtt_count[i]
+            if n:
+                self.all_rtt.extend(all_rtt[i, :n].tolist())
+            else:  # no result, same as atlas.parser_of_ping()
+                self.all_rtt.extend([NONE_FLOAT] * 3)
+            self.rtt_offset.append(len(self.all_rtt))
+
+    def to_dict(self):
+        """ convert the buffer to the format returned by atlas.group_by_probe()
+
+        Returns:
+            dict(epoch=[int], min_rtt=[float], all_rtt=[tuple of float])
+        """
+        off = self.rtt_offset
+        return dict(epoch=self.epoch.tolist(),
+                    min_rtt=[_restore_rtt(i) for i in self.min_rtt],
+                    all_rtt=[tuple([_restore_rtt(i) for i in self.all_rtt[off[k]:off[k+1]]])
+                             for k in xrange(len(self.epoch))])
+
+
+class IpTable:
+    """ IpTable interns the hop IP addresses met in a chunk, each distinct address is given an int id
+
+    Besides IP addresses, the table also holds the placeholders for hops without address, i.e. 'x' and IP_ERR.
+
+    Attributes:
+        ips (list of string): ips[i] is the address of id i
+        ids (dict): address to its id
+    """
+    def __init__(self, ips=()):
+        self.ips = []
+        self.ids = dict()
+        for ip in ips:
+            self.id_of(ip)
+
+    def __len__(self):
+        return len(self.ips)
+
+    def __getitem__(self, i):
+        return self.ips[i]
+
+    def id_of(self, ip):
+        """ get the id of an IP address, a new id is given to an address not yet seen
+
+        Args:
+            ip (string)
+
+        Returns:
+            int
+        """
+        i = self.ids.get(ip)
+        if i is None:
+            ip = intern(str(ip))
+            i = self.ids[ip] = len(self.ips)
+            self.ips.append(ip)
+        return i
+
+
+class TraceBuffer:
+    """ TraceBuffer accumulates parsed traceroute measurements of one probe in typed arrays
+
+    Paths are stored as ragged arrays: the hops of all paths are concatenated, and each hop IP is
+    replaced by its id in an IpTable, normally shared by all the probes of a chunk.
+
+    Attributes:
+        epoch (array of long): timestamp of each measurement
+        paris_id (array of long): Paris ID of each measurement, NONE_INT if absent
+        has_path (array of byte): 0 if the measurement came without result, thus path None
+        path_offset (array of long): hops of the i-th path are in [path_offset[i], path_offset[i+1])
+        hop_n (array of short): hop count, NONE_INT if absent
+        hop_ip (array of int): id of the hop IP address in ip_table
+        hop_rtt (array of double): RTT of the hop
+        ip_table (IpTable): where hop IP addresses are interned
+    """
+    kind = 'traceroute'
+
+    def __init__(self, ip_table=None):
+        self.epoch = array('l')
+        self.paris_id = array('l')
+        self.has_path = array('b')
+        self.path_offset = array('l', [0])
+        self.hop_n = array('h')
+        self.hop_ip = array('i')
+        self.hop_rtt = array('d')
+        self.ip_table = ip_table if ip_table is not None else IpTable()
+
+    def __len__(self):
+        return len(self.epoch)
+
+    def append(self, rec):
+        """ append one measurement
+
+        Args:
+            rec (dict): output of atlas.parser_of_trace()
+        """
+        self.epoch.append(rec['epoch'])
+        pid = rec['paris_id']
+        self.paris_id.append(NONE_INT if pid is None else pid)
+        path = rec['path']
+        if path is None:
+            self.has_path.append(0)
+        else:
+            self.has_path.append(1)
+            id_of = self.ip_table.id_of
+            for n_hop, ip, rtt in path:
+                self.hop_n.append(NONE_INT if n_hop is None else n_hop)
+                self.hop_ip.append(id_of(ip))
+                self.hop_rtt.append(_float_or_nan(rtt))
+        self.path_offset.append(len(self.hop_n))
+
+    def get_path(self, k):
+        """ rebuild the k-th path
+
+        Returns:
+            tuple of (hop count int, IP address string, RTT) or None
+        """
+        if not self.has_path[k]:
+            return None
+        ips = self.ip_table.ips
+        return tuple([(_restore_int(self.hop_n[i]), ips[self.hop_ip[i]], _restore_rtt(self.hop_rtt[i]))
+                      for i in xrange(self.path_offset[k], self.path_offset[k+1])])
+
+    def get_ip_ids(self, k):
+        """ the hop IP ids of the k-th path, cheaper to compare than the rebuilt path
+
+        Returns:
+            tuple of int or None
+        """
+        if not self.has_path[k]:
+            return None
+        return tuple(self.hop_ip[self.path_offset[k]:self.path_offset[k+1]])
+
+    def to_dict(self):
+        """ convert the buffer to the format returned by atlas.group_by_probe()
+
+        Returns:
+            dict(epoch=[int], paris_id=[int], path=[tuple of hops])
+        """
+        return dict(epoch=self.epoch.tolist(),
+                    paris_id=[_restore_int(i) for i in self.paris_id],
+                    path=[self.get_path(k) for k in xrange(len(self.epoch))])
+
+
+class ConnectionBuffer:
+    """ ConnectionBuffer accumulates connection events of one probe
+
+    Attributes:
+        connect (array of long): timestamps of connect events
+        disconnect (array of long): timestamps of disconnect events
+    """
+    kind = 'connection'
+
+    def __init__(self):
+        self.connect = array('l')
+        self.disconnect = array('l')
+
+    def __len__(self):
+        return len(self.connect) + len(self.disconnect)
+
+    def append(self, rec):
+        """ append one event
+
+        Args:
+            rec (dict): output of atlas.parser_of_connection()
+        """
+        for k, v in rec.items():
+            getattr(self, k).append(v)
+
+    def to_dict(self):
+        """ convert the buffer to the format returned by atlas.group_by_probe()
+
+        Returns:
+            dict(connect=[int], disconnect=[int])
+        """
+        return dict(connect=self.connect.tolist(), disconnect=self.disconnect.tolist())
+
+
+BUFFER = {'ping': PingBuffer, 'traceroute': TraceBuffer, 'connection': ConnectionBuffer}
+
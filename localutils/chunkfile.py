@@ -0,0 +1,508 @@
+"""
+chunkfile.py reads and writes measurement chunks in a binary columnar format
+
+A chunk file holds the measurements of several probes for one measurement id, as the json chunk files did.
+Each probe is stored as a set of typed columns, the attributes of buffers.PingBuffer, TraceBuffer
+or ConnectionBuffer, one after the other. The file layout is:
+
+    MAGIC | columns of probe 1 | columns of probe 2 | ... | IP table | header (json) | header offset (uint64) | MAGIC
+
+The header, at the end of the file, gives for each probe the position of its columns.
+The columns of a probe are followed by their own directory, so that a probe can be decoded alone:
+<chunk>_<msm>.idx next to the chunk file gives the byte range of each probe, see load_probe().
+Columns are little-endian arrays aligned on 8 bytes, read through a memory map without copy unless compressed.
+RTTs are quantized to int32 ticks of 1/rtt_scale msec; error codes of error.py are kept as is.
+"""
+from buffers import BUFFER, IpTable, NONE_FLOAT, NONE_INT
+from planner import read_chunk_index
+from array import array
+import glob
+import numpy as np
+import logging
+import struct
+import mmap
+import json
+import zlib
+import os
+
+MAGIC = 'RTTCHNK1'
+EXT = '.col'
+IDX_MAGIC = 'RTTIDX02'
+IDX_EXT = '.idx'
+# RTTs are stored in microseconds by default
+DEFAULT_RTT_SCALE = 1000
+# stored in place of a missing RTT
+RTT_NONE = -2 ** 31
+# column name and stored type for each kind of measurement; 'rtt' for quantized RTTs
+COLUMNS = {'ping': (('epoch', '<i8'), ('min_rtt', 'rtt'), ('all_rtt', 'rtt'), ('rtt_offset', '<i4')),
+           'traceroute': (('epoch', '<i8'), ('paris_id', '<i2'), ('has_path', '|i1'), ('path_offset', '<i4'),
+                          ('hop_n', '<i2'), ('hop_ip', '<i4'), ('hop_rtt', 'rtt')),
+           'connection': (('connect', '<i8'), ('disconnect', '<i8'))}
+_FOOTER = struct.Struct('<Q8s')
+# index file: magic, size and CRC32 of the header of the chunk file, position of the IP table,
+# then one entry per probe sorted by probe id
+_IDX_HEADER = struct.Struct('<8sQQQQQQ')
+_IDX_ENTRY = np.dtype([('pb', '<i8'), ('offset', '<i8'), ('length', '<i8'), ('dir_length', '<i8')])
+
+
+class ChunkError(Exception):
+    """ raised when a file is not a valid chunk file """
+    pass
+
+
+def chunk_file(data_dir, chunk_id, msm):
+    """ path to the chunk file of a given chunk id and measurement id
+
+    Args:
+        data_dir (string): where the chunk files are stored
+        chunk_id (int)
+        msm (int or string): measurement id
+
+    Returns:
+        string, e.g. data/0_1010.col
+    """
+    return os.path.join(data_dir, "%d_%s%s" % (chunk_id, msm, EXT))
+
+
+def index_file(fn):
+    """ path to the index of a chunk file, e.g. data/0_1010.idx for data/0_1010.col """
+    return os.path.splitext(fn)[0] + IDX_EXT
+
+
+def _crc(data):
+    """ unsigned CRC32 of a string or buffer """
+    return zlib.crc32(data) & 0xffffffff
+
+
+def encode_rtt(x, rtt_scale=DEFAULT_RTT_SCALE):
+    """ quantize RTTs for storage
+
+    Args:
+        x (numpy.array of float): RTTs in msec, negative error codes, NaN for missing values
+        rtt_scale (int): ticks per msec; 0 to keep float64 values untouched
+
+    Returns:
+        numpy.array of int32, or of float64 if rtt_scale is 0
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if not rtt_scale:
+        return x.astype('<f8')
+    out = np.full(len(x), RTT_NONE, dtype='<i4')
+    valid = ~np.isnan(x)
+    out[valid] = np.where(x[valid] < 0, x[valid], np.round(x[valid] * rtt_scale))
+    return out
+
+
+def decode_rtt(x, rtt_scale=DEFAULT_RTT_SCALE):
+    """ reverse of encode_rtt()
+
+    Returns:
+        numpy.array of float64: RTTs in msec, negative error codes, NaN for missing values
+    """
+    if not rtt_scale:
+        return np.asarray(x, dtype=np.float64)
+    out = x.astype(np.float64)
+    pos = x >= 0
+    out[pos] /= rtt_scale
+    out[x == RTT_NONE] = NONE_FLOAT
+    return out
+
+
+class ChunkWriter:
+    """ ChunkWriter writes probe buffers one by one to a chunk file
+
+    The file is written under a temporary name and renamed on close(), a chunk file is thus always complete.
+
+    Attributes:
+        fn (string): path to the chunk file
+        kind (string): ping, traceroute or connection; taken from the first buffer added if not given
+        rtt_scale (int): RTTs are stored in 1/rtt_scale msec; 0 to store them in float64
+        compress (bool): compress columns with zlib; compressed columns are no more memory-mapped when read
+    """
+    def __init__(self, fn, kind=None, rtt_scale=DEFAULT_RTT_SCALE, compress=False):
+        self.fn = fn
+        self.kind = kind
+        self.rtt_scale = rtt_scale
+        self.compress = compress
+        self._tmp = fn + '.tmp'
+        self._fp = open(self._tmp, 'wb')
+        self._fp.write(MAGIC)
+        self._probes = []
+        self._index = []
+        self._ip_table = IpTable()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._fp.close()
+            os.remove(self._tmp)
+
+    def _write(self, data):
+        """ write a block aligned on 8 bytes, return [offset, stored length, compressed] """
+        pad = -self._fp.tell() % 8
+        if pad:
+            self._fp.write('\0' * pad)
+        offset = self._fp.tell()
+        if self.compress:
+            data = zlib.compress(data, 6)
+        self._fp.write(data)
+        return [offset, len(data), int(self.compress)]
+
+    def add(self, pb, buf):
+        """ write the columns of a probe
+
+        Args:
+            pb (int): probe id
+            buf (buffers.PingBuffer, TraceBuffer or ConnectionBuffer)
+        """
+        if self.kind is None:
+            self.kind = buf.kind
+        elif self.kind != buf.kind:
+            raise ValueError("%s buffer of probe %d in a %s chunk" % (buf.kind, pb, self.kind))
+        columns = dict()
+        for name, dtype in COLUMNS[self.kind]:
+            if name == 'hop_ip':
+                # ids are given by the table of the buffer, translate them to the table of the file
+                mapping = np.array([self._ip_table.id_of(ip) for ip in buf.ip_table.ips], dtype='<i4')
+                col = mapping[np.asarray(buf.hop_ip, dtype=np.int64)] if len(buf.hop_ip) else np.array([], '<i4')
+            elif dtype == 'rtt':
+                col = encode_rtt(getattr(buf, name), self.rtt_scale)
+            else:
+                col = np.asarray(getattr(buf, name)).astype(dtype)
+            columns[name] = self._write(col.tostring()) + [len(col)]
+        self._probes.append([pb, columns])
+        # directory of the probe right after its columns
+        directory = json.dumps(dict(kind=self.kind, rtt_scale=self.rtt_scale, columns=columns))
+        start = min([c[0] for c in columns.values()])
+        self._fp.write(directory)
+        self._index.append((pb, start, self._fp.tell() - start, len(directory)))
+
+    def close(self):
+        """ write the IP table and the header, then move the index and the file in place """
+        ips = self._write('\n'.join(self._ip_table.ips)) + [len(self._ip_table)]
+        header = json.dumps(dict(kind=self.kind, rtt_scale=self.rtt_scale, ips=ips, probes=self._probes))
+        offset = self._fp.tell()
+        self._fp.write(header)
+        self._fp.write(_FOOTER.pack(offset, MAGIC))
+        size = self._fp.tell()
+        self._fp.close()
+        idx_fn = index_file(self.fn)
+        with open(idx_fn + '.tmp', 'wb') as fp:
+            fp.write(_IDX_HEADER.pack(IDX_MAGIC, size, _crc(header), *ips))
+            fp.write(np.array(sorted(self._index), dtype=_IDX_ENTRY).tostring())
+        # the index first: if interrupted in between, the new index does not match the CRC of the old chunk
+        os.rename(idx_fn + '.tmp', idx_fn)
+        os.rename(self._tmp, self.fn)
+
+
+def write_chunk(fn, by_probe, rtt_scale=DEFAULT_RTT_SCALE, compress=False):
+    """ write buffers grouped by probe to a chunk file
+
+    Args:
+        fn (string): path to the chunk file
+        by_probe (dict): probe id (int) to buffer, e.g. returned by atlas.stream_group_by_probe()
+        rtt_scale (int): see ChunkWriter
+        compress (bool): see ChunkWriter
+    """
+    with ChunkWriter(fn, rtt_scale=rtt_scale, compress=compress) as w:
+        for pb, buf in by_probe.items():
+            w.add(pb, buf)
+
+
+class ChunkReader:
+    """ ChunkReader gives access to the columns of each probe in a chunk file through a memory map,
+    or from memory if the file is read at once
+
+    Attributes:
+        fn (string): path to the chunk file
+        kind (string): ping, traceroute, connection; None if the chunk holds no probe
+        rtt_scale (int): see ChunkWriter
+        probes (list of int): probe ids in the order they are stored
+        ip_table (buffers.IpTable): hop IP addresses of traceroute chunks
+    """
+    def __init__(self, fn, only=None, preload=False):
+        """ map the file and read its header
+
+        Args:
+            fn (string): path to the chunk file
+            only (collection of int): if given, only these probes are made available; their directories are
+            then located with the index file, the header of the chunk is not read unless the index is missing or stale
+            preload (bool): read the entire file into memory instead of mapping it, so that no later access
+            waits on the disk, see prefetch.py
+        """
+        self.fn = fn
+        with open(fn, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < len(MAGIC) + _FOOTER.size:
+                raise ChunkError("%s is too short to be a chunk file" % fn)
+            if preload:
+                self._mm = fp.read()
+            else:
+                self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, magic = _FOOTER.unpack(self._mm[size - _FOOTER.size:])
+        if self._mm[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            self.close()
+            raise ChunkError("%s is not a chunk file" % fn)
+        if only is not None:
+            if self._read_index(size, buffer(self._mm, offset, size - _FOOTER.size - offset), only):
+                return
+        try:
+            header = json.loads(self._mm[offset:size - _FOOTER.size])
+        except ValueError:
+            self.close()
+            raise ChunkError("%s has a broken header" % fn)
+        self.kind = header['kind']
+        self.rtt_scale = header['rtt_scale']
+        self._columns = {pb: cols for pb, cols in header['probes'] if only is None or pb in only}
+        self.probes = [pb for pb, _ in header['probes'] if pb in self._columns]
+        self._read_ip_table(*header['ips'])
+
+    def _read_ip_table(self, offset, length, compressed, count):
+        ips = self._block(offset, length, compressed)
+        self.ip_table = IpTable(str(ips).split('\n') if count else [])
+
+    def _read_index(self, size, header, only):
+        """ locate the directories of the given probes with the index file
+
+        Args:
+            size (int): size of the chunk file
+            header (buffer): undecoded header of the chunk file, to check the index against
+            only (collection of int): probe ids
+
+        Returns:
+            bool: False if the index file is missing or does not match the chunk file
+        """
+        try:
+            with open(index_file(self.fn), 'rb') as fp:
+                idx = fp.read()
+        except IOError:
+            return False
+        if len(idx) < _IDX_HEADER.size:
+            return False
+        magic, chunk_size, crc, ip_off, ip_len, ip_z, ip_count = _IDX_HEADER.unpack_from(idx)
+        if magic != IDX_MAGIC or chunk_size != size or crc != _crc(header) or \
+                (len(idx) - _IDX_HEADER.size) % _IDX_ENTRY.itemsize:
+            logging.warning("%s does not match %s, header read instead." % (index_file(self.fn), self.fn))
+            return False
+        entries = np.frombuffer(idx, dtype=_IDX_ENTRY, offset=_IDX_HEADER.size)
+        self.kind = None
+        self.rtt_scale = None
+        self._columns = dict()
+        self.probes = []
+        for pb in only:
+            i = np.searchsorted(entries['pb'], pb)
+            if i < len(entries) and entries['pb'][i] == pb:
+                _, offset, length, dir_length = entries[i]
+                try:
+                    directory = json.loads(self._mm[offset + length - dir_length:offset + length])
+                    self.kind = directory['kind']
+                    self.rtt_scale = directory['rtt_scale']
+                    self._columns[pb] = directory['columns']
+                except (ValueError, KeyError, TypeError):
+                    logging.warning("%s has a broken entry for probe %d, header read instead." %
+                                    (index_file(self.fn), pb))
+                    return False
+                self.probes.append(pb)
+        self._read_ip_table(ip_off, ip_len, ip_z, ip_count)
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.probes)
+
+    def __contains__(self, pb):
+        return pb in self._columns
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+
+    def _block(self, offset, length, compressed):
+        if compressed:
+            return zlib.decompress(self._mm[offset:offset + length])
+        return buffer(self._mm, offset, length)
+
+    def count(self, pb):
+        """ number of measurements of a probe, known from its directory without reading any column
+
+        Returns:
+            int
+        """
+        return self._columns[pb][COLUMNS[self.kind][0][0]][3]
+
+    def column(self, pb, name):
+        """ raw stored column of a probe
+
+        Args:
+            pb (int): probe id
+            name (string): see COLUMNS
+
+        Returns:
+            numpy.array, read-only; RTT columns are still quantized, see rtt()
+        """
+        offset, length, compressed, count = self._columns[pb][name]
+        dtype = dict(COLUMNS[self.kind])[name]
+        dtype = ('<i4' if self.rtt_scale else '<f8') if dtype == 'rtt' else dtype
+        return np.frombuffer(self._block(offset, length, compressed), dtype=dtype, count=count)
+
+    def rtt(self, pb, name):
+        """ RTT column of a probe in msec
+
+        Returns:
+            numpy.array of float64, negative error codes, NaN for missing values
+        """
+        return decode_rtt(self.column(pb, name), self.rtt_scale)
+
+    def rtt_list(self, pb, name):
+        """ RTT column of a probe as list, the way parsers in atlas.py return RTTs
+
+        Returns:
+            list of float; error codes in int, None for missing values
+        """
+        return [None if v != v else (int(v) if v < 0 else v) for v in self.rtt(pb, name).tolist()]
+
+    def buffer(self, pb):
+        """ rebuild the buffer of a probe, e.g. for merging with newly fetched measurements
+
+        Returns:
+            buffers.PingBuffer, TraceBuffer or ConnectionBuffer; traceroute buffers share the ip_table of the reader
+        """
+        buf = BUFFER[self.kind]()
+        if self.kind == 'traceroute':
+            buf.ip_table = self.ip_table
+        for name, dtype in COLUMNS[self.kind]:
+            col = self.rtt(pb, name) if dtype == 'rtt' else self.column(pb, name)
+            setattr(buf, name, array(getattr(buf, name).typecode, col.tolist()))
+        return buf
+
+    def record(self, pb):
+        """ measurements of a probe in the format returned by atlas.group_by_probe()
+
+        Returns:
+            dict, see buffers.PingBuffer.to_dict(), TraceBuffer.to_dict() and ConnectionBuffer.to_dict()
+        """
+        return self.buffer(pb).to_dict()
+
+    def items(self):
+        """ iterate over probes and their measurements, see record()
+
+        Returns:
+            generator of (probe id, dict)
+        """
+        for pb in self.probes:
+            yield pb, self.record(pb)
+
+    def paris_id(self, pb):
+        """ Paris ID of each traceroute of a probe
+
+        Returns:
+            list of int, None if absent
+        """
+        return [None if i == NONE_INT else i for i in self.column(pb, 'paris_id').tolist()]
+
+    def paths(self, pb):
+        """ hop IP addresses of each traceroute of a probe
+
+        Returns:
+            list of (tuple of string or None)
+        """
+        off = self.column(pb, 'path_offset')
+        has_path = self.column(pb, 'has_path')
+        ips = self.ip_table.ips
+        hop_ip = self.column(pb, 'hop_ip').tolist()
+        return [tuple([ips[i] for i in hop_ip[off[k]:off[k+1]]]) if has_path[k] else None
+                for k in xrange(len(has_path))]
+
+
+def read_chunk(fn):
+    """ load an entire chunk file
+
+    Args:
+        fn (string): path to the chunk file
+
+    Returns:
+        dict: probe id (int) to measurements, same as atlas.group_by_probe()
+    """
+    with ChunkReader(fn) as r:
+        return dict(r.items())
+
+
+# chunk index files already read, path to (modification time, probe id to chunk id)
+_CHUNK_INDEX = dict()
+
+
+def _chunk_of(probe_id, index_fn):
+    """ chunk id of a probe according to a probe to chunk id indexing file, read once per process """
+    mtime = os.path.getmtime(index_fn)
+    if index_fn not in _CHUNK_INDEX or _CHUNK_INDEX[index_fn][0] != mtime:
+        _CHUNK_INDEX[index_fn] = (mtime, read_chunk_index(index_fn))
+    return _CHUNK_INDEX[index_fn][1].get(probe_id)
+
+
+def load_probe(probe_id, msm, data_dir='data/'):
+    """ load the measurements of one probe, without reading the other probes of its chunk
+
+    The chunk is found with pb_chunk_index_*.csv, then the probe with the index file of the chunk;
+    only the columns of the probe are decoded from the memory mapped chunk file.
+
+    Args:
+        probe_id (int)
+        msm (int): measurement id
+        data_dir (string): where chunk files and pb_chunk_index_*.csv are stored
+
+    Returns:
+        dict, measurements in the format returned by atlas.group_by_probe(); None if the probe is not found
+    """
+    for index_fn in sorted(glob.glob(os.path.join(data_dir, 'pb_chunk_index_*.csv'))):
+        chunk_id = _chunk_of(probe_id, index_fn)
+        if chunk_id is None:
+            continue
+        fn = chunk_file(data_dir, chunk_id, msm)
+        if not os.path.isfile(fn):
+            continue
+        with ChunkReader(fn, only=[probe_id]) as r:
+            if probe_id in r:
+                return r.record(probe_id)
+    return None
+
+
+def buffers_from_records(mes):
+    """ turn measurements grouped by probe back into buffers
+
+    Args:
+        mes (dict): probe id (int or string) to measurements, as returned by atlas.group_by_probe()
+        or loaded from a json chunk file
+
+    Returns:
+        dict: probe id (int) to buffer; traceroute buffers share one IpTable
+    """
+    by_probe = dict()
+    ip_table = IpTable()
+    for pb, rec in mes.items():
+        if 'min_rtt' in rec:
+            buf = BUFFER['ping']()
+            for t, m, a in zip(rec['epoch'], rec['min_rtt'], rec['all_rtt']):
+                buf.append(dict(epoch=t, min_rtt=m, all_rtt=a))
+        elif 'path' in rec:
+            buf = BUFFER['traceroute'](ip_table)
+            for t, p, h in zip(rec['epoch'], rec['paris_id'], rec['path']):
+                buf.append(dict(epoch=t, paris_id=p, path=h))
+        elif 'connect' in rec or 'disconnect' in rec:
+            buf = BUFFER['connection']()
+            for k in ('connect', 'disconnect'):
+                for t in rec.get(k, []):
+                    buf.append({k: t})
+        else:
+            logging.warning("Probe %s with empty measurement result, not converted." % pb)
+            continue
+        by_probe[int(pb)] = buf
+    return by_probe
@@ -2,36 +2,65 @@
 dbtools.py provides class definitions to handle CAIDA AS relationship inference and
 IXP related output from traIXroute database merge
 """
-import SubnetTree
+import snapshot as sn
+from misc import LruCache
+import numpy as np
+import calendar
+import binascii
 import logging
-import pyasn
+import bisect
+import socket
+import struct
+import time
+import gzip
+import os
+import re
 
+# sets attributes of immutable value objects
+_set = object.__setattr__
 
-class IXP:
+
+class IXP(object):
     """ IXP is a class that describes IXP
 
+    IXP is an immutable value object: equality and hash are those of the tuple of its attributes, the hash is
+    computed once.
+
     Attributes:
         short (string): short name for IXP
         long (string): long name for IXP
         country (string): country code, for US may contain state name
         city (string): name of the city
     """
+    __slots__ = ('short', 'long', 'country', 'city', '_key', '_hash')
 
     def __init__(self, short_name, long_name, country, city):
-        self.short = short_name
-        self.long = long_name
-        self.country = country
-        self.city = city
+        key = (short_name, long_name, country, city)
+        _set(self, 'short', short_name)
+        _set(self, 'long', long_name)
+        _set(self, 'country', country)
+        _set(self, 'city', city)
+        _set(self, '_key', key)
+        _set(self, '_hash', hash(key))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("IXP is immutable, %s can not be set" % name)
+
+    def __reduce__(self):
+        return IXP, self._key
 
     def __repr__(self):
         return "IXP(short=%r, long=%r, country=%r, city=%r)" % \
                (self.short, self.long, self.country, self.city)
 
     def __eq__(self, other):
-        return self.__repr__() == other.__repr__()
+        return self is other or (isinstance(other, IXP) and self._hash == other._hash and self._key == other._key)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(self.__repr__())
+        return self._hash
 
 
 class AsRelation:
@@ -87,30 +116,48 @@ class AddrType:
     Normal, InterCo, IxpPref, Virtual, Others = range(100, 105, 1)
 
 
-class Addr:
+class Addr(object):
     """Addr describes an IP address
 
+    Addr is immutable, as the same instance is shared by all the hops with the same IP address,
+    see pathtools.get_ip_info(). Equality and hash are those of the tuple of its attributes, the hash is
+    computed once.
+
     Attributes:
         addr (string): IP address in string, e.g. '129.250.66.33'
         type (AddrType): the type of IP address
         asn (int): AS that uses this interconnection IP address
         ixp (IXP): the IXP that attributes the IP address
     """
+    __slots__ = ('addr', 'type', 'asn', 'ixp', 'desc', '_key', '_hash')
+
     def __init__(self, addr, addr_type=None, asn=None, ixp=None, desc=None):
-        self.addr = addr
-        self.type = addr_type
-        self.asn = asn
-        self.ixp = ixp
-        self.desc = desc
+        key = (addr, addr_type, asn, ixp, desc)
+        _set(self, 'addr', addr)
+        _set(self, 'type', addr_type)
+        _set(self, 'asn', asn)
+        _set(self, 'ixp', ixp)
+        _set(self, 'desc', desc)
+        _set(self, '_key', key)
+        _set(self, '_hash', hash(key))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Addr is immutable, %s can not be set" % name)
+
+    def __reduce__(self):
+        return Addr, self._key
 
     def __repr__(self):
         return "Addr(addr=%r, type=%r, asn=%r, ixp=%r, desc=%r)" % (self.addr, self.type, self.asn, self.ixp, self.desc)
 
     def __eq__(self, other):
-        return self.__repr__() == other.__repr__()
+        return self is other or (isinstance(other, Addr) and self._hash == other._hash and self._key == other._key)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(self.__repr__())
+        return self._hash
 
     def get_asn(self):
         """get the ASN or other info according to the address type
@@ -132,43 +179,358 @@ class Addr:
             return self.desc
 
 
+# value of prefix tables for addresses covered by no prefix
+NO_VALUE = -1
+# value of the ranges of a later version of a prefix table left to its base, see _delta()
+KEEP = -2
+# file names of the versions of CAIDA AS relationship inference and of pyasn IP to ASN databases, see find_versions()
+AS_REL_PATTERN = r'^(?P<date>\d{8})\.as-rel2?\.txt$'
+IPASN_PATTERN = r'^ipasn(?:[._](?P<date>\d{8}))?\.dat(?:\.gz)?$'
+# number of versions of a database kept loaded by VersionedDB, apart from the base
+DEFAULT_VERSIONS = 4
+# offset of IPv4 addresses mapped in IPv6 address space, ::ffff:0:0/96
+V4_MAPPED = 0xffff << 32
+
+
+def _parse_prefix(pref):
+    """ parse an IP prefix
+
+    Args:
+        pref (string): e.g. '193.0.20.0/23'
+
+    Returns:
+        (int, int, int): IP version, first and last address of the prefix in int
+
+    Raises:
+        ValueError: if the prefix is invalid
+    """
+    try:
+        addr, length = pref.split('/')
+        version, bits = (6, 128) if ':' in addr else (4, 32)
+        n = int(binascii.hexlify(socket.inet_pton(socket.AF_INET6 if version == 6 else socket.AF_INET, addr)), 16)
+        host = (1 << (bits - int(length))) - 1
+    except (socket.error, ValueError, TypeError):
+        raise ValueError("invalid prefix %r" % pref)
+    if host < 0:
+        raise ValueError("invalid prefix %r" % pref)
+    return version, n & ~host, n | host
+
+
+def _pack_addr(addr, mapped=False):
+    """ turn an IP address into a key of prefix tables
+
+    Args:
+        addr (string): IP address
+        mapped (bool): IPv4 addresses are mapped in IPv6 address space, as SubnetTree does
+
+    Returns:
+        (int, int or string): IP version, address as int for IPv4 or 16-byte string for IPv6 and mapped IPv4;
+        (None, None) if invalid
+    """
+    try:
+        if ':' in addr:
+            return 6, socket.inet_pton(socket.AF_INET6, addr)
+        packed = socket.inet_pton(socket.AF_INET, addr)
+    except (socket.error, TypeError, ValueError):
+        return None, None
+    if mapped:
+        return 6, '\x00' * 10 + '\xff\xff' + packed
+    return 4, struct.unpack('>I', packed)[0]
+
+
+def _flatten(prefixes, max_addr):
+    """ turn nested prefixes into consecutive address ranges, each taking the value of the longest prefix covering it
+
+    Args:
+        prefixes (list of (int, int, int)): first address, last address and value of each prefix;
+        of identical prefixes the last one is kept
+        max_addr (int): the largest address of the address space
+
+    Returns:
+        (list of int, list of int): first address of each range and its value, NO_VALUE if not covered by any prefix
+    """
+    bounds = []
+
+    def mark(start, value):
+        if start > max_addr:
+            return
+        if bounds and bounds[-1][0] == start:
+            bounds[-1] = (start, value)
+        else:
+            bounds.append((start, value))
+
+    stack = []  # (last address, value) of the prefixes covering the current address
+    for first, last, value in sorted(prefixes, key=lambda p: (p[0], -p[1])):
+        while stack and stack[-1][0] < first:
+            end, _ = stack.pop()
+            mark(end + 1, stack[-1][1] if stack else NO_VALUE)
+        mark(first, value)
+        stack.append((last, value))
+    while stack:
+        end, _ = stack.pop()
+        mark(end + 1, stack[-1][1] if stack else NO_VALUE)
+    starts, values = [], []
+    for start, value in bounds:
+        if not values or values[-1] != value:  # merge adjacent ranges of same value
+            starts.append(start)
+            values.append(value)
+    return starts, values
+
+
+def _v6_keys(starts):
+    """ IPv6 addresses in int to sortable 16-byte strings """
+    return np.array([binascii.unhexlify('%032x' % i) for i in starts], dtype='S16')
+
+
+def _prefix_table(prefixes, version):
+    """ compile prefixes into two arrays, see _flatten() and _lookup() """
+    if version == 4:
+        starts, values = _flatten(prefixes, (1 << 32) - 1)
+        return np.array(starts, dtype='<u4'), np.array(values, dtype='<i8')
+    starts, values = _flatten(prefixes, (1 << 128) - 1)
+    return _v6_keys(starts), np.array(values, dtype='<i8')
+
+
+def _lookup(starts, values, key):
+    """ value of the range containing key in a prefix table, None if not covered """
+    i = starts.searchsorted(key, 'right') - 1
+    if i < 0:
+        return None
+    v = values[i]
+    return None if v == NO_VALUE else int(v)
+
+
+def _lookup_many(starts, values, keys):
+    """ values of the ranges containing each key in a prefix table, NO_VALUE if not covered """
+    if not len(starts):
+        return np.full(len(keys), NO_VALUE, dtype=np.int64)
+    i = starts.searchsorted(keys, 'right') - 1
+    return np.where(i >= 0, values[np.maximum(i, 0)], NO_VALUE)
+
+
+def _delta(starts, values, base_starts, base_values):
+    """ the ranges of a prefix table whose value differs from that of a base table
+
+    Args:
+        starts (numpy.array), values (numpy.array): prefix table, see _prefix_table()
+        base_starts (numpy.array), base_values (numpy.array): the base prefix table
+
+    Returns:
+        (numpy.array, numpy.array): prefix table with value KEEP in the ranges where it equals the base
+    """
+    bounds = np.union1d(starts, base_starts)
+    new = _lookup_many(starts, values, bounds)
+    delta = np.where(new != _lookup_many(base_starts, base_values, bounds), new, KEEP)
+    change = np.ones(len(delta), dtype=bool)
+    change[1:] = delta[1:] != delta[:-1]  # merge adjacent ranges of same value
+    return bounds[change], delta[change]
+
+
+def _relations_of(keys, relations, queries, found=False):
+    """ relationship of each queried asn pair key in sorted keys, NO_RELATION if absent; see AsRelationDB
+
+    Returns:
+        numpy.array of int8, and numpy.array of bool telling whether each key is present if found is True
+    """
+    res = np.full(len(queries), AsRelationDB.NO_RELATION, dtype='i1')
+    present = np.zeros(len(queries), dtype=bool)
+    if len(keys) and len(queries):
+        idx = np.minimum(keys.searchsorted(queries), len(keys) - 1)
+        present = keys[idx] == queries
+        res[present] = relations[idx[present]]
+    return (res, present) if found else res
+
+
+def split_addrs(addrs):
+    """ turn IP addresses in string into integers, see pack_v4() and pack_v6()
+
+    Args:
+        addrs (list of string): IP addresses
+
+    Returns:
+        (numpy.array, numpy.array, numpy.array, numpy.array, numpy.array): position in addrs of IPv4 addresses,
+        IPv4 addresses as uint32, position in addrs of IPv6 addresses, high and low 64 bits of IPv6 addresses
+        as uint64; invalid addresses are in neither
+    """
+    idx4, v4, idx6, v6 = [], [], [], []
+    for i, addr in enumerate(addrs):
+        version, key = _pack_addr(addr)
+        if version == 4:
+            idx4.append(i)
+            v4.append(key)
+        elif version == 6:
+            idx6.append(i)
+            v6.append(struct.unpack('>QQ', key))
+    v6 = np.array(v6, dtype=np.uint64).reshape((len(v6), 2))
+    return (np.array(idx4, dtype=np.int64), np.array(v4, dtype=np.uint32),
+            np.array(idx6, dtype=np.int64), v6[:, 0], v6[:, 1])
+
+
+def pack_v4(addrs):
+    """ IPv4 addresses in uint32 to the 16-byte keys of prefix tables, mapped in IPv6 address space
+
+    Args:
+        addrs (numpy.array of uint32)
+
+    Returns:
+        numpy.array of 16-byte strings
+    """
+    keys = np.zeros(len(addrs), dtype=[('zero', 'V10'), ('ffff', '>u2'), ('addr', '>u4')])
+    keys['ffff'] = 0xffff
+    keys['addr'] = addrs
+    return keys.view('S16')
+
+
+def pack_v6(hi, lo):
+    """ IPv6 addresses given as two uint64 halves to the 16-byte keys of prefix tables
+
+    Args:
+        hi (numpy.array of uint64): the high 64 bits of each address
+        lo (numpy.array of uint64): the low 64 bits
+
+    Returns:
+        numpy.array of 16-byte strings
+    """
+    keys = np.zeros(len(hi), dtype=[('hi', '>u8'), ('lo', '>u8')])
+    keys['hi'] = hi
+    keys['lo'] = lo
+    return keys.view('S16')
+
+
+def _strings(seq):
+    """ list of strings to a numpy array of fixed size strings """
+    return np.array(seq, dtype='S%d' % max([1] + [len(i) for i in seq]))
+
+
+def _ixp_arrays(ixps):
+    """ IXP objects to arrays of their fields, in order to be stored in a snapshot """
+    return dict(ixp_short=_strings([i.short for i in ixps]), ixp_long=_strings([i.long for i in ixps]),
+                ixp_country=_strings([i.country for i in ixps]), ixp_city=_strings([i.city for i in ixps]))
+
+
+def _ixps_from_arrays(arrays):
+    """ IXP objects from their fields stored in a snapshot """
+    return [IXP(short_name=s, long_name=l, country=c, city=t) for s, l, c, t in
+            zip(arrays['ixp_short'].tolist(), arrays['ixp_long'].tolist(),
+                arrays['ixp_country'].tolist(), arrays['ixp_city'].tolist())]
+
+
+def _is_asn(asn):
+    """ whether asn is an int that fits in the 32 bits given to ASNs in array keys """
+    return isinstance(asn, (int, long, np.integer)) and 0 <= asn < 1 << 32
+
+
 class AsnDB:
     """AsnDB provides facility to query the ASN of a given IP address
 
+    Prefixes are compiled into a snapshot next to the main file, see snapshot.py, and looked up by binary search
+    in the mapped ranges.
+    A later version of the database can be built on top of an earlier one, its base: the snapshot then only keeps
+    the address ranges whose ASN changed, the others are looked up in the base, see VersionedAsnDB.
+
     Attributes:
-        _main (pyasn): stores the IP to ASN mapping parsed by pyasn from routeview BGP feeds
+        _main (dict): IP version to (first address of each range, ASN or NO_VALUE) arrays, for the prefix
+        to ASN mapping of routeview BGP feeds converted by pyasn:
             pyasn_util_download.py --latest
             pyasn_util_convert.py --single <Downloaded RIB File> <ipasn_db_file_name>
-        _reserved (SubnetTree or None): stores the reserved IP blocks
+        ASN is KEEP in the ranges left to the base
+        _base (AsnDB or None): the earlier version this one is built on
+        _reserved (tuple or None): (first address of each range, index in reserved_des list or NO_VALUE) arrays
+        for the reserved IP blocks, IPv4 being mapped in IPv6 address space
+        reserved_list (list of string): description of the reserved IP blocks, indexed by the codes of lookup_v4_many()
+        and lookup_v6_many(); None if no reserved IP blocks are loaded
         reserved_des (set or None): the set of reserved IP blocks description
     """
-    def __init__(self, main, reserved=None):
+    def __init__(self, main, reserved=None, base=None):
         """load from file
 
         Args:
             main (string): path to the conversion out put of pyasn
-            reserved (string): path to file recording reserved IP blocks
+            reserved (string): path to file recording reserved IP blocks; ignored if base is given
+            base (AsnDB): an earlier version of the database, loaded without base; its reserved IP blocks are used
         """
+        self._base = base
+        self.source = main
+        if base is not None:
+            arrays = sn.load(main + sn.EXT, 'asn-delta/1', [main, base.source], lambda: self._compile_delta(main))
+            self._main = {4: (arrays['v4_start'], arrays['v4_asn']), 6: (arrays['v6_start'], arrays['v6_asn'])}
+            self._reserved = base._reserved
+            self.reserved_list = base.reserved_list
+            self.reserved_des = base.reserved_des
+            return
+        sources = [main] if reserved is None else [main, reserved]
+        arrays = sn.load(main + sn.EXT, 'asn/1', sources, lambda: self._compile(main, reserved))
+        self._main = {4: (arrays['v4_start'], arrays['v4_asn']), 6: (arrays['v6_start'], arrays['v6_asn'])}
+        if reserved is not None:
+            self._reserved = (arrays['reserved_start'], arrays['reserved_des'])
+            self.reserved_list = arrays['reserved_list'].tolist()
+            self.reserved_des = set(self.reserved_list)
+        else:
+            self._reserved = None
+            self.reserved_list = None
+            self.reserved_des = None
+
+    @staticmethod
+    def _compile(main, reserved):
+        complete = True
+        prefixes = {4: [], 6: []}
         try:
-            self._main = pyasn.pyasn(main)
-        except (IOError, RuntimeError) as e:
+            with (gzip.open(main, 'rb') if main.endswith('.gz') else open(main, 'r')) as fp:
+                for line in fp:
+                    if not line.startswith(';') and len(line.split()) >= 2:
+                        pref, asn = line.split()[:2]
+                        try:
+                            version, first, last = _parse_prefix(pref)
+                            prefixes[version].append((first, last, int(asn)))
+                        except ValueError as e:
+                            logging.warning("Line ignored in %s: %s" % (main, e))
+        except IOError as e:
             logging.critical("Encountered error when initializing IP to ASN DB: %s" % e)
+            complete = False
+        arrays = dict()
+        for version in (4, 6):
+            arrays['v%d_start' % version], arrays['v%d_asn' % version] = _prefix_table(prefixes[version], version)
 
+        des = []
+        blocks = []
         if reserved is not None:
-            self._reserved = SubnetTree.SubnetTree()
-            self.reserved_des = set()
             try:
                 with open(reserved, 'r') as fp:
                     for line in fp:
                         if not line.startswith('#') and len(line.split()) >= 2:
                             pref, desc = [i.strip() for i in line.split()]
-                            self._reserved.insert(pref, desc)
-                            self.reserved_des.add(desc)
-            except IOError as e:
+                            version, first, last = _parse_prefix(pref)
+                            if version == 4:
+                                first, last = first + V4_MAPPED, last + V4_MAPPED
+                            if desc not in des:
+                                des.append(desc)
+                            blocks.append((first, last, des.index(desc)))
+            except (IOError, ValueError) as e:
                 logging.critical("Encountered error when initializing IP to ASN DB: %s" % e)
-        else:
-            self._reserved = None
-            self.reserved_des = None
+                complete = False
+        arrays['reserved_start'], arrays['reserved_des'] = _prefix_table(blocks, 6)
+        arrays['reserved_list'] = _strings(des)
+        return arrays, complete
+
+    def _compile_delta(self, main):
+        arrays, complete = self._compile(main, None)
+        for version in (4, 6):
+            start, asn = 'v%d_start' % version, 'v%d_asn' % version
+            arrays[start], arrays[asn] = _delta(arrays[start], arrays[asn], *self._base._main[version])
+        return arrays, complete
+
+    def _asn(self, version, key):
+        """ ASN of an address given as key of the version's prefix table, None if not found """
+        asn = _lookup(self._main[version][0], self._main[version][1], key)
+        return self._base._asn(version, key) if asn == KEEP else asn
+
+    def _asn_many(self, version, keys):
+        asn = _lookup_many(self._main[version][0], self._main[version][1], keys)
+        if self._base is not None:
+            keep = asn == KEEP
+            if keep.any():
+                asn[keep] = self._base._asn_many(version, keys[keep])
+        return asn
 
     def lookup(self, addr):
         """look up the ASN or description of given IP address
@@ -177,23 +539,62 @@ class AsnDB:
             addr (string): IP address, e.g. e.g. '129.250.66.33'
 
         Return:
-            string if reserved or invalid IP address, int if an ASN is retrieved
+            string if reserved or invalid IP address, int if an ASN is retrieved, None if not found
         """
-        try:
-            return self._reserved[addr]
-        except (TypeError, KeyError):
-            try:
-                return self._main.lookup(addr)[0]
-            except ValueError:
-                return 'Invalid IP address'
+        if self._reserved is not None:
+            _, key = _pack_addr(addr, mapped=True)
+            if key is not None:
+                des = _lookup(self._reserved[0], self._reserved[1], key)
+                if des is not None:
+                    return self.reserved_list[des]
+        version, key = _pack_addr(addr)
+        if key is None:
+            return 'Invalid IP address'
+        return self._asn(version, key)
+
+    def lookup_v4_many(self, addrs):
+        """look up many IPv4 addresses at once, see lookup()
+
+        Args:
+            addrs (numpy.array of uint32): IPv4 addresses, e.g. 2180661793 for '129.250.66.33'
+
+        Returns:
+            (numpy.array of int64, numpy.array of int64): ASN of each address, NO_VALUE if not found;
+            index in reserved_list of the reserved block containing each address, NO_VALUE if none,
+            a reserved block takes precedence over the ASN as in lookup()
+        """
+        addrs = np.asarray(addrs, dtype=np.uint32)
+        return self._asn_many(4, addrs), self._lookup_reserved(pack_v4(addrs))
+
+    def lookup_v6_many(self, hi, lo):
+        """look up many IPv6 addresses at once, see lookup_v4_many()
+
+        Args:
+            hi (numpy.array of uint64): the high 64 bits of each IPv6 address
+            lo (numpy.array of uint64): the low 64 bits
+
+        Returns:
+            (numpy.array of int64, numpy.array of int64): see lookup_v4_many()
+        """
+        keys = pack_v6(np.asarray(hi, dtype=np.uint64), np.asarray(lo, dtype=np.uint64))
+        return self._asn_many(6, keys), self._lookup_reserved(keys)
+
+    def _lookup_reserved(self, keys):
+        if self._reserved is None:
+            return np.full(len(keys), NO_VALUE, dtype=np.int64)
+        return _lookup_many(self._reserved[0], self._reserved[1], keys)
 
 
 class IxpPrefixDB:
     """
     IxpPerfixDB provides searching facilities for IP prefixes belonging to IXPs
 
+    Prefixes are compiled into a snapshot next to the source file, see snapshot.py.
+
     Attributes:
-        _pt (SubnetTree): prefix as key, IXP instance as value
+        _starts (numpy.array): first address of each range, IPv4 being mapped in IPv6 address space
+        _values (numpy.array): index in _ixps of the IXP holding each range, NO_VALUE if none
+        _ixps (list of IXP): the IXPs
     """
     def __init__(self, fn):
         """Initializes from traIXroute database merge output ixp_prefixes.txt
@@ -201,7 +602,17 @@ class IxpPrefixDB:
         Args:
             fn (string): path to the traIXroute db merge output ixp_prefixes.txt
         """
-        self._pt = SubnetTree.SubnetTree()
+        arrays = sn.load(fn + sn.EXT, 'ixp-prefix/1', [fn], lambda: self._compile(fn))
+        self._starts = arrays['start']
+        self._values = arrays['ixp']
+        self._ixps = _ixps_from_arrays(arrays)
+
+    @staticmethod
+    def _compile(fn):
+        complete = True
+        ixps = []
+        index = dict()
+        prefixes = []
         try:
             with open(fn, 'r') as fp:
                 for line in fp:
@@ -209,10 +620,24 @@ class IxpPrefixDB:
                     if len(line.split(',')) == 7:
                         _, flag, pref, short_name, long_name, country, city = [i.strip() for i in line.split(',')]
                         if flag == '!':
-                            self._pt.insert(pref,
-                                            IXP(short_name=short_name, long_name=long_name, country=country, city=city))
+                            ixp = IXP(short_name=short_name, long_name=long_name, country=country, city=city)
+                            if ixp not in index:
+                                index[ixp] = len(ixps)
+                                ixps.append(ixp)
+                            try:
+                                version, first, last = _parse_prefix(pref)
+                            except ValueError as e:
+                                logging.warning("Line ignored in %s: %s" % (fn, e))
+                                continue
+                            if version == 4:
+                                first, last = first + V4_MAPPED, last + V4_MAPPED
+                            prefixes.append((first, last, index[ixp]))
         except IOError as e:
             logging.critical("Encountered error when initializing IXP prefix DB: %s" % e)
+            complete = False
+        arrays = _ixp_arrays(ixps)
+        arrays['start'], arrays['ixp'] = _prefix_table(prefixes, 6)
+        return arrays, complete
 
     def lookup(self, addr):
         """Lookup a given IP address if it belongs to an IXP
@@ -223,25 +648,61 @@ class IxpPrefixDB:
         Returns:
             IXP or None if no IXP contains the queried IP address
         """
-        try:
-            return self._pt[addr]
-        except KeyError:
+        _, key = _pack_addr(addr, mapped=True)
+        if key is None:
             return None
+        idx = _lookup(self._starts, self._values, key)
+        return None if idx is None else self._ixps[idx]
+
+    def lookup_many(self, keys):
+        """Lookup many IP addresses at once, see lookup()
+
+        Args:
+            keys (numpy.array of 16-byte strings): IP addresses, see pack_v4() and pack_v6()
+
+        Returns:
+            list of IXP or None
+        """
+        idx = _lookup_many(self._starts, self._values, keys).tolist()
+        return [None if i == NO_VALUE else self._ixps[i] for i in idx]
 
 
 class AsRelationDB:
     """AsRelationDB provides searching facilities for CAIDA AS relationship inference
 
+    Relations are compiled into a snapshot next to the source file, see snapshot.py.
+    A later version of the database can be built on top of an earlier one, its base: the snapshot then only keeps
+    the pairs whose relationship changed, the others are looked up in the base, see VersionedAsRelationDB.
+
     Attributes:
-        _relation (dict): asn pair tuple to int, i.e. relationships defined in AsRelation class
+        _keys (numpy.array of uint64): asn pair (left << 32 | right), sorted
+        _relation (numpy.array of int8): relationship of each pair, i.e. defined in AsRelation class;
+        NO_RELATION if None
+        _base (AsRelationDB or None): the earlier version this one is built on
     """
-    def __init__(self, fn):
+    NO_RELATION = -128
+
+    def __init__(self, fn, base=None):
         """Initializes from the CAIDA AS relationship inference *.as-rel2.txt
 
         Args:
             fn (string): path to CAIDA AS relationship inference file
+            base (AsRelationDB): an earlier version of the database, loaded without base
         """
-        self._relation = dict()
+        self._base = base
+        self.source = fn
+        if base is None:
+            arrays = sn.load(fn + sn.EXT, 'as-rel/1', [fn], lambda: self._compile(fn))
+        else:
+            arrays = sn.load(fn + sn.EXT, 'as-rel-delta/1', [fn, base.source], lambda: self._compile_delta(fn))
+        self._keys = arrays['keys']
+        self._relation = arrays['relation']
+
+    @staticmethod
+    def _compile(fn):
+        complete = True
+        keys = []
+        relations = []
         try:
             with open(fn, 'r') as fp:
                 for line in fp:
@@ -251,10 +712,36 @@ class AsRelationDB:
                         left_as = int(rel[0])
                         right_as = int(rel[1])
                         relation = AsRelation.encode(int(rel[2]))
-                        self._relation.update({(left_as, right_as): relation,
-                                               (right_as, left_as): AsRelation.flip(relation)})
+                        flipped = AsRelation.flip(relation)
+                        keys.extend([left_as << 32 | right_as, right_as << 32 | left_as])
+                        relations.extend([AsRelationDB.NO_RELATION if relation is None else relation,
+                                          AsRelationDB.NO_RELATION if flipped is None else flipped])
         except (IOError, TypeError) as e:
             logging.critical("Encountered error when initializing AS relationship DB: %s" % e)
+            complete = False
+        keys = np.array(keys, dtype='<u8')
+        relations = np.array(relations, dtype='i1')
+        # keep the last relationship given to a pair
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        relations = relations[order]
+        last = np.append(keys[1:] != keys[:-1], True) if len(keys) else np.zeros(0, dtype=bool)
+        return dict(keys=keys[last], relation=relations[last]), complete
+
+    def _compile_delta(self, fn):
+        arrays, complete = self._compile(fn)
+        # pairs of either version whose relationship changed, a pair gone being NO_RELATION
+        keys = np.union1d(arrays['keys'], self._base._keys)
+        relations = _relations_of(arrays['keys'], arrays['relation'], keys)
+        change = relations != self._base._relations(keys)
+        return dict(keys=keys[change], relation=relations[change]), complete
+
+    def _relations(self, keys):
+        """ relationship of each asn pair key, NO_RELATION if None """
+        res, found = _relations_of(self._keys, self._relation, keys, found=True)
+        if self._base is not None and not found.all():
+            res[~found] = self._base._relations(keys[~found])
+        return res
 
     def has_relation(self, tup):
         """Check if the two AS in the input tuple have certain relationship
@@ -266,18 +753,59 @@ class AsRelationDB:
             one of the relationships defined in AsRelation or None
         """
         try:
-            return self._relation[tup]
-        except KeyError:
+            left_as, right_as = tup
+        except (TypeError, ValueError):
+            return None
+        if not (_is_asn(left_as) and _is_asn(right_as)):
             return None
+        key = np.uint64(int(left_as) << 32 | int(right_as))
+        i = self._keys.searchsorted(key)
+        if i < len(self._keys) and self._keys[i] == key:
+            relation = int(self._relation[i])
+            return None if relation == self.NO_RELATION else relation
+        return None if self._base is None else self._base.has_relation(tup)
+
+    def has_relation_many(self, pairs):
+        """Check the relationship of many AS pairs at once, see has_relation()
+
+        Args:
+            pairs (list of tuple or numpy.array of shape (n, 2)): pairs of ASN in int
+
+        Returns:
+            numpy.array of int8: one of the relationships defined in AsRelation for each pair, NO_RELATION if None
+        """
+        res = np.full(len(pairs), self.NO_RELATION, dtype='i1')
+        if not len(pairs):
+            return res
+        arr = np.asarray(pairs)
+        if arr.ndim != 2 or arr.shape[1] != 2 or arr.dtype.kind not in 'iu':
+            # pairs with None or else, checked one by one
+            for i, tup in enumerate(pairs):
+                relation = self.has_relation(tuple(tup))
+                if relation is not None:
+                    res[i] = relation
+            return res
+        left_as = arr[:, 0].astype(np.int64)
+        right_as = arr[:, 1].astype(np.int64)
+        valid = (left_as >= 0) & (left_as < 1 << 32) & (right_as >= 0) & (right_as < 1 << 32)
+        keys = left_as[valid].astype(np.uint64) << np.uint64(32) | right_as[valid].astype(np.uint64)
+        res[valid] = self._relations(keys)
+        return res
 
 
 class IxpMemberDB:
     """IxpMemberDB provides search facilities for IXP interconnection IP addresses and IXP membership
 
+    The membership is compiled into a snapshot next to the source file, see snapshot.py.
+    Each IXP is given a dense integer id, its index in _ixps; the IXPs an AS is present at are a bitset over these ids.
+
     Attributes:
-        _interco (dict): IP address to InterCo object mapping
-        _membership (dict): IXP to member ASN (int) set mapping
-        _presence (dict): ASN (int) to IXPs that it is present
+        _interco (tuple): sorted interconnection IP addresses, packed as 16 bytes with IPv4 mapped in IPv6 address
+        space, ASN and IXP id for each of them
+        _asn (numpy.array of int64): ASNs present at at least one IXP, sorted
+        _bits (numpy.array of uint64): one row of bits per ASN in _asn, bit i set if the AS is a member of IXP i
+        _ixps (list of IXP): the IXPs
+        _ixp_index (dict): IXP to its id
     """
     def __init__(self, fn):
         """Initializes from traIXroute database merge output ixp_membership.txt
@@ -285,9 +813,20 @@ class IxpMemberDB:
         Args:
             fn (string): path to traIXroute database merge output ixp_membership.txt
         """
-        self._interco = dict()
-        self._membership = dict()
-        self._presence = dict()
+        arrays = sn.load(fn + sn.EXT, 'ixp-member/2', [fn], lambda: self._compile(fn))
+        self._interco = (arrays['interco_key'], arrays['interco_asn'], arrays['interco_ixp'])
+        self._asn = arrays['asn']
+        self._bits = arrays['bits']
+        self._ixps = _ixps_from_arrays(arrays)
+        self._ixp_index = {ixp: i for i, ixp in enumerate(self._ixps)}
+
+    @staticmethod
+    def _compile(fn):
+        complete = True
+        ixps = []
+        index = dict()
+        interco = dict()
+        presence = dict()
         try:
             with open(fn, 'r') as fp:
                 for line in fp:
@@ -297,20 +836,32 @@ class IxpMemberDB:
                         if flag == '!':
                             ixp = IXP(short_name=short_name, long_name=long_name, country=country, city=city)
                             asn = int(asn[2:])
-                            # update IXP membership
-                            if ixp in self._membership:
-                                self._membership[ixp].add(asn)
-                            else:
-                                self._membership[ixp] = set([asn])
-                            # update AS presences at IXPs
-                            if asn in self._presence:
-                                self._presence[asn].add(ixp)
+                            if ixp not in index:
+                                index[ixp] = len(ixps)
+                                ixps.append(ixp)
+                            # IXP membership and AS presences at IXPs
+                            presence.setdefault(asn, set()).add(index[ixp])
+                            # interconnection ip
+                            _, key = _pack_addr(addr, mapped=True)
+                            if key is None:
+                                logging.warning("Line ignored in %s: invalid IP address %r" % (fn, addr))
                             else:
-                                self._presence[asn] = set([ixp])
-                            # update interconnection ip
-                            self._interco.update({addr: Addr(addr=addr, addr_type=AddrType.InterCo, asn=asn, ixp=ixp)})
+                                interco[key] = (asn, index[ixp])
         except (IOError, ValueError) as e:
             logging.critical("Encountered error when initializing IXP membership DB: %s" % e)
+            complete = False
+        arrays = _ixp_arrays(ixps)
+        keys = sorted(interco)
+        arrays['interco_key'] = np.array(keys, dtype='S16')
+        arrays['interco_asn'] = np.array([interco[i][0] for i in keys], dtype='<i8')
+        arrays['interco_ixp'] = np.array([interco[i][1] for i in keys], dtype='<i4')
+        asns = sorted(presence)
+        arrays['asn'] = np.array(asns, dtype='<i8')
+        arrays['bits'] = np.zeros((len(asns), max(1, -(-len(ixps) // 64))), dtype='<u8')
+        for row, asn in enumerate(asns):
+            for i in presence[asn]:
+                arrays['bits'][row, i // 64] |= np.uint64(1 << (i % 64))
+        return arrays, complete
 
     def lookup_interco(self, addr):
         """Lookup IXP interconnection IP address
@@ -321,10 +872,41 @@ class IxpMemberDB:
         Returns:
             InterCo if queried IP address is an IXP interconnection IP otherwise None
         """
-        try:
-            return self._interco[addr]
-        except KeyError:
+        keys, asns, ixps = self._interco
+        _, key = _pack_addr(addr, mapped=True)
+        if key is None:
             return None
+        i = keys.searchsorted(key)
+        if i < len(keys) and keys[i] == key:
+            return Addr(addr=addr, addr_type=AddrType.InterCo, asn=int(asns[i]), ixp=self._ixps[ixps[i]])
+        return None
+
+    def lookup_interco_many(self, keys):
+        """Lookup many IXP interconnection IP addresses at once, see lookup_interco()
+
+        Args:
+            keys (numpy.array of 16-byte strings): IP addresses, see pack_v4() and pack_v6()
+
+        Returns:
+            list of (int, IXP) or None: ASN using the interconnection IP and its IXP, None if not an interconnection IP
+        """
+        addrs, asns, ixps = self._interco
+        if not len(addrs):
+            return [None] * len(keys)
+        idx = np.minimum(addrs.searchsorted(keys), len(addrs) - 1)
+        found = (addrs[idx] == keys).tolist()
+        return [(int(asns[i]), self._ixps[ixps[i]]) if f else None for i, f in zip(idx.tolist(), found)]
+
+    def _rows(self, asns):
+        """ row in _bits of each ASN, -1 if the AS is not present at any IXP """
+        rows = np.full(len(asns), -1, dtype=np.int64)
+        valid = np.array([_is_asn(i) for i in asns], dtype=bool)
+        if not len(self._asn) or not valid.any():
+            return rows
+        keys = np.array([int(i) for i, v in zip(asns, valid) if v], dtype=np.int64)
+        idx = np.minimum(self._asn.searchsorted(keys), len(self._asn) - 1)
+        rows[valid] = np.where(self._asn[idx] == keys, idx, -1)
+        return rows
 
     def common_ixp(self, as_list):
         """Find out the IXPs that ASNs in given list are all present at
@@ -335,7 +917,13 @@ class IxpMemberDB:
         Return:
             set of IXP or empty set
         """
-        return set.intersection(*[self._presence.get(i, set()) for i in as_list])
+        if not len(as_list):
+            raise TypeError("common_ixp() needs at least one ASN")
+        rows = self._rows(as_list)
+        if (rows < 0).any():
+            return set()
+        bits = np.bitwise_and.reduce(self._bits[rows], axis=0).tolist()
+        return set([self._ixps[w * 64 + b] for w, word in enumerate(bits) if word for b in xrange(64) if word >> b & 1])
 
     def is_member(self, ixp, asn):
         """Check if given ASN is a member of the given IXP:
@@ -347,7 +935,149 @@ class IxpMemberDB:
         Returns:
             boolean
         """
-        try:
-            return asn in self._membership[ixp]
-        except KeyError:
-            return False
\ No newline at end of file
+        return bool(self.is_member_many([(ixp, asn)])[0])
+
+    def is_member_many(self, pairs):
+        """Check the IXP membership of many ASes at once, see is_member()
+
+        Args:
+            pairs (list of (IXP, int)): IXP and ASN pairs
+
+        Returns:
+            numpy.array of bool
+        """
+        ids = np.array([self._ixp_index.get(ixp, -1) for ixp, _ in pairs], dtype=np.int64)
+        rows = self._rows([asn for _, asn in pairs])
+        res = (ids >= 0) & (rows >= 0)
+        if res.any():
+            words = self._bits[rows[res], ids[res] // 64]
+            res[res] = words >> (ids[res] % 64).astype(np.uint64) & np.uint64(1) > 0
+        return res
+
+
+def find_versions(db_dir, pattern):
+    """ find the versions of a database in a directory, dated by their file name
+
+    Args:
+        db_dir (string): directory holding the database files
+        pattern (string): regular expression matched against file names, with an optional group 'date' as YYYYMMDD;
+        a file without date is valid from the beginning, e.g. AS_REL_PATTERN or IPASN_PATTERN
+
+    Returns:
+        list of (int, string): sec since epoch from which each version is valid, path to the file; sorted by time
+    """
+    versions = []
+    try:
+        names = os.listdir(db_dir)
+    except OSError as e:
+        logging.critical("Failed to list database versions in %s: %s" % (db_dir, e))
+        return versions
+    for name in names:
+        match = re.match(pattern, name)
+        if match is None:
+            continue
+        date = match.groupdict().get('date')
+        epoch = calendar.timegm(time.strptime(date, '%Y%m%d')) if date else 0
+        versions.append((epoch, os.path.join(db_dir, name)))
+    return sorted(versions)
+
+
+class VersionedDB:
+    """VersionedDB holds the successive versions of a database, e.g. monthly RIBs, and answers queries at a given time
+
+    A version is valid from its date till that of the next one; the first one is as well used before its date.
+    Versions are only loaded when first queried and the least recently used ones are dropped beyond capacity.
+    The first version is the base of all the others: it is kept loaded and the others only store what differs from it.
+    Subclasses tell how a version is loaded by implementing _load().
+
+    Attributes:
+        versions (list of (int, string)): sec since epoch from which each version is valid and path to its file,
+        sorted by time, see find_versions()
+    """
+    def __init__(self, versions, capacity=DEFAULT_VERSIONS):
+        """
+        Args:
+            versions (list of (int, string)): see VersionedDB
+            capacity (int): maximum number of versions kept loaded, apart from the base
+
+        Raises:
+            ValueError: if no version is given
+        """
+        if not versions:
+            raise ValueError("no version of the database is given")
+        self.versions = sorted(versions)
+        self._starts = [i[0] for i in self.versions]
+        self._base = None
+        self._loaded = LruCache(self._load_version, capacity)
+
+    def _load(self, fn, base):
+        """ load a version from its file, on top of base if not None """
+        raise NotImplementedError
+
+    def _load_version(self, idx):
+        if self._base is None:
+            self._base = self._load(self.versions[0][1], None)
+        return self._base if idx == 0 else self._load(self.versions[idx][1], self._base)
+
+    def index_at(self, epoch):
+        """ index in versions of the version valid at a given time
+
+        Args:
+            epoch (int): sec since epoch
+
+        Returns:
+            int
+        """
+        return max(bisect.bisect_right(self._starts, epoch) - 1, 0)
+
+    def at(self, epoch):
+        """ the version valid at a given time, loaded if not yet """
+        return self._loaded(self.index_at(epoch))
+
+    def between(self, start, end):
+        """ load the versions valid during a time range, e.g. that of a chunk
+
+        Args:
+            start (int): sec since epoch
+            end (int): sec since epoch
+
+        Returns:
+            list of (int, object): index in versions and the loaded version
+        """
+        return [(i, self._loaded(i)) for i in xrange(self.index_at(start), self.index_at(end) + 1)]
+
+
+class VersionedAsnDB(VersionedDB):
+    """VersionedAsnDB holds successive versions of the IP to ASN database, see AsnDB; they share the reserved IP blocks
+    """
+    def __init__(self, versions, reserved=None, capacity=DEFAULT_VERSIONS):
+        """
+        Args:
+            versions (list of (int, string)): see VersionedDB, files converted by pyasn
+            reserved (string): path to file recording reserved IP blocks
+            capacity (int): see VersionedDB
+        """
+        VersionedDB.__init__(self, versions, capacity)
+        self._reserved_fn = reserved
+
+    def _load(self, fn, base):
+        return AsnDB(fn, self._reserved_fn, base=base)
+
+    def lookup(self, addr, epoch):
+        """look up the ASN or description of given IP address at a given time, see AsnDB.lookup()"""
+        return self.at(epoch).lookup(addr)
+
+
+class VersionedAsRelationDB(VersionedDB):
+    """VersionedAsRelationDB holds successive versions of CAIDA AS relationship inference, see AsRelationDB
+    """
+    def _load(self, fn, base):
+        return AsRelationDB(fn, base=base)
+
+    def has_relation(self, tup, epoch):
+        """Check the relationship of two AS at a given time, see AsRelationDB.has_relation()"""
+        return self.at(epoch).has_relation(tup)
+
+    def has_relation_many(self, pairs, epoch):
+        """Check the relationship of many AS pairs at a given time, see AsRelationDB.has_relation_many()"""
+        return self.at(epoch).has_relation_many(pairs)
@@ -0,0 +1,268 @@
+"""
+fetcher.py downloads Atlas measurement results and probe listings with retries,
+and provides a local stand-in of the Atlas API for tests
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urlparse
+import requests
+
+ATLAS_SERVER = 'https://atlas.ripe.net'
+RESULT_PATH = '/api/v2/measurements/%d/results/'
+PROBE_PATH = '/api/v2/probes/'
+# HTTP status worth a retry: throttled or server side trouble
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class FetchError(Exception):
+    """ raised when results can not be downloaded after all the retries """
+    pass
+
+
+class AtlasFetcher:
+    """ AtlasFetcher downloads measurement results in newline delimited format to local files
+
+    It holds no state other than its settings, one instance can be shared by many threads.
+
+    Attributes:
+        server (string): scheme and host of the Atlas API, e.g. 'https://atlas.ripe.net' or 'http://127.0.0.1:8000'
+        retries (int): times a failed request is tried again
+        backoff (float): seconds to wait before the first retry, doubled at each following retry
+        timeout (float): seconds to wait for the server to answer or to send the next bytes
+    """
+    def __init__(self, server=ATLAS_SERVER, retries=5, backoff=2., timeout=300.):
+        self.server = server.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def download(self, msm_id, pb_id, start, end, dest):
+        """ download measurement results of given probes within [start, end] to a file
+
+        Each line of the file is one measurement in JSON format.
+        The download is started over from scratch after a failure, with exponential backoff between tries.
+
+        Args:
+            msm_id (int): measurement id
+            pb_id (list of int): list of probe ids
+            start (int): epoch time for the beginning of observation window
+            end (int): epoch time for the end of observation window
+            dest (string): path to the file where results are written
+
+        Raises:
+            FetchError: if all tries failed, or the server refused the request
+        """
+        url = self.server + RESULT_PATH % msm_id
+        params = dict(start=start, stop=end, probe_ids=','.join([str(i) for i in pb_id]), format='txt')
+
+        def save():
+            resp = self._get(url, params, stream=True)
+            with open(dest, 'wb') as fp:
+                for block in resp.iter_content(chunk_size=1 << 16):
+                    fp.write(block)
+        self._retry(save, "Measurement %d for %d probes" % (msm_id, len(pb_id)))
+
+    def probes(self, **filters):
+        """ iterate over the probes listed by the Atlas probe API, page by page
+
+        Args:
+            filters: query parameters of the probe API, e.g. tags='system-v3', is_anchor='true', id__gt=10000
+
+        Returns:
+            generator of dict, each being a probe as returned by the Atlas API
+
+        Raises:
+            FetchError: if a page can not be fetched after all the retries
+        """
+        url = self.server + PROBE_PATH
+        params = dict(filters)
+        params.setdefault('page_size', 500)
+        while url:
+            page = self._retry(lambda: self._get(url, params).json(), "Probe listing")
+            for pb in page.get('results', []):
+                yield pb
+            # the next page link carries the query parameters
+            url, params = page.get('next'), None
+
+    def _get(self, url, params, stream=False):
+        """ GET url, raise on status worth a retry, and FetchError on the others """
+        resp = requests.get(url, params=params, stream=stream, timeout=self.timeout)
+        if resp.status_code in RETRY_STATUS:
+            raise requests.exceptions.HTTPError("%d from %s" % (resp.status_code, url))
+        elif resp.status_code != 200:
+            raise FetchError("%d from %s" % (resp.status_code, url))
+        return resp
+
+    def _retry(self, func, what):
+        """ call func until it succeeds, with exponential backoff between tries
+
+        Args:
+            func (function): without argument, may raise requests.exceptions.RequestException
+            what (string): describes the request in logs
+
+        Returns:
+            what func returns
+        """
+        for attempt in xrange(self.retries + 1):
+            try:
+                return func()
+            except (requests.exceptions.RequestException, ValueError) as e:  # ValueError for broken json
+                if attempt == self.retries:
+                    raise FetchError("%s, given up after %d tries" % (e, attempt + 1))
+                wait = self.backoff * 2 ** attempt
+                wait += random.uniform(0, wait)  # jitter so that throttled workers do not retry all at once
+                logging.warning("%s: %s, retry in %.1f sec." % (what, e, wait))
+                time.sleep(wait)
+
+
+def read_results(fn):
+    """ iterate over the measurements saved by AtlasFetcher.download()
+
+    Args:
+        fn (string): path to the downloaded file
+
+    Returns:
+        generator of dict, each being an Atlas measurement in JSON format
+    """
+    with open(fn, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class _CannedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ answers GET /api/v2/measurements/<msm>/results/ and /api/v2/probes/ from the data loaded by CannedAtlasServer """
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        parts = [i for i in url.path.split('/') if i]
+        if parts == ['api', 'v2', 'probes']:
+            self.probes(url)
+            return
+        if len(parts) != 5 or parts[:3] != ['api', 'v2', 'measurements'] or parts[4] != 'results':
+            self.send_error(404)
+            return
+        if self.server.pop_failure():
+            self.send_error(503)
+            return
+        try:
+            results = self.server.results[int(parts[3])]
+        except (KeyError, ValueError):
+            self.send_error(404)
+            return
+        query = dict(urlparse.parse_qsl(url.query))
+        start = int(query.get('start', 0))
+        stop = int(query.get('stop', 2 ** 62))
+        probes = set([int(i) for i in query['probe_ids'].split(',')]) if query.get('probe_ids') else None
+        selected = [r for r in results if start <= r.get('timestamp', 0) <= stop and
+                    (probes is None or r.get('prb_id') in probes)]
+        if query.get('format') == 'txt':
+            body = ''.join([json.dumps(r) + '\n' for r in selected])
+        else:
+            body = json.dumps(selected)
+        self.reply(body)
+
+    def probes(self, url):
+        """ answer a page of the probe listing; tags, is_anchor, id__gt, id__in, page and page_size are honored """
+        if self.server.pop_failure():
+            self.send_error(503)
+            return
+        query = dict(urlparse.parse_qsl(url.query))
+        selected = self.server.probes
+        if query.get('tags'):
+            tags = query['tags'].split(',')
+            selected = [pb for pb in selected if all([t in [d['slug'] for d in pb['tags']] for t in tags])]
+        if query.get('is_anchor'):
+            selected = [pb for pb in selected if pb['is_anchor'] == (query['is_anchor'].lower() == 'true')]
+        if query.get('id__gt'):
+            selected = [pb for pb in selected if pb['id'] > int(query['id__gt'])]
+        if query.get('id__in'):
+            ids = set([int(i) for i in query['id__in'].split(',')])
+            selected = [pb for pb in selected if pb['id'] in ids]
+        page = int(query.get('page', 1))
+        page_size = int(query.get('page_size', 100))
+        nxt = None
+        if page * page_size < len(selected):
+            query['page'] = page + 1
+            nxt = '%s%s?%s' % (self.server.url, url.path, '&'.join(['%s=%s' % (k, v) for k, v in query.items()]))
+        self.reply(json.dumps(dict(count=len(selected), next=nxt, previous=None,
+                                   results=selected[(page - 1) * page_size:page * page_size])))
+
+    def reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.debug("CannedAtlasServer: " + fmt % args)
+
+
+class CannedAtlasServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ CannedAtlasServer is a local stand-in of the Atlas result API serving canned measurements
+
+    Results are read from <msm id>.json files in a folder, each holding a list of measurements
+    as returned by the Atlas API. start, stop, probe_ids and format query parameters are honored.
+    Probes are read from probes.json in the same folder, a list of probes as returned by the Atlas API.
+
+    Attributes:
+        results (dict): msm id (int) to list of measurements
+        probes (list of dict): probes served by the probe API
+        url (string): to be given as server to AtlasFetcher
+    """
+    daemon_threads = True
+
+    def __init__(self, results, port=0, failures=0, probes=None):
+        """ bind to localhost
+
+        Args:
+            results (string or dict): folder of <msm id>.json files, or msm id (int) to list of measurements
+            port (int): 0 to let the system pick a free port
+            failures (int): number of first requests answered with 503, to exercise retries
+            probes (list of dict): probes served by the probe API, read from probes.json in results folder if not given
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), _CannedHandler)
+        self.probes = probes if probes is not None else []
+        if isinstance(results, dict):
+            self.results = results
+        else:
+            self.results = dict()
+            for fn in os.listdir(results):
+                if fn == 'probes.json':
+                    if probes is None:
+                        with open(os.path.join(results, fn), 'r') as fp:
+                            self.probes = json.load(fp)
+                elif fn.endswith('.json'):
+                    with open(os.path.join(results, fn), 'r') as fp:
+                        self.results[int(fn[:-5])] = json.load(fp)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self._failures = failures
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def pop_failure(self):
+        """ return True if the current request shall fail """
+        with self._lock:
+            if self._failures > 0:
+                self._failures -= 1
+                return True
+            return False
+
+    def start(self):
+        """ serve in a background thread """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ stop serving and release the port """
+        self.shutdown()
+        self.server_close()
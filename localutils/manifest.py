@@ -0,0 +1,127 @@
+"""
+manifest.py keeps track of the time range of measurements already stored for each probe
+"""
+import json
+import logging
+import os
+
+
+class Manifest:
+    """ Manifest records, for each measurement id and probe id, the time range stored in data/ and in which chunk
+
+    It is persisted as a json file:
+    {msm id (string): {probe id (string): [start (int), end (int), chunk id (int), count (int)]}}
+    count, the number of stored measurements, is absent in records of older manifests.
+
+    Attributes:
+        fn (string): path to the manifest file
+        _ranges (dict): content of the manifest file
+    """
+    def __init__(self, fn):
+        """ load the manifest from file, start from an empty one if the file is missing or broken
+
+        Args:
+            fn (string): path to the manifest file, normally data/manifest.json
+        """
+        self.fn = fn
+        self._ranges = dict()
+        if os.path.isfile(fn):
+            try:
+                with open(fn, 'r') as fp:
+                    self._ranges = json.load(fp)
+            except ValueError:
+                logging.warning("decoding %s failed, starting with an empty manifest." % fn)
+
+    def entries(self, msm, probe_list):
+        """ get the stored time ranges of given probes for a measurement
+
+        Args:
+            msm (int): measurement id
+            probe_list (list of int): probe ids
+
+        Returns:
+            dict: probe id (int) to (start, end, chunk id, count) tuple; probes without record are absent
+        """
+        by_msm = self._ranges.get(str(msm), dict())
+        return {pb: tuple(by_msm[str(pb)]) for pb in probe_list if str(pb) in by_msm}
+
+    def update(self, msm, entries):
+        """ set the stored time ranges of probes for a measurement
+
+        Args:
+            msm (int): measurement id
+            entries (dict): probe id (int) to (start, end, chunk id, count) tuple
+        """
+        by_msm = self._ranges.setdefault(str(msm), dict())
+        for pb, rg in entries.items():
+            by_msm[str(pb)] = list(rg)
+
+    def save(self):
+        """ write the manifest to file; the file is replaced atomically so that an interruption never corrupts it """
+        tmp = self.fn + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(self._ranges, fp)
+        os.rename(tmp, self.fn)
+
+
+def missing_ranges(entry, chunk_id, start, end):
+    """ find the time ranges to be fetched for a probe so that [start, end] is fully stored
+
+    Args:
+        entry (tuple or None): (start, end, chunk id, count) recorded in manifest for the probe
+        chunk_id (int): the chunk the probe belongs to in the current run
+        start (int): epoch time for the beginning of observation window
+        end (int): epoch time for the end of observation window
+
+    Returns:
+        list of (int, int): inclusive epoch ranges not yet stored; empty if nothing is missing
+
+    Notes:
+        a record stored in a different chunk is ignored, the entire window is then fetched.
+    """
+    if entry is None or entry[2] != chunk_id:
+        return [(start, end)]
+    stored_start, stored_end = entry[:2]
+    ranges = []
+    if start < stored_start:
+        ranges.append((start, stored_start - 1))
+    if end > stored_end:
+        ranges.append((stored_end + 1, end))
+    return ranges
+
+
+def merge_records(old, new):
+    """ merge measurements of the same probe fetched over different time ranges
+
+    Args:
+        old (dict): stored measurements of a probe, e.g. dict(epoch=[int], min_rtt=[float], all_rtt=[tuple of float])
+        new (dict): newly fetched measurements of same format
+
+    Returns:
+        dict: same format, ordered by epoch; for connection events, each list is ordered
+    """
+    merged = dict()
+    for k in set(old.keys()) | set(new.keys()):
+        merged[k] = list(old.get(k, [])) + list(new.get(k, []))
+    if 'epoch' in merged:
+        order = sorted(range(len(merged['epoch'])), key=lambda i: merged['epoch'][i])
+        for k in merged:
+            merged[k] = [merged[k][i] for i in order]
+    else:
+        for k in merged:
+            merged[k] = sorted(merged[k])
+    return merged
+
+
+def record_count(rec):
+    """ number of measurements in the stored records of a probe
+
+    Args:
+        rec (dict): e.g. dict(epoch=[int], min_rtt=[float], all_rtt=[tuple of float])
+
+    Returns:
+        int
+    """
+    if 'epoch' in rec:
+        return len(rec['epoch'])
+    return sum([len(v) for v in rec.values()])
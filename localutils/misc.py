@@ -51,3 +51,128 @@ def get_chunk_count(f):
             if idx > 0:
                 chunk_count = max(chunk_count, type_convert(line.split(";")[1].strip()))
     return chunk_count
+
+
+class LruCache:
+    """ LruCache memoizes a function of one hashable argument, keeping the results of the most recently used arguments
+
+    Results are kept in a dict and ordered in a circular doubly linked list, each link being
+    [previous link, next link, argument, result]; the link following the root is the least recently used.
+
+    Attributes:
+        capacity (int): maximum number of results kept, 0 to disable caching
+        hits (int): number of calls answered from the cache
+        misses (int): number of calls that went through the function
+    """
+    def __init__(self, func, capacity):
+        """
+        Args:
+            func (callable): function of one hashable argument
+            capacity (int): see LruCache
+        """
+        self._func = func
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._links = dict()
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __call__(self, key):
+        root = self._root
+        link = self._links.get(key)
+        if link is not None:
+            # unlink and put it back as most recently used
+            prev, nxt, _, value = link
+            prev[1] = nxt
+            nxt[0] = prev
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            self.hits += 1
+            return value
+        value = self._func(key)
+        self.misses += 1
+        while self._links and len(self._links) >= self.capacity:
+            # evict the least recently used
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self._links[oldest[2]]
+        if self.capacity > 0:
+            last = root[0]
+            last[1] = root[0] = self._links[key] = [last, root, key, value]
+        return value
+
+    def clear(self):
+        """ drop all the results and reset the counters """
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None, None]
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """ usage of the cache
+
+        Returns:
+            dict: hits, misses, size, capacity and hit_rate (float, None if never called)
+        """
+        calls = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, size=len(self._links), capacity=self.capacity,
+                    hit_rate=float(self.hits) / calls if calls else None)
+
+
+class PathTable:
+    """ PathTable interns paths to integer ids, e.g. the AS paths of one probe, so that paths are compared by id
+
+    Attributes:
+        paths (list of tuple): the i-th path is the one of id i
+    """
+    def __init__(self):
+        self.paths = []
+        self._ids = dict()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def intern(self, path):
+        """ id of a path, a new one if the path is not yet known
+
+        Args:
+            path (list or tuple of hops): hops shall be hashable, e.g. ASN or IP address
+
+        Returns:
+            int
+        """
+        path = tuple(path)
+        pid = self._ids.get(path)
+        if pid is None:
+            pid = self._ids[path] = len(self.paths)
+            self.paths.append(path)
+        return pid
+
+    def intern_all(self, paths):
+        """ ids of a sequence of paths, see intern() """
+        return [self.intern(p) for p in paths]
+
+
+def run_length(ids):
+    """ run-length encode a sequence
+
+    Args:
+        ids (list): e.g. path ids
+
+    Returns:
+        list of (value, int, int): value, index of its first occurrence and length of each run
+    """
+    runs = []
+    for idx, i in enumerate(ids):
+        if runs and runs[-1][0] == i:
+            runs[-1][2] += 1
+        else:
+            runs.append([i, idx, 1])
+    return [tuple(r) for r in runs]
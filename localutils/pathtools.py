@@ -2,21 +2,64 @@
 pathtools.py provides functions handling IP hops, IXP detection and ASN information.
 """
 import dbtools as db
+from misc import LruCache, PathTable, run_length
 import os
 import copy
 import logging
 
 # load database from the local folder
 cur_path = os.path.abspath(os.path.dirname(__file__))
-
-as_rel = db.AsRelationDB(os.path.join(cur_path, "db/20161201.as-rel2.txt"))
-ip2asn = db.AsnDB(main=os.path.join(cur_path, "db/ipasn.dat"),
-                  reserved=os.path.join(cur_path, "db/reserved_ip.txt"))
+db_path = os.path.join(cur_path, "db")
+
+# IP to ASN and AS relationship databases are versioned by date, see dbtools.find_versions();
+# ip2asn and as_rel are the versions in use, the latest ones unless use_versions_at() is called
+as_rel_versions = db.VersionedAsRelationDB(db.find_versions(db_path, db.AS_REL_PATTERN) or
+                                           [(0, os.path.join(db_path, "20161201.as-rel2.txt"))])
+ip2asn_versions = db.VersionedAsnDB(db.find_versions(db_path, db.IPASN_PATTERN) or
+                                    [(0, os.path.join(db_path, "ipasn.dat"))],
+                                    reserved=os.path.join(db_path, "reserved_ip.txt"))
+as_rel = as_rel_versions.at(as_rel_versions.versions[-1][0])
+ip2asn = ip2asn_versions.at(ip2asn_versions.versions[-1][0])
 ixp_pref = db.IxpPrefixDB(os.path.join(cur_path, "db/ixp_prefixes.txt"))
 ixp_member = db.IxpMemberDB(os.path.join(cur_path, "db/ixp_membership.txt"))
 
+# number of distinct IP addresses whose information is kept by get_ip_info() in each process
+IP_CACHE_SIZE = 1 << 16
 
-def get_ip_info(ip):
+
+def version_at(epoch):
+    """ the versions of IP to ASN and AS relationship databases valid at a given time
+
+    Args:
+        epoch (int): sec since epoch
+
+    Returns:
+        (int, int): index of the version in ip2asn_versions and in as_rel_versions
+    """
+    return ip2asn_versions.index_at(epoch), as_rel_versions.index_at(epoch)
+
+
+def use_versions_at(epoch):
+    """ make the IP to ASN and AS relationship databases valid at a given time the ones in use
+
+    ip_info_cache is cleared if the version of the IP to ASN database changes.
+
+    Args:
+        epoch (int): sec since epoch
+
+    Returns:
+        (int, int): see version_at()
+    """
+    global ip2asn, as_rel
+    asn_db = ip2asn_versions.at(epoch)
+    if asn_db is not ip2asn:
+        ip2asn = asn_db
+        ip_info_cache.clear()
+    as_rel = as_rel_versions.at(epoch)
+    return version_at(epoch)
+
+
+def lookup_ip_info(ip):
     """Query the ASN and IXP information for a given IP address from various data source
 
     Args:
@@ -42,6 +85,57 @@ def get_ip_info(ip):
     return addr
 
 
+ip_info_cache = LruCache(lookup_ip_info, IP_CACHE_SIZE)
+
+
+def get_ip_info(ip):
+    """Query the ASN and IXP information for a given IP address, see lookup_ip_info()
+
+    Results are kept in ip_info_cache, least recently used addresses being evicted beyond its capacity,
+    IP_CACHE_SIZE by default; ip_info_cache.stats() tells the hit rate.
+
+    Args:
+        ip (string): ip address, e.g. '129.250.66.33'
+
+    Returns:
+        addr (db.Addr): Addr object, with addr_type attribute set; shared by all the calls on the same ip
+    """
+    return ip_info_cache(ip)
+
+
+def get_ip_info_many(ips):
+    """Query the information of many IP addresses at once, e.g. all the hops of a chunk, see lookup_ip_info()
+
+    Addresses are resolved by a few vectorized lookups in each database instead of one call per address;
+    ip_info_cache is neither used nor updated.
+
+    Args:
+        ips (list of string): ip addresses
+
+    Returns:
+        list of db.Addr, same order as ips
+    """
+    idx4, v4, idx6, hi, lo = db.split_addrs(ips)
+    res = [db.Addr(addr=ip, addr_type=db.AddrType.Others, desc='Invalid IP address') for ip in ips]
+    for idx, keys, (asn, reserved) in ((idx4, db.pack_v4(v4), ip2asn.lookup_v4_many(v4)),
+                                       (idx6, db.pack_v6(hi, lo), ip2asn.lookup_v6_many(hi, lo))):
+        for i, interco, ixp, a, r in zip(idx.tolist(), ixp_member.lookup_interco_many(keys), ixp_pref.lookup_many(keys),
+                                         asn.tolist(), reserved.tolist()):
+            ip = ips[i]
+            # same precedence as lookup_ip_info(): IXP interconnection, IXP prefix, reserved IP block then ASN
+            if interco is not None:
+                res[i] = db.Addr(addr=ip, addr_type=db.AddrType.InterCo, asn=interco[0], ixp=interco[1])
+            elif ixp is not None:
+                res[i] = db.Addr(addr=ip, addr_type=db.AddrType.IxpPref, ixp=ixp)
+            elif r != db.NO_VALUE:
+                res[i] = db.Addr(addr=ip, addr_type=db.AddrType.Others, desc=ip2asn.reserved_list[r])
+            elif a != db.NO_VALUE:
+                res[i] = db.Addr(addr=ip, addr_type=db.AddrType.Normal, asn=a)
+            else:
+                res[i] = db.Addr(addr=ip, addr_type=db.AddrType.Others, desc=None)
+    return res
+
+
 def bridge(path):
     """given a sequence of IP hops, identify sub-sequences without ASN, and remove only those IPs other than
     IXP IPs if the the ASes wrapping the sub-sequence have known relation ship
@@ -57,17 +151,19 @@ def bridge(path):
     asn_path = [hop.asn for hop in path]
     holes = find_holes(asn_path)  # indexes of None (ASN) sub-sequences
     last_idx = len(path) - 1
-    for start, end in holes:
-        # only check the sub-sequences having type dbtools.AddrType.Others hops
-        if start > 0 and end < last_idx and db.AddrType.Others in [hop.type for hop in path[start:end+1]]:
-            # if there is known relation between the two ASes wrapping the None sub-sequence
-            left_asn = path[start-1].asn
-            right_asn = path[end+1].asn
-            if left_asn == right_asn or as_rel.has_relation((left_asn, right_asn)) is not None:
-                # remove only the hop of type dbtools.AddrType.Others
-                for idx in range(start, end+1):
-                    if path[idx].type == db.AddrType.Others:
-                        remove_flag[idx] = True
+    # only check the sub-sequences having type dbtools.AddrType.Others hops
+    holes = [(start, end) for start, end in holes
+             if start > 0 and end < last_idx and db.AddrType.Others in [hop.type for hop in path[start:end+1]]]
+    # relations between the two ASes wrapping each None sub-sequence, looked up at once
+    wrapping = [(path[start-1].asn, path[end+1].asn) for start, end in holes]
+    relations = as_rel.has_relation_many(wrapping)
+    for (start, end), (left_asn, right_asn), relation in zip(holes, wrapping, relations):
+        # if there is known relation between the two ASes wrapping the None sub-sequence
+        if left_asn == right_asn or relation != as_rel.NO_RELATION:
+            # remove only the hop of type dbtools.AddrType.Others
+            for idx in range(start, end+1):
+                if path[idx].type == db.AddrType.Others:
+                    remove_flag[idx] = True
     return [path[idx] for idx in range(last_idx+1) if not remove_flag[idx]]
 
 
@@ -110,6 +206,13 @@ def insert_ixp(path):
     """
     path_len = len(path)
     ixp_insertion = []
+    # IXP membership of the ASes surrounding each IXP hop, checked at once for the whole path
+    candidates = [idx for idx in range(1, path_len-1)
+                  if (path[idx].type == db.AddrType.InterCo or path[idx].type == db.AddrType.IxpPref) and
+                  path[idx-1].type == db.AddrType.Normal and path[idx+1].type == db.AddrType.Normal]
+    membership = ixp_member.is_member_many([(path[idx].ixp, path[idx+side].asn)
+                                            for idx in candidates for side in (-1, 1)]).tolist()
+    surrounding_member = {idx: (membership[2*k], membership[2*k+1]) for k, idx in enumerate(candidates)}
     for idx, hop in enumerate(path):
         if (hop.type == db.AddrType.InterCo or hop.type == db.AddrType.IxpPref) and (0 < idx < path_len-1):
             # Normal - Interco/IxpPref - Normal
@@ -130,8 +233,7 @@ def insert_ixp(path):
                     # ASN: A - B - C
                     elif left_hop.get_asn() != hop.get_asn() != right_hop.get_asn():
                         # check IXP member ship
-                        left_is_member = ixp_member.is_member(ixp=hop.ixp, asn=left_hop.asn)
-                        right_is_member = ixp_member.is_member(ixp=hop.ixp, asn=right_hop.asn)
+                        left_is_member, right_is_member = surrounding_member[idx]
                         # IXP membership: A -m- B -m- C -> A - IXP - B - IXP - C
                         if left_is_member and right_is_member:
                             ixp_insertion.append((idx, hop.ixp))
@@ -146,8 +248,7 @@ def insert_ixp(path):
                             pass  # in this case no IXP hop will be seen in the path
                 # Normal - IxpPref - Normal
                 elif hop.type == db.AddrType.IxpPref:
-                    left_is_member = ixp_member.is_member(ixp=hop.ixp, asn=left_hop.asn)
-                    right_is_member = ixp_member.is_member(ixp=hop.ixp, asn=right_hop.asn)
+                    left_is_member, right_is_member = surrounding_member[idx]
                     # IXP membership: A -m- IxpPref -m- B -> A - IXP - IxpPref - IXP - B
                     if left_is_member and right_is_member:
                         ixp_insertion.append((idx, hop.ixp))
@@ -193,6 +294,118 @@ def remove_repeated_asn(path):
     return removed
 
 
+def ip_to_asn_path(ip_path, src=None, ixp=True, ip_info=None):
+    """ translate an IP path to an ASN path
+
+    Args:
+        ip_path (list of string): IP hops, e.g. as seen in traceroute
+        src (string): IP address of the source, added as first hop if not None
+        ixp (bool): detect IXPs, only done for IPv4 in this project
+        ip_info (dict): IP address to db.Addr already resolved, e.g. with get_ip_info_many();
+        other addresses are queried with get_ip_info()
+
+    Returns:
+        list of ASN, ASN can be int or str if IXP hop, without continuously repeated ones
+    """
+    if src is not None:
+        ip_path = [src] + list(ip_path)
+    if ip_info is None:
+        enhanced_path = [get_ip_info(i) for i in ip_path]  # query IP information
+    else:
+        enhanced_path = [ip_info[i] if i in ip_info else get_ip_info(i) for i in ip_path]
+    enhanced_path = bridge(enhanced_path)  # remove holes if possible
+    if ixp:
+        enhanced_path = insert_ixp(enhanced_path)
+    return remove_repeated_asn([hop.get_asn() for hop in enhanced_path])
+
+
+def is_as_change(prev, path):
+    """ whether path differs from prev, see as_path_change() """
+    return path != prev
+
+
+def is_as_change_cl(prev, path):
+    """ whether path differs from prev by valid ASNs only, see as_path_change_cl() """
+    if len(path) > 0 and len(prev) > 0:
+        if path[-1] == prev[-1] and path != prev:  # exclude reachability issue
+            diff_as = set(path) ^ set(prev)
+            return len(diff_as) > 0 and all([type(i) is int for i in diff_as])  # all difference is a valid ASN
+    return False
+
+
+def _first_diff(prev, path):
+    """ the first pair of different hops of two non-empty paths, None if none """
+    if len(path) > 0 and len(prev) > 0:
+        for hop_pair in zip(path, prev):
+            if hop_pair[0] != hop_pair[1]:
+                return hop_pair
+    return None
+
+
+def is_as_change_cs(prev, path):
+    """ whether the first different hops of prev and path are both valid ASN, see as_path_change_cs() """
+    hop_pair = _first_diff(prev, path)
+    return hop_pair is not None and type(hop_pair[0]) is int and type(hop_pair[1]) is int
+
+
+def is_as_change_ixp(prev, path):
+    """ whether path differs from prev by an IXP, see as_path_change_ixp() """
+    if len(path) > 0 and len(prev) > 0:
+        if path[-1] == prev[-1] and path != prev:  # exclude reachability issue
+            diff_as = set(path) ^ set(prev)
+            return len(diff_as) > 0 and any([is_ixp_asn_hop(i) for i in diff_as])
+    return False
+
+
+def is_as_change_ixp_cs(prev, path):
+    """ whether the first different hops of prev and path involve an IXP, see as_path_change_ixp_cs() """
+    hop_pair = _first_diff(prev, path)
+    return hop_pair is not None and all([not is_bad_hop(i) for i in hop_pair]) and \
+        any([type(i) is str for i in hop_pair])
+
+
+def is_as_change_ixp_pu(prev, path):
+    """ whether the first different hops of prev and path are both IXPs, see as_path_change_ixp_pu() """
+    hop_pair = _first_diff(prev, path)
+    return hop_pair is not None and all([is_ixp_asn_hop(i) for i in hop_pair])
+
+
+# AS path change detectors, by name, to the test telling if there is a change between two consecutive paths
+AS_PATH_DETECTORS = dict(as_path_change=is_as_change, as_path_change_cl=is_as_change_cl,
+                         as_path_change_cs=is_as_change_cs, as_path_change_ixp=is_as_change_ixp,
+                         as_path_change_ixp_cs=is_as_change_ixp_cs, as_path_change_ixp_pu=is_as_change_ixp_pu)
+
+
+def as_path_changes(paths, detectors=None):
+    """ run several AS path change detectors in one pass
+
+    Paths are interned to ids and run-length encoded: consecutive identical paths are never a change for any detector,
+    the hop level tests only run at the boundaries of runs, once for each distinct pair of paths.
+
+    Args:
+        paths (list of list of ASN): [[ASN,...],...]
+        detectors (list of string): names in AS_PATH_DETECTORS, all of them if None
+
+    Returns:
+        dict: detector name to list of int, index of change is set to 1, otherwise 0
+    """
+    detectors = sorted(AS_PATH_DETECTORS) if detectors is None else detectors
+    tests = [AS_PATH_DETECTORS[name] for name in detectors]
+    table = PathTable()
+    runs = run_length(table.intern_all(paths))
+    change = [[0] * len(paths) for _ in detectors]
+    tested = dict()  # (previous path id, path id) to the result of each test
+    for (prev_id, _, _), (pid, begin, _) in zip(runs, runs[1:]):
+        res = tested.get((prev_id, pid))
+        if res is None:
+            prev, path = table.paths[prev_id], table.paths[pid]
+            res = tested[(prev_id, pid)] = [test(prev, path) for test in tests]
+        for k, is_change in enumerate(res):
+            if is_change:
+                change[k][begin] = 1
+    return dict(zip(detectors, change))
+
+
 def as_path_change(paths):
     """ mark the idx at which AS path changes
 
@@ -202,12 +415,7 @@ def as_path_change(paths):
     Returns:
         list of int, index of change is set to 1, otherwise 0
     """
-    change = [0] * len(paths)
-    for idx, path in enumerate(paths):
-        if idx > 0:
-            if path != paths[idx-1]:
-                change[idx] = 1
-    return change
+    return as_path_changes(paths, ['as_path_change'])['as_path_change']
 
 
 def as_path_change_cl(paths):
@@ -219,15 +427,7 @@ def as_path_change_cl(paths):
     Returns:
         list of int, index of change is set to 1, otherwise 0
     """
-    change = [0] * len(paths)
-    for idx, path in enumerate(paths):
-        if idx > 0:
-            if len(path) > 0 and len(paths[idx-1]) > 0:
-                if path[-1] == paths[idx-1][-1] and path != paths[idx-1]:  # exclude reachability issue
-                    diff_as = set(path) ^ set(paths[idx-1])
-                    if len(diff_as) > 0 and all([type(i) is int for i in diff_as]):  # all difference is a valid ASN
-                        change[idx] = 1
-    return change
+    return as_path_changes(paths, ['as_path_change_cl'])['as_path_change_cl']
 
 
 def as_path_change_cs(paths):
@@ -241,16 +441,7 @@ def as_path_change_cs(paths):
     Returns:
         list of int, index of change is set to 1, otherwise 0
     """
-    change = [0] * len(paths)
-    for idx, path in enumerate(paths):
-        if idx > 0:
-            if len(path) > 0 and len(paths[idx-1]) > 0:
-                for hop_pair in zip(path, paths[idx-1]):
-                    if hop_pair[0] != hop_pair[1]:
-                        if type(hop_pair[0]) is int and type(hop_pair[1]) is int:
-                            change[idx] = 1
-                        break
-    return change
+    return as_path_changes(paths, ['as_path_change_cs'])['as_path_change_cs']
 
 
 def is_ixp_asn_hop(x):
@@ -287,16 +478,7 @@ def as_path_change_ixp(paths):
     Returns:
         list of int, index of change is set to 1, otherwise 0
     """
-    change = [0] * len(paths)
-    for idx, path in enumerate(paths):
-        if idx > 0:
-            if len(path) > 0 and len(paths[idx-1]) > 0:
-                if path[-1] == paths[idx-1][-1] and path != paths[idx-1]:  # exclude reachability issue
-                    diff_as = set(path) ^ set(paths[idx-1])
-                    if len(diff_as) > 0 and \
-                            any([is_ixp_asn_hop(i) for i in diff_as]):
-                        change[idx] = 1
-    return change
+    return as_path_changes(paths, ['as_path_change_ixp'])['as_path_change_ixp']
 
 
 def as_path_change_ixp_cs(paths):
@@ -310,16 +492,7 @@ def as_path_change_ixp_cs(paths):
     Returns:
         list of int, index of change is set to 1, otherwise 0
     """
-    change = [0] * len(paths)
-    for idx, path in enumerate(paths):
-        if idx > 0:
-            if len(path) > 0 and len(paths[idx-1]) > 0:
-                for hop_pair in zip(path, paths[idx-1]):
-                    if hop_pair[0] != hop_pair[1]:
-                        if all([not is_bad_hop(i) for i in hop_pair]) and any([type(i) is str for i in hop_pair]):
-                            change[idx] = 1
-                        break
-    return change
+    return as_path_changes(paths, ['as_path_change_ixp_cs'])['as_path_change_ixp_cs']
 
 
 def as_path_change_ixp_pu(paths):
@@ -333,39 +506,121 @@ def as_path_change_ixp_pu(paths):
     Returns:
         list of int, index of change is set to 1, otherwise 0
     """
-    change = [0] * len(paths)
-    for idx, path in enumerate(paths):
-        if idx > 0:
-            if len(path) > 0 and len(paths[idx-1]) > 0:
-                for hop_pair in zip(path, paths[idx-1]):
-                    if hop_pair[0] != hop_pair[1]:
-                        if all([is_ixp_asn_hop(i) for i in hop_pair]):
-                            change[idx] = 1
-                        break
-    return change
+    return as_path_changes(paths, ['as_path_change_ixp_pu'])['as_path_change_ixp_pu']
+
 
+def _frozen(x):
+    """ lists, e.g. paths, to tuples, recursively, so that they can be hashed """
+    return tuple([_frozen(i) for i in x]) if isinstance(x, list) else x
 
-class IpForwardingPattern:
+
+# id of no path, e.g. that of a paris id not yet seen in an IpForwardingPattern
+NO_PATH = -1
+
+
+class IpPathTable(PathTable):
+    """ IpPathTable interns the ip paths of a sequence of traceroutes to integer ids, see misc.PathTable
+
+    Paths with the same hops in the same order share an id; None, i.e. no path, is given NO_PATH.
+
+    Attributes:
+        paths (list of path): the i-th path is the first one met of id i
+    """
+    def intern(self, path):
+        """ id of a path, a new one if the path is not yet known
+
+        Args:
+            path (list of hops or None)
+
+        Returns:
+            int
+        """
+        if path is None:
+            return NO_PATH
+        key = tuple(path) if isinstance(path, list) else path
+        pid = self._ids.get(key)
+        if pid is None:
+            pid = self._ids[key] = len(self.paths)
+            self.paths.append(path)
+        return pid
+
+    def intern_all(self, paths):
+        """ ids of a sequence of paths, see intern() """
+        ids = self._ids
+        res = []
+        for path in paths:
+            if path is None:
+                res.append(NO_PATH)
+                continue
+            key = tuple(path) if isinstance(path, list) else path
+            pid = ids.get(key)
+            if pid is None:
+                pid = ids[key] = len(self.paths)
+                self.paths.append(path)
+            res.append(pid)
+        return res
+
+    def path(self, pid):
+        """ the path of an id, None for NO_PATH """
+        return None if pid == NO_PATH else self.paths[pid]
+
+
+class IpForwardingPattern(object):
     """IpForwardingPattern describes the forwarding paths for all the paris-id in joining one destination
 
+    Paths are held as ids given by an IpPathTable, so that comparing patterns compares integers.
+    Two patterns are equal if the paths taken by each paris id are; the hash is computed once and kept till the next
+    update(), ids shall thus only be changed through update() and update_id().
+
     Attributes:
+        ids (list of int): index of the list is the paris id; the element is the id of the path taken, NO_PATH if unset
+        table (IpPathTable): gives the path of each id, shared by the patterns of a same path sequence
         pattern (list of path): index of the list is the paris id; the element is a path composed of hops;
         each path is a list of hop; two paths are equal if they contain the same hops following same order
     """
-    def __init__(self, size, paris_id=None, paths=None):
+    __slots__ = ('ids', 'table', '_hash')
+
+    def __init__(self, size, paris_id=None, paths=None, table=None):
         """Initialize with size that the number of different paris id and optionally with paths taken by paris id
 
         Args:
             size (int): number of different paris id, in the case of RIPE Atlas, it is 16
             paris_id (list of int): sequence of paris id
             paths (list of path): path taken when the corresponding paris id in the paris_id list is used
+            table (IpPathTable): interns the paths, a new one if None
         """
-        self.pattern = [None] * size
+        self.table = IpPathTable() if table is None else table
+        self.ids = [NO_PATH] * size
+        self._hash = None
         if paris_id is not None and paths is not None:
             # NOTE: if a paris_id have different paths is not checked here
             assert len(paris_id) == len(paths)
-            for pid, path in zip(paris_id, paths):
-                    self.pattern[pid] = path
+            for pid, path_id in zip(paris_id, self.table.intern_all(paths)):
+                self.ids[pid] = path_id
+
+    @classmethod
+    def of_ids(cls, size, table, paris_id, ids):
+        """ pattern of a sequence of paris id and path ids
+
+        Args:
+            size (int): number of different paris id
+            table (IpPathTable): the table that gave the ids
+            paris_id (list of int): sequence of paris id
+            ids (list of int): id of the path taken when the corresponding paris id is used
+
+        Returns:
+            IpForwardingPattern
+        """
+        pattern = cls(size, table=table)
+        pattern_ids = pattern.ids
+        for pid, path_id in zip(paris_id, ids):
+            pattern_ids[pid] = path_id
+        return pattern
+
+    @property
+    def pattern(self):
+        path = self.table.path
+        return [path(i) for i in self.ids]
 
     def update(self, paris_id, path):
         """update/complete the current pattern with new paris id and path taken
@@ -379,19 +634,22 @@ class IpForwardingPattern:
         Returns:
             boolean
         """
-        assert paris_id < len(self.pattern)
+        return self.update_id(paris_id, self.table.intern(path))
+
+    def update_id(self, paris_id, path_id):
+        """ update() with the id of the path taken, see IpPathTable """
+        assert paris_id < len(self.ids)
+        cur = self.ids[paris_id]
         # if the paris id has not yet path set, the input can always be integrated into existing pattern
-        if self.pattern[paris_id] is None:
-            self.pattern[paris_id] = path
+        if cur == NO_PATH:
+            self.ids[paris_id] = path_id
+            self._hash = None
             return True
-        elif self.pattern[paris_id] == path:
-            return True
-        else:
-            return False
+        return cur == path_id
 
     def is_complete(self):
         """test if the pattern has path set for each paris id"""
-        return None not in self.pattern
+        return NO_PATH not in self.ids
 
     def is_match(self, paris_id, paths):
         """test if the input paris ids and paths are compatible with existing pattern
@@ -405,8 +663,14 @@ class IpForwardingPattern:
         Returns:
             boolean
         """
-        for pid, path in zip(paris_id, paths):
-            if self.pattern[pid] is not None and path is not None and self.pattern[pid] != path:
+        return self.is_match_ids(paris_id, self.table.intern_all(paths))
+
+    def is_match_ids(self, paris_id, ids):
+        """ is_match() with the ids of the paths taken, see IpPathTable """
+        pattern = self.ids
+        for pid, path_id in zip(paris_id, ids):
+            cur = pattern[pid]
+            if cur != path_id and cur != NO_PATH and path_id != NO_PATH:
                 return False
         return True
 
@@ -418,10 +682,23 @@ class IpForwardingPattern:
         Returns:
             boolean
         """
-        if len(pattern.pattern) != len(self.pattern):
+        if len(pattern.ids) != len(self.ids):
             return False
-        else:
-            return self.is_match(range(len(pattern.pattern)), pattern.pattern)
+        elif pattern.table is not self.table:
+            return self.is_match(range(len(pattern.ids)), pattern.pattern)
+        # identical patterns, e.g. two complete ones, are told at once
+        return self.ids == pattern.ids or self.is_match_ids(range(len(pattern.ids)), pattern.ids)
+
+    def __deepcopy__(self, memo):
+        # the table is shared, the path of an id never changes
+        cp = IpForwardingPattern(len(self.ids), table=self.table)
+        cp.ids[:] = self.ids
+        cp._hash = self._hash
+        return cp
+
+    def __reduce__(self):
+        size = len(self.ids)
+        return IpForwardingPattern, (size, range(size), self.pattern)
 
     def __repr__(self):
         return "IpForwardingPattern(%r)" % dict(enumerate(self.pattern))
@@ -430,21 +707,37 @@ class IpForwardingPattern:
         return "%s" % dict(enumerate(self.pattern))
 
     def __hash__(self):
-        return hash(self.__repr__())
+        # paths rather than ids, so that equal patterns of different tables hash the same
+        if self._hash is None:
+            self._hash = hash(_frozen(self.pattern))
+        return self._hash
 
     def __eq__(self, other):
-        return self.__repr__() == other.__repr__()
+        if self is other:
+            return True
+        if not isinstance(other, IpForwardingPattern):
+            return False
+        if self.table is other.table:
+            return self.ids == other.ids
+        return self.pattern == other.pattern
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
 
-class PatternSegment:
+class PatternSegment(object):
     """PatternsSegment describes a subsequence of paths following a same IpFowardingPattern
 
+    Two segments are equal if their begin, end and pattern are.
+
     Attributes:
         begin (int): the beginning index of the path segment;
                      only meaningful when you know the sequence of paris_id and paths; the same for end
         end (int): the index if last path of the segment, thus inclusive
         pattern (IpForwardingPattern): the pattern followed by this segment
     """
+    __slots__ = ('begin', 'end', 'pattern')
+
     def __init__(self, begin, end, pattern):
         self.begin = begin
         self.end = end
@@ -454,6 +747,9 @@ class PatternSegment:
         """return the length of the segment"""
         return self.end - self.begin + 1
 
+    def __reduce__(self):
+        return PatternSegment, (self.begin, self.end, self.pattern)
+
     def __repr__(self):
         return "PatternSegment(begin=%r, end=%r, pattern=%r)" % (self.begin, self.end, self.pattern)
 
@@ -461,10 +757,94 @@ class PatternSegment:
         return "(%r, %r, pattern=%s)" % (self.begin, self.end, self.pattern)
 
     def __hash__(self):
-        return hash(self.__repr__())
+        return hash((self.begin, self.end, self.pattern))
 
     def __eq__(self, other):
-        return self.__repr__() == other.__repr__()
+        return self is other or (isinstance(other, PatternSegment) and
+                                 (self.begin, self.end, self.pattern) == (other.begin, other.end, other.pattern))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+class PatternIndex(object):
+    """PatternIndex tells which of a few complete IpForwardingPatterns paths and patterns are compatible with
+
+    A set of patterns is an int, bit i standing for patterns[i]; the sets of the patterns compatible with the paths
+    of a sequence are thus intersected with bitwise and.
+
+    Attributes:
+        patterns (list of IpForwardingPattern): complete patterns, of a same size and IpPathTable
+        all (int): the set of all the patterns
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.all = (1 << len(self.patterns)) - 1
+        self._sets = dict()  # (paris id, path id) to the set of patterns taking that path for that paris id
+        for i, pattern in enumerate(self.patterns):
+            for pid, path_id in enumerate(pattern.ids):
+                self._sets[(pid, path_id)] = self._sets.get((pid, path_id), 0) | 1 << i
+
+    def matching(self, paris_id, path_id):
+        """ set of the patterns compatible with a path taken by a paris id, all of them for NO_PATH
+
+        Args:
+            paris_id (int)
+            path_id (int): see IpPathTable
+
+        Returns:
+            int
+        """
+        if path_id == NO_PATH:
+            return self.all
+        return self._sets.get((paris_id, path_id), 0)
+
+    def matching_pattern(self, pattern):
+        """ set of the patterns compatible with a pattern, see IpForwardingPattern.is_match_pattern()
+
+        Args:
+            pattern (IpForwardingPattern): of the same IpPathTable as the patterns
+
+        Returns:
+            int
+        """
+        if not self.patterns or len(pattern.ids) != len(self.patterns[0].ids):
+            return 0
+        res = self.all
+        for pid, path_id in enumerate(pattern.ids):
+            res &= self.matching(pid, path_id)
+            if not res:
+                break
+        return res
+
+    def longest_match(self, paris_id, ids, begin, end):
+        """ length of the longest sub-sequence starting at each position that matches one same pattern
+
+        Args:
+            paris_id (list of int): Paris ID used when tracerouting
+            ids (list of int): id of the path taken when the corresponding paris id is used
+            begin (int): first position
+            end (int): last position, sub-sequences end there at the latest
+
+        Returns:
+            list of int: from position begin to end
+        """
+        everything = self.all
+        get = self._sets.get
+        sets = [everything if path_id == NO_PATH else get((pid, path_id), 0)
+                for pid, path_id in zip(paris_id[begin:end+1], ids[begin:end+1])]
+        res = []
+        for i in xrange(len(sets)):
+            # running and of the sets from position i, as long as a pattern is left
+            common = sets[i]
+            j = i
+            while common:
+                j += 1
+                if j == len(sets):
+                    break
+                common &= sets[j]
+            res.append(j - i)
+        return res
 
 
 def ip_path_change_simple(paris_id, paths, size=16):
@@ -481,17 +861,29 @@ def ip_path_change_simple(paris_id, paths, size=16):
         list of PatternSegment
     """
     assert (len(paris_id) == len(paths))
+    table = IpPathTable()
+    return _ip_path_change_simple(paris_id, table.intern_all(paths), size, table)
+
+
+def _ip_path_change_simple(paris_id, ids, size, table):
+    """ ip_path_change_simple() over the ids of the paths, given by table """
     seg = []
-    cur_seg = PatternSegment(begin=0, end=0, pattern=IpForwardingPattern(size))
-    for idx, (pid, path) in enumerate(zip(paris_id, paths)):
-        if cur_seg.pattern.update(pid, path):
-            cur_seg.end = idx
-        else:
+    cur_seg = PatternSegment(begin=0, end=0, pattern=IpForwardingPattern(size, table=table))
+    # IpForwardingPattern.update_id() inlined, the patterns being new
+    pattern = cur_seg.pattern.ids
+    for idx, (pid, path_id) in enumerate(zip(paris_id, ids)):
+        cur = pattern[pid]
+        if cur == NO_PATH:
+            pattern[pid] = path_id
+        elif cur != path_id:
             # once a paris id and the path take is not longer compatible with the current segment
             # start a new segment
+            cur_seg.end = idx - 1
             seg.append(cur_seg)
-            cur_seg = PatternSegment(begin=idx, end=idx, pattern=IpForwardingPattern(size))
-            cur_seg.pattern.update(pid, path)
+            cur_seg = PatternSegment(begin=idx, end=idx, pattern=IpForwardingPattern(size, table=table))
+            pattern = cur_seg.pattern.ids
+            pattern[pid] = path_id
+    cur_seg.end = max(len(ids) - 1, cur_seg.begin)
     # store the last segment
     if cur_seg not in seg:
         seg.append(cur_seg)
@@ -515,11 +907,27 @@ def ip_path_change_bck_ext(paris_id, paths, size=16):
     Returns:
         list of PatternSegment
     """
+    table = IpPathTable()
+    ids = table.intern_all(paths)
+    seg = _ip_path_change_simple(paris_id, ids, size, table)  # simple segmentation
+    return _backward_extension(seg, paris_id, ids, size, table)
 
-    seg = ip_path_change_simple(paris_id, paths, size)  # simple segmentation
 
-    for idx, s in enumerate(seg[:-1]):
-        next_s = seg[idx + 1]
+def _backward_extension(seg, paris_id, ids, size, table):
+    """ backward extension of ip_path_change_bck_ext() over the ids of the paths, given by table
+
+    Each segment is extended over the segment before as it stands, i.e. once extended itself, never beyond it;
+    a segment entirely taken by the next one is removed.
+
+    Args:
+        seg (list of PatternSegment): simple segmentation, see ip_path_change_simple(); left unchanged
+
+    Returns:
+        list of PatternSegment
+    """
+    res = seg[:1]
+    for next_s in seg[1:]:
+        s = res[-1]
         # | cur seg |<-  next seg  | extend later
         # |  cur seg ->|  next seg | is already done with simple segmentation
         # next segment can only be backwardly extended if:
@@ -527,25 +935,35 @@ def ip_path_change_bck_ext(paris_id, paths, size=16):
         # it's pattern has been repeated twice so that we are sure that it is a stable pattern
         # it is longer than the previous pattern so that we maximizes the longest pattern
         if next_s.pattern.is_complete() and next_s.get_len() >= 2 * size and next_s.get_len() > s.get_len():
-            next_s_cp = copy.deepcopy(next_s)
-            cur_s_cp = copy.deepcopy(s)
-            pos = cur_s_cp.end
-            while True:
-                # test if can be backwardly extended
-                if next_s.pattern.update(paris_id[pos], paths[pos]):
-                    cur_s_cp.end = pos - 1
-                    cur_s_cp.pattern = IpForwardingPattern(size,
-                                                           paris_id[cur_s_cp.begin:cur_s_cp.end+1],
-                                                           paths[cur_s_cp.begin:cur_s_cp.end+1])
-                    next_s_cp.begin = pos
-                    pos -= 1
-                else:
-                    break
+            # the pattern of next seg being complete, a path extends it only if it is the one of its paris id;
+            # each path is tested once, the pattern of cur seg is built once its new end is known
+            pattern = next_s.pattern.ids
+            pos = s.end
+            while pos >= s.begin and pattern[paris_id[pos]] == ids[pos]:
+                pos -= 1
             # if extended, change the both segments
-            if cur_s_cp != s:
-                seg[idx] = cur_s_cp
-                seg[idx+1] = next_s_cp
-    return seg
+            if pos != s.end:
+                if pos < s.begin:
+                    res.pop()
+                else:
+                    res[-1] = PatternSegment(begin=s.begin, end=pos,
+                                             pattern=IpForwardingPattern.of_ids(size, table, paris_id[s.begin:pos+1],
+                                                                                ids[s.begin:pos+1]))
+                next_s = PatternSegment(begin=pos+1, end=next_s.end, pattern=copy.deepcopy(next_s.pattern))
+        res.append(next_s)
+    assert _is_partition(res, len(ids))
+    return res
+
+
+def _is_partition(seg, n):
+    """ whether segments cover the indexes from 0 to n - 1 in order, each index being in one and only one of them
+
+    The segmentation of an empty sequence is a single segment (0, 0), see ip_path_change_simple().
+    """
+    if n == 0:
+        return True
+    return len(seg) > 0 and seg[0].begin == 0 and seg[-1].end == n - 1 and \
+        all([s.begin <= s.end for s in seg]) and all([s.end + 1 == t.begin for s, t in zip(seg, seg[1:])])
 
 
 def ip_path_change_split(paris_id, paths, size):
@@ -566,11 +984,22 @@ def ip_path_change_split(paris_id, paths, size):
     Returns:
         list of PatternSegment
     """
+    table = IpPathTable()
+    ids = table.intern_all(paths)
+    seg = _backward_extension(_ip_path_change_simple(paris_id, ids, size, table), paris_id, ids, size, table)
+    return _split_merge(seg, paris_id, ids, size, table)
+
+
+def _split_merge(seg, paris_id, ids, size, table):
+    """ further split and merge of ip_path_change_split() over the ids of the paths, given by table
 
-    seg = ip_path_change_bck_ext(paris_id, paths, size)
+    Args:
+        seg (list of PatternSegment): segmentation with backward extension, see ip_path_change_bck_ext()
+    """
     # find relatively popular IpForwarding pattern: any patter that ever lasts more than 2 paris id iteration
     # not different segment can have same pattern at different places in the path sequences
-    long_pat = set([s.pattern for s in seg if s.get_len() > 2*size and s.pattern.is_complete()])
+    long_pat = PatternIndex(dict([(tuple(s.pattern.ids), s.pattern) for s in seg
+                                  if s.get_len() > 2*size and s.pattern.is_complete()]).values())
     # {idx:(position, length)}
     # idx: the idx of seg to be split
     # position and length of the longest sub-segment that matches popular patterns
@@ -582,41 +1011,15 @@ def ip_path_change_split(paris_id, paths, size):
     for idx, s in enumerate(seg):
         # the segment should at least 3 in length and it's pattern has not been repeated
         # and it's pattern doesn't match with any of the popular ones
-        if 2 < s.get_len() < 2 * size:
-            # logging.debug("Split short seg %d th: %r" % (idx, s))
-            any_match = False
-            for lp in long_pat:
-                if lp.is_match_pattern(s.pattern):
-                    any_match = True
-                    # logging.debug("\tShort seg match with popular pattern %r, thus skipped" % (lp))
-            if not any_match:
-                max_len_per_pos = []
-                # iterate over all the idx from the beginning to one before last of the short segment
-                # and store the longest match with popular patterns for each position
-                for pos in range(s.begin, s.end):
-                    # logging.debug("\tInspect pos %d" % pos)
-                    l = 2  # starting from match length 2
-                    while pos+l <= s.end+1:  # iterate till the end of current segment
-                        any_match = False  # the number of  matched long pattern
-                        for lp in long_pat:
-                            if lp.is_match(paris_id[pos:pos+l], paths[pos:pos+l]):
-                                any_match = True
-                                break
-                        if any_match:  # if pos:pos+l matches at least one long pattern, further extend the length
-                            l += 1
-                        else:  # record last successful try
-                            max_len_per_pos.append((pos, l-1))
-                            break
-                    # this is case when the end of sub-segment reaches the end of the short segment
-                    if (pos, l-1) not in max_len_per_pos:
-                        max_len_per_pos.append((pos, l-1))
-                    # logging.debug("\t\tlongest sub seg %s" % str(max_len_per_pos[-1]))
-
-                max_len_per_pos = sorted(max_len_per_pos, key=lambda e: e[1], reverse=True)
-                longest_cut = max_len_per_pos[0]
-                if longest_cut[1] > 1:  # further split only if the length of the longest match > 1 in length
-                    split[idx] = longest_cut
-                    # logging.debug("\t cut at %s" % str(longest_cut))
+        if 2 < s.get_len() < 2 * size and not long_pat.matching_pattern(s.pattern):
+            # the longest match with popular patterns starting at each idx from the beginning to one before last
+            # of the short segment, a match of length 1 being always assumed; the earliest of the longest is kept
+            longest_cut = (s.begin, 1)
+            for pos, l in enumerate(long_pat.longest_match(paris_id, ids, s.begin, s.end)[:-1], s.begin):
+                if l > longest_cut[1]:
+                    longest_cut = (pos, l)
+            if longest_cut[1] > 1:  # further split only if the length of the longest match > 1 in length
+                split[idx] = longest_cut
 
     # split the segments
     for idx, s in enumerate(seg):
@@ -627,41 +1030,41 @@ def ip_path_change_split(paris_id, paths, size):
             if cut_begin == s.begin:
                 split_seg.append(PatternSegment(begin=cut_begin,
                                                 end=cut_end,
-                                                pattern=IpForwardingPattern(size,
-                                                                            paris_id[cut_begin:cut_end + 1],
-                                                                            paths[cut_begin:cut_end + 1])))
+                                                pattern=IpForwardingPattern.of_ids(size, table,
+                                                                                   paris_id[cut_begin:cut_end + 1],
+                                                                                   ids[cut_begin:cut_end + 1])))
                 split_seg.append(PatternSegment(begin=cut_end + 1,
                                                 end=s.end,
-                                                pattern=IpForwardingPattern(size,
-                                                                            paris_id[cut_end + 1:s.end + 1],
-                                                                            paths[cut_end + 1:s.end + 1])))
+                                                pattern=IpForwardingPattern.of_ids(size, table,
+                                                                                   paris_id[cut_end + 1:s.end + 1],
+                                                                                   ids[cut_end + 1:s.end + 1])))
             elif cut_begin > s.begin and cut_end < s.end:
                 split_seg.append(PatternSegment(begin=s.begin,
                                                 end=cut_begin - 1,
-                                                pattern=IpForwardingPattern(size,
-                                                                            paris_id[s.begin:cut_begin],
-                                                                            paths[s.begin:cut_begin])))
+                                                pattern=IpForwardingPattern.of_ids(size, table,
+                                                                                   paris_id[s.begin:cut_begin],
+                                                                                   ids[s.begin:cut_begin])))
                 split_seg.append(PatternSegment(begin=cut_begin,
                                                 end=cut_end,
-                                                pattern=IpForwardingPattern(size,
-                                                                            paris_id[cut_begin:cut_end + 1],
-                                                                            paths[cut_begin:cut_end + 1])))
+                                                pattern=IpForwardingPattern.of_ids(size, table,
+                                                                                   paris_id[cut_begin:cut_end + 1],
+                                                                                   ids[cut_begin:cut_end + 1])))
                 split_seg.append(PatternSegment(begin=cut_end + 1,
                                                 end=s.end,
-                                                pattern=IpForwardingPattern(size,
-                                                                            paris_id[cut_end + 1:s.end + 1],
-                                                                            paths[cut_end + 1:s.end + 1])))
+                                                pattern=IpForwardingPattern.of_ids(size, table,
+                                                                                   paris_id[cut_end + 1:s.end + 1],
+                                                                                   ids[cut_end + 1:s.end + 1])))
             elif cut_end == s.end:
                 split_seg.append(PatternSegment(begin=s.begin,
                                                 end=cut_begin - 1,
-                                                pattern=IpForwardingPattern(size,
-                                                                            paris_id[s.begin:cut_begin],
-                                                                            paths[s.begin:cut_begin])))
+                                                pattern=IpForwardingPattern.of_ids(size, table,
+                                                                                   paris_id[s.begin:cut_begin],
+                                                                                   ids[s.begin:cut_begin])))
                 split_seg.append(PatternSegment(begin=cut_begin,
                                                 end=cut_end,
-                                                pattern=IpForwardingPattern(size,
-                                                                            paris_id[cut_begin:cut_end + 1],
-                                                                            paths[cut_begin:cut_end + 1])))
+                                                pattern=IpForwardingPattern.of_ids(size, table,
+                                                                                   paris_id[cut_begin:cut_end + 1],
+                                                                                   ids[cut_begin:cut_end + 1])))
         else:
             split_seg.append(s)
 
@@ -676,20 +1079,17 @@ def ip_path_change_split(paris_id, paths, size):
         if s.get_len() < 2 * size or next_s.get_len() < 2 * size:
             # if the neighbouring seg matches with each other then test if merged seg matches with popular pattern
             if s.pattern.is_match_pattern(next_s.pattern):
-                merge_pat = IpForwardingPattern(size, paris_id[s.begin:next_s.end+1], paths[s.begin:next_s.end+1])
-                any_match = False
-                for lp in long_pat:
-                    if lp.is_match_pattern(merge_pat):
-                        any_match = True
-                        break
-                if any_match:
+                merge_pat = IpForwardingPattern.of_ids(size, table, paris_id[s.begin:next_s.end+1],
+                                                       ids[s.begin:next_s.end+1])
+                if long_pat.matching_pattern(merge_pat):
                     merge[idx] = PatternSegment(begin=s.begin, end=next_s.end, pattern=merge_pat)
 
     # in general consecutive merge, e.g. 1 merge 2 and 2 merge 3,  is not possible
     # log it when happens
     for i in merge:
         if i+1 in merge:
-            logging.error("IP change split: consecutive merge possible: %r, %r" % (paris_id, paths))
+            logging.error("IP change split: consecutive merge possible: %r, %r" %
+                          (paris_id, [table.path(path_id) for path_id in ids]))
             return split_seg
 
     mg_seg = []
@@ -698,9 +1098,34 @@ def ip_path_change_split(paris_id, paths, size):
             mg_seg.append(merge[idx])
         elif idx not in merge and idx-1 not in merge:
             mg_seg.append(seg)
+    assert _is_partition(mg_seg, len(ids))
     return mg_seg
 
 
+def ip_path_changes(paris_id, paths, size=16):
+    """ segment a sequence of paths with the three IFP change detection methods at once
+
+    Paths are interned once; backward extension starts from the simple segmentation and split from the backward
+    extension, instead of each method redoing the ones it builds upon.
+
+    Args:
+        paris_id (list of int): Paris ID used when tracerouting
+        paths (list of path): path is composed of ip hops
+        size (int): number of different paris_ids
+
+    Returns:
+        dict: simple, bck_ext and split to list of PatternSegment,
+        as ip_path_change_simple(), ip_path_change_bck_ext() and ip_path_change_split() return
+    """
+    assert (len(paris_id) == len(paths))
+    table = IpPathTable()
+    ids = table.intern_all(paths)
+    simple = _ip_path_change_simple(paris_id, ids, size, table)
+    bck_ext = _backward_extension(simple, paris_id, ids, size, table)
+    split = _split_merge(bck_ext, paris_id, ids, size, table)
+    return dict(simple=simple, bck_ext=bck_ext, split=split)
+
+
 def ifp_change(seg, seq_len):
     """ mark the idx at which IpForwardingPattern changes, i.e. the beginning of a new segment
 
@@ -716,3 +1141,195 @@ def ifp_change(seg, seq_len):
         for s in seg[1:]:
             change[s.begin] = 1
     return change
+
+
+class IfpChangeDetector(object):
+    """IfpChangeDetector detects IFP changes online, as traceroutes are appended to the history of a probe
+
+    It gives the changes ip_path_change_simple() or ip_path_change_bck_ext() find in the whole history,
+    at a cost proportional to the traceroutes appended. Only the current segment of the simple segmentation and the one
+    before are kept: their pattern and the last position of each paris id in them, which is all backward extension
+    needs, see _extension(). The state is thus bounded whatever the length of the history, and can be saved between
+    runs with state() and from_state().
+
+    With simple method, a change is final as soon as the traceroute beginning the new segment arrives.
+    Backward extension moves the beginning of a segment once the next one is over; with bck_ext method,
+    the change at the beginning of a segment is thus final once the segment after it is over, see pending().
+
+    Attributes:
+        size (int): number of different paris id
+        method (string): simple or bck_ext
+        count (int): number of traceroutes ingested, i.e. the index of the next one in the history
+    """
+    METHODS = ('simple', 'bck_ext')
+
+    def __init__(self, size=16, method='bck_ext'):
+        """
+        Args:
+            size (int): number of different paris id, in the case of RIPE Atlas, it is 16
+            method (string): see IfpChangeDetector
+        """
+        if method not in self.METHODS:
+            raise ValueError("Unknown IFP change detection method %r" % method)
+        self.size = size
+        self.method = method
+        self.count = 0
+        self._prev = None  # segment before the current one, see _segment()
+        self._cur = None  # current segment
+
+    def _segment(self, begin):
+        """ a new segment of the simple segmentation
+
+        Returns:
+            dict: begin, end: first and last index of the segment;
+            pattern: path taken by each paris id, None if unknown, paths being tuples of hops;
+            last: last index of each paris id with a path in the segment, -1 if none;
+            last_none: last index without path in the segment, -1 if none;
+            moved: the beginning of the segment after backward extension
+        """
+        return dict(begin=begin, end=begin, pattern=[None] * self.size, last=[-1] * self.size, last_none=-1,
+                    moved=begin)
+
+    def update(self, paris_id, path):
+        """ ingest the next traceroute
+
+        Args:
+            paris_id (int): Paris ID used when tracerouting
+            path (path): path composed of ip hops, None if missing
+
+        Returns:
+            list of int: indexes in the history of the changes that became final
+        """
+        key = None if path is None else (tuple(path) if isinstance(path, list) else path)
+        idx = self.count
+        self.count += 1
+        changes = []
+        if self._cur is None:
+            self._cur = self._segment(idx)
+        else:
+            known = self._cur['pattern'][paris_id]
+            if known is not None and known != key:
+                # not compatible with the current segment, which is over
+                changes = self._close(idx)
+        cur = self._cur
+        if cur['pattern'][paris_id] is None:
+            cur['pattern'][paris_id] = key
+        if key is None:
+            cur['last_none'] = idx
+        else:
+            cur['last'][paris_id] = idx
+        cur['end'] = idx
+        return changes
+
+    def extend(self, paris_id, paths):
+        """ ingest traceroutes in order, see update()
+
+        Args:
+            paris_id (list of int): Paris ID used when tracerouting
+            paths (list of path): path is composed of ip hops
+
+        Returns:
+            list of int: indexes in the history of the changes that became final
+        """
+        assert (len(paris_id) == len(paths))
+        changes = []
+        for pid, path in zip(paris_id, paths):
+            changes.extend(self.update(pid, path))
+        return changes
+
+    def _extension(self, prev, cur):
+        """ beginning of cur once backwardly extended over prev, see ip_path_change_bck_ext()
+
+        The pattern of cur being complete, the extension stops at the last traceroute of prev that takes a path
+        other than the one of its paris id in cur; traceroutes of a paris id in prev all take the same path.
+        prev is taken as it stands after its own extension: the traceroutes it took over follow its pattern,
+        they thus stop the extension only if those of prev itself do.
+
+        Returns:
+            int, prev['moved'] if cur takes all of prev; None if cur is not extended
+        """
+        cur_len = cur['end'] - cur['begin'] + 1
+        if None in cur['pattern'] or cur_len < 2 * self.size or cur_len <= prev['end'] - prev['moved'] + 1:
+            return None
+        stop = prev['last_none']
+        for pid, (path, cur_path) in enumerate(zip(prev['pattern'], cur['pattern'])):
+            if path is not None and path != cur_path:
+                stop = max(stop, prev['last'][pid])
+        if stop >= prev['end']:
+            return None
+        return max(stop + 1, prev['moved'])
+
+    def _close(self, begin):
+        """ end the current segment, a new one beginning at begin
+
+        Returns:
+            list of int: changes that became final
+        """
+        prev, cur = self._prev, self._cur
+        changes = []
+        if self.method == 'simple':
+            changes.append(begin)
+        elif prev is not None:
+            moved = self._extension(prev, cur)
+            if moved is not None:
+                cur['moved'] = moved
+            # the first segment of the history begins no change, nor does a segment cur takes all of
+            if 0 < prev['moved'] < cur['moved']:
+                changes.append(prev['moved'])
+        self._prev, self._cur = cur, self._segment(begin)
+        return changes
+
+    def pending(self):
+        """ changes not yet final, as they would be if the history ended now
+
+        Returns:
+            list of int: indexes in the history
+        """
+        prev, cur = self._prev, self._cur
+        if self.method == 'simple' or cur is None:
+            return []
+        changes = []
+        moved = None if prev is None else self._extension(prev, cur)
+        moved = cur['begin'] if moved is None else moved
+        if prev is not None and 0 < prev['moved'] < moved:
+            changes.append(prev['moved'])
+        if moved > 0:
+            changes.append(moved)
+        return changes
+
+    def state(self):
+        """ the state of the detector, to be saved between runs, e.g. with json
+
+        Returns:
+            dict, see from_state()
+        """
+        segments = []
+        for s in (self._prev, self._cur):
+            if s is not None:
+                s = dict(s)
+                s['pattern'] = [None if p is None else (list(p) if isinstance(p, tuple) else p) for p in s['pattern']]
+                s['last'] = list(s['last'])
+            segments.append(s)
+        return dict(size=self.size, method=self.method, count=self.count, segments=segments)
+
+    @classmethod
+    def from_state(cls, state):
+        """ a detector resuming from a state given by state()
+
+        Args:
+            state (dict)
+
+        Returns:
+            IfpChangeDetector
+        """
+        detector = cls(state['size'], state['method'])
+        detector.count = state['count']
+        segments = []
+        for s in state['segments']:
+            if s is not None:
+                s = dict(s)
+                s['pattern'] = [tuple(p) if isinstance(p, list) else p for p in s['pattern']]
+                s['last'] = list(s['last'])
+            segments.append(s)
+        detector._prev, detector._cur = segments
+        return detector
@@ -0,0 +1,100 @@
+"""
+planner.py cuts probes into chunks of roughly equal amount of measurements
+"""
+import heapq
+import math
+
+# interval in seconds of Atlas built-in measurements
+# https://atlas.ripe.net/docs/built-in/
+INTERVAL = {1010: 240, 2010: 240, 5010: 1800, 6010: 1800}
+DEFAULT_INTERVAL = 1800
+
+
+def estimate_volume(probes, start, end, msm_ids, first_connected=None, history=None):
+    """ estimate the number of measurements each probe produces within a time window
+
+    For each measurement, the rate observed in past runs is used when known,
+    otherwise one measurement per interval since the probe is first connected.
+
+    Args:
+        probes (list of int): probe ids
+        start (int): epoch time for the beginning of observation window
+        end (int): epoch time for the end of observation window
+        msm_ids (list of int): measurements to be collected for these probes
+        first_connected (dict): probe id (int) to epoch time of first connection, None if unknown
+        history (dict): msm id (int) to dict, probe id (int) to (start, end, chunk id, count) recorded in manifest
+
+    Returns:
+        dict: probe id (int) to expected number of measurements (float), summed over all the measurement ids
+    """
+    first_connected = first_connected if first_connected else dict()
+    history = history if history else dict()
+    volume = dict()
+    for pb in probes:
+        fc = first_connected.get(pb)
+        active = max(end - max(start, fc if fc is not None else start), 0)
+        vol = 0.
+        for msm in msm_ids:
+            past = history.get(msm, dict()).get(pb)
+            if past is not None and len(past) > 3 and past[1] > past[0]:
+                vol += float(past[3]) / (past[1] - past[0]) * (end - start)
+            else:
+                vol += float(active) / INTERVAL.get(msm, DEFAULT_INTERVAL)
+        volume[pb] = vol
+    return volume
+
+
+def plan_chunks(volume, chunk_size=20, fixed=None):
+    """ assign probes to chunks so that chunks hold roughly the same amount of measurements
+
+    Probes are taken from the largest volume to the smallest, each is put into the chunk with least volume
+    so far (longest processing time first). A chunk takes at most 2 * chunk_size probes.
+
+    Args:
+        volume (dict): probe id (int) to expected volume, see estimate_volume()
+        chunk_size (int): average number of probes per chunk, sets the number of chunks
+        fixed (dict): probe id (int) to chunk id of a previous plan; kept as is for probes still in volume
+
+    Returns:
+        list of list of int: probe ids of each chunk, the index being the chunk id
+    """
+    fixed = {pb: ck for pb, ck in (fixed if fixed else dict()).items() if pb in volume}
+    chunk_count = int(math.ceil(len(volume) / float(chunk_size)))
+    if fixed:
+        chunk_count = max(chunk_count, max(fixed.values()) + 1)
+    chunks = [[] for _ in xrange(chunk_count)]
+    load = [0.] * chunk_count
+    for pb, ck in fixed.items():
+        chunks[ck].append(pb)
+        load[ck] += volume[pb]
+    heap = [(load[ck], ck) for ck in xrange(chunk_count) if len(chunks[ck]) < 2 * chunk_size]
+    heapq.heapify(heap)
+    for pb in sorted([i for i in volume if i not in fixed], key=lambda i: (-volume[i], i)):
+        if not heap:  # all the chunks are full
+            chunks.append([])
+            load.append(0.)
+            heap.append((0., len(chunks) - 1))
+        vol, ck = heapq.heappop(heap)
+        chunks[ck].append(pb)
+        load[ck] = vol + volume[pb]
+        if len(chunks[ck]) < 2 * chunk_size:
+            heapq.heappush(heap, (load[ck], ck))
+    return [sorted(c) for c in chunks]
+
+
+def read_chunk_index(f):
+    """ read a probe to chunk id indexing file
+
+    Args:
+        f (string): path to probe to chunk id indexing file, e.g. data/pb_chunk_index_v4.csv
+
+    Returns:
+        dict: probe id (int) to chunk id (int)
+    """
+    index = dict()
+    with open(f, 'r') as fp:
+        for idx, line in enumerate(fp):
+            if idx > 0 and line.strip():
+                pb, ck = line.split(';')
+                index[int(pb)] = int(ck)
+    return index
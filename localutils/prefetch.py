@@ -0,0 +1,277 @@
+"""
+prefetch.py reads the next chunks in a background thread while the current ones are processed
+"""
+from chunkfile import ChunkReader, ChunkError
+import ConfigParser
+import threading
+import logging
+import os
+
+# number of chunks read ahead of the one being processed
+DEFAULT_DEPTH = 2
+# bytes of chunks held in memory at once by a loader, the one being processed included
+DEFAULT_MAX_BYTES = 512 << 20
+# bytes read at once when reading a file ahead
+READ_BLOCK = 1 << 20
+
+
+def read_chunk(fn):
+    """ default loader: read an entire chunk file into memory, see chunkfile.ChunkReader """
+    return ChunkReader(fn, preload=True)
+
+
+def load_item(item, load=read_chunk, errors=(IOError, ChunkError)):
+    """ load an item in a pool worker the way ChunkLoader does
+
+    Args:
+        item: e.g. path to a chunk file
+        load (callable): see ChunkLoader
+        errors (tuple of Exception): errors logged instead of raised
+
+    Returns:
+        loaded value, None if an expected error is raised
+    """
+    try:
+        return load(item)
+    except errors as e:
+        logging.error("loading %s failed: %s" % (item, e))
+        return None
+
+
+def read_ahead(item):
+    """ read file(s) through without keeping them, so that they are in the page cache once opened by a worker
+
+    Args:
+        item (string or tuple of string): path(s) to file(s); missing files are left to the worker to report
+    """
+    for fn in item if isinstance(item, (tuple, list)) else [item]:
+        try:
+            with open(fn, 'rb') as fp:
+                while fp.read(READ_BLOCK):
+                    pass
+        except IOError:
+            pass
+
+
+def file_size(item):
+    """ expected memory footprint of an item, the size on disk of the file(s) it names
+
+    Args:
+        item (string or tuple of string): path(s) to file(s)
+
+    Returns:
+        int: bytes, 0 for missing files
+    """
+    if isinstance(item, (tuple, list)):
+        return sum([file_size(i) for i in item])
+    try:
+        return os.path.getsize(item)
+    except OSError:
+        return 0
+
+
+def read_config(config):
+    """ read the optional [prefetch] section of the project config
+
+    [prefetch]
+    depth = 2
+    memory = 512
+
+    Args:
+        config (ConfigParser.ConfigParser)
+
+    Returns:
+        (int, int): read-ahead depth, memory cap in bytes
+    """
+    depth = DEFAULT_DEPTH
+    max_bytes = DEFAULT_MAX_BYTES
+    try:
+        depth = config.getint("prefetch", "depth")
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    except ValueError:
+        logging.warning("prefetch depth is not an integer, %d used." % depth)
+    try:
+        max_bytes = config.getint("prefetch", "memory") << 20
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+    except ValueError:
+        logging.warning("prefetch memory is not an integer, %d MB used." % (max_bytes >> 20))
+    return depth, max_bytes
+
+
+class ChunkLoader:
+    """ ChunkLoader iterates over (item, loaded value) in order, loading the next items in a background thread
+
+    Loading, e.g. reading a chunk file from a network mounted repository, thus overlaps with the processing
+    of the current item. An item is considered processed once the next one is asked for.
+
+    Expected errors raised by the loader are logged and the item is given with None;
+    any other error is raised to the consumer when it reaches the item.
+
+    Attributes:
+        depth (int): maximum number of items loaded ahead of the one being processed
+        max_bytes (int): maximum size of items held at once, the one being processed included;
+        an item larger than that is still loaded, alone
+    """
+    def __init__(self, items, load=read_chunk, depth=DEFAULT_DEPTH, max_bytes=DEFAULT_MAX_BYTES,
+                 size=file_size, errors=(IOError, ChunkError)):
+        """ start loading in background
+
+        Args:
+            items (list): e.g. paths to chunk files
+            load (callable): item to loaded value, chunkfile.ChunkReader with the file read into memory by default;
+            a value with a close() method is closed once processed
+            depth (int): see ChunkLoader
+            max_bytes (int): see ChunkLoader
+            size (callable): item to its expected memory footprint in bytes, size on disk by default
+            errors (tuple of Exception): errors logged instead of raised
+        """
+        self.depth = max(0, depth)
+        self.max_bytes = max_bytes
+        self._items = list(items)
+        self._load = load
+        self._size = size
+        self._errors = errors
+        self._ready = dict()  # index to (value, exception, size)
+        self._held = 0  # bytes of loaded items not yet processed
+        self._next = 0  # index of the next item to be given to the consumer
+        self._current = None  # (value, size) of the item being processed
+        self._stop = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='ChunkLoader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        for i, item in enumerate(self._items):
+            value = exc = None
+            try:
+                size = self._size(item)
+            except Exception as e:
+                size, exc = 0, e
+            with self._cond:
+                # wait until the item is within depth and fits in memory; always load when nothing is held
+                while not self._stop and (i >= self._next + self.depth or
+                                          (self._held and self._held + size > self.max_bytes)):
+                    self._cond.wait()
+                if self._stop:
+                    return
+                self._held += size
+            try:
+                if exc is None:
+                    value = self._load(item)
+            except self._errors as e:
+                logging.error("loading %s failed: %s" % (item, e))
+            except Exception as e:
+                exc = e
+            with self._cond:
+                self._ready[i] = (value, exc, size)
+                self._cond.notify_all()
+
+    def _release(self):
+        """ free the item being processed """
+        if self._current is None:
+            return
+        value, size = self._current
+        self._current = None
+        if hasattr(value, 'close'):
+            value.close()
+        with self._cond:
+            self._held -= size
+            self._cond.notify_all()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self._release()
+        if self._next >= len(self._items):
+            raise StopIteration
+        i = self._next
+        with self._cond:
+            self._next += 1
+            self._cond.notify_all()
+            while i not in self._ready:
+                self._cond.wait()
+            value, exc, size = self._ready.pop(i)
+        self._current = (value, size)
+        if exc is not None:
+            raise exc
+        return self._items[i], value
+
+    def close(self):
+        """ stop loading, close the items loaded but not processed """
+        self._release()
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join()
+        for value, _, _ in self._ready.values():
+            if hasattr(value, 'close'):
+                value.close()
+        self._ready = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TaskFeed:
+    """ TaskFeed feeds a multiprocessing pool with one task per chunk, the chunks of the next tasks being read into
+    the page cache by a ChunkLoader in a background thread
+
+    With Pool.imap_unordered() and chunksize=1, each chunk goes to the first worker free, whatever the time taken
+    by the chunks before. The pool however takes in its tasks as fast as they are given: the feed holds a task back
+    as long as window tasks are dispatched and unfinished, done() being called for each result. Chunks are thus
+    read ahead of the workers by depth chunks at most, and are still in the page cache once opened.
+
+        with pf.TaskFeed(files, processes) as feed:
+            for res in pool.imap_unordered(worker, feed, chunksize=1):
+                feed.done()
+
+    Attributes:
+        window (int): maximum number of tasks dispatched and unfinished, e.g. the number of workers
+        depth (int): maximum number of chunks read ahead of the tasks dispatched
+        max_bytes (int): maximum size of chunks read ahead, see ChunkLoader
+    """
+    def __init__(self, items, window, depth=DEFAULT_DEPTH, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Args:
+            items (list): e.g. paths to chunk files, or tuples of paths to the files of a task
+            window (int): see TaskFeed
+            depth (int): see TaskFeed
+            max_bytes (int): see TaskFeed
+        """
+        self.window = max(1, window)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._items = list(items)
+        self._slots = threading.Semaphore(self.window)
+        self._stop = False
+
+    def __iter__(self):
+        # run by the task handler thread of the pool
+        with ChunkLoader(self._items, load=read_ahead, depth=self.depth, max_bytes=self.max_bytes) as loader:
+            for item, _ in loader:
+                self._slots.acquire()
+                if self._stop:
+                    return
+                yield item
+
+    def done(self):
+        """ to be called once per result, letting the next task in """
+        self._slots.release()
+
+    def close(self):
+        """ stop feeding tasks, e.g. when a worker failed """
+        self._stop = True
+        self._slots.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
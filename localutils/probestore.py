@@ -0,0 +1,278 @@
+"""
+probestore.py keeps the meta data of Atlas probes in a binary cache refreshed incrementally from the Atlas API
+"""
+from atlas import probe_tuple
+from misc import read_probe
+import numpy as np
+import logging
+import socket
+import struct
+import json
+import time
+import os
+
+MAGIC = 'RTTPROB1'
+# name of the cache file in data/
+CACHE = 'pb.cache'
+# a complete listing of probes is fetched if the last one is older than that, in sec
+FULL_REFRESH_AGE = 86400
+# the probes of interest: v3 probes and anchors, see atlas.get_pb()
+SELECTIONS = (dict(tags='system-v3'), dict(is_anchor='true'))
+# one row per probe; addresses and prefixes are stored in network byte order along with the prefix length,
+# -1 for None in numbers, tags is a bitmask over the tag table
+ROW = np.dtype([('id', '<i4'), ('address_v4', 'V4'), ('prefix_v4', 'V4'), ('prefix_len_v4', 'i1'), ('asn_v4', '<i8'),
+                ('address_v6', 'V16'), ('prefix_v6', 'V16'), ('prefix_len_v6', 'i1'), ('asn_v6', '<i8'),
+                ('is_anchor', '?'), ('has', 'u1'), ('country_code', 'S2'), ('first_connected', '<i8'),
+                ('tags', '<u8')])
+# bits of the has column, set if the value is not None
+HAS = {'address_v4': 1, 'prefix_v4': 2, 'address_v6': 4, 'prefix_v6': 8}
+_FAMILY = {4: socket.AF_INET, 6: socket.AF_INET6}
+_HEADER_LEN = struct.Struct('<I')
+
+
+class ProbeStore:
+    """ ProbeStore holds probe meta data as a numpy array sorted by probe id
+
+    Probes are handled as tuples in the format of atlas.get_pb():
+    (id, address_v4, prefix_v4, asn_v4, address_v6, prefix_v6, asn_v6, is_anchor, country_code, first_connected,
+    system_tags)
+
+    Attributes:
+        fn (string): path to the cache file
+        tags (list of string): i-th tag is the i-th bit in the tags column
+        full_refresh (int): epoch time of the last complete listing from the API, 0 if never
+    """
+    def __init__(self, fn=None):
+        """ load the cache file if it exists, otherwise start empty
+
+        Args:
+            fn (string): path to the cache file, normally data/pb.cache
+        """
+        self.fn = fn
+        self.tags = []
+        self.full_refresh = 0
+        self._rows = np.zeros(0, dtype=ROW)
+        if fn and os.path.isfile(fn):
+            try:
+                self._load(fn)
+            except (ValueError, struct.error) as e:
+                logging.warning("decoding %s failed, starting with an empty probe store: %s" % (fn, e))
+                self._rows = np.zeros(0, dtype=ROW)
+
+    def _load(self, fn):
+        with open(fn, 'rb') as fp:
+            data = fp.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("not a probe cache")
+        length, = _HEADER_LEN.unpack_from(data, len(MAGIC))
+        start = len(MAGIC) + _HEADER_LEN.size
+        header = json.loads(data[start:start + length])
+        self.tags = [str(i) for i in header['tags']]
+        self.full_refresh = header['full_refresh']
+        self._rows = np.frombuffer(data, dtype=ROW, count=header['count'], offset=start + length).copy()
+
+    def save(self, fn=None):
+        """ write the cache file; the file is replaced atomically so that an interruption never corrupts it """
+        fn = fn if fn else self.fn
+        header = json.dumps(dict(tags=self.tags, full_refresh=self.full_refresh, count=len(self._rows)))
+        with open(fn + '.tmp', 'wb') as fp:
+            fp.write(MAGIC)
+            fp.write(_HEADER_LEN.pack(len(header)))
+            fp.write(header)
+            fp.write(self._rows.tostring())
+        os.rename(fn + '.tmp', fn)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, pb):
+        return self._find(pb) is not None
+
+    def _find(self, pb):
+        i = np.searchsorted(self._rows['id'], pb)
+        if i < len(self._rows) and self._rows['id'][i] == pb:
+            return i
+        return None
+
+    def _encode(self, probe):
+        """ turn a probe tuple into a row """
+        if len(probe) == 10:  # pb.csv written before first_connected was recorded
+            probe = probe[:9] + (None,) + probe[9:]
+        pid, a4, p4, asn4, a6, p6, asn6, anchor, cc, fc, tags = probe
+        mask = 0
+        for t in tags:
+            if t not in self.tags:
+                if len(self.tags) == 64:
+                    raise ValueError("more than 64 distinct system tags")
+                self.tags.append(str(t))
+            mask |= 1 << self.tags.index(t)
+        has = 0
+        packed = dict()
+        for af, addr, pref in ((4, a4, p4), (6, a6, p6)):
+            size = 4 if af == 4 else 16
+            packed[af] = ['\0' * size, '\0' * size, -1]
+            for k, (name, v) in enumerate((('address_v%d' % af, addr), ('prefix_v%d' % af, pref))):
+                if v is None:
+                    continue
+                try:
+                    if k == 1:
+                        v, packed[af][2] = str(v).split('/')
+                    packed[af][k] = socket.inet_pton(_FAMILY[af], str(v))
+                    has |= HAS[name]
+                except (socket.error, ValueError):
+                    logging.warning("Probe %d has invalid %s %s, taken as None." % (pid, name, v))
+        return (pid, packed[4][0], packed[4][1], int(packed[4][2]), -1 if asn4 is None else asn4,
+                packed[6][0], packed[6][1], int(packed[6][2]), -1 if asn6 is None else asn6,
+                bool(anchor), has, '' if cc is None else str(cc), -1 if fc is None else fc, mask)
+
+    def _decode(self, row):
+        """ turn a row into a probe tuple """
+        pid, a4, p4, l4, asn4, a6, p6, l6, asn6, anchor, has, cc, fc, mask = row.tolist()
+        addr = dict()
+        for name, v in (('address_v4', a4), ('prefix_v4', p4), ('address_v6', a6), ('prefix_v6', p6)):
+            addr[name] = socket.inet_ntop(_FAMILY[int(name[-1])], str(v)) if has & HAS[name] else None
+        for name, length in (('prefix_v4', l4), ('prefix_v6', l6)):
+            if addr[name] is not None:
+                addr[name] = '%s/%d' % (addr[name], length)
+        tags = tuple([t for i, t in enumerate(self.tags) if mask >> i & 1])
+        return (pid, addr['address_v4'], addr['prefix_v4'], None if asn4 == -1 else asn4,
+                addr['address_v6'], addr['prefix_v6'], None if asn6 == -1 else asn6,
+                anchor, cc or None, None if fc == -1 else fc, tags)
+
+    def get(self, pb):
+        """ meta data of a probe
+
+        Args:
+            pb (int): probe id
+
+        Returns:
+            tuple, see ProbeStore; None if the probe is unknown
+        """
+        i = self._find(pb)
+        return None if i is None else self._decode(self._rows[i])
+
+    def merge(self, probes):
+        """ add new probes and update the changed ones
+
+        Args:
+            probes (iterable of tuple): probe tuples, e.g. returned by atlas.get_pb() or misc.read_probe()
+
+        Returns:
+            (int, int): number of new probes, number of changed probes
+        """
+        index = {pid: i for i, pid in enumerate(self._rows['id'].tolist())}
+        new = dict()
+        changed = dict()
+        for probe in probes:
+            row = self._encode(probe)
+            i = index.get(row[0])
+            if i is None:
+                new[row[0]] = row
+            elif self._rows[i].tostring() != np.array([row], dtype=ROW).tostring():
+                changed[i] = row
+        for i, row in changed.items():
+            self._rows[i] = row
+        if new:
+            self._rows = np.concatenate((self._rows, np.array(new.values(), dtype=ROW)))
+            self._rows.sort(order='id')
+        return len(new), len(changed)
+
+    def refresh(self, fetcher, max_age=FULL_REFRESH_AGE, selections=SELECTIONS):
+        """ update the store from the Atlas API
+
+        Only the probes newer than the last known one are listed, unless the last complete listing is older
+        than max_age; in either case only new and changed probes are merged.
+
+        Args:
+            fetcher (fetcher.AtlasFetcher): queries the Atlas API or a local stand-in
+            max_age (int): seconds; 0 forces a complete listing
+            selections (tuple of dict): filters of the probe API selecting the probes of interest
+
+        Returns:
+            (int, int): number of new probes, number of changed probes
+
+        Raises:
+            fetcher.FetchError: if the listing failed, the store is then left untouched
+        """
+        now = int(time.time())
+        full = not len(self._rows) or now - self.full_refresh >= max_age
+        probes = []
+        for filters in selections:
+            filters = dict(filters)
+            if not full:
+                filters['id__gt'] = int(self._rows['id'][-1])
+            probes.extend([probe_tuple(pb) for pb in fetcher.probes(**filters)])
+        res = self.merge(probes)
+        if full:
+            self.full_refresh = now
+        logging.info("%s probe listing: %d new and %d changed probes." % ('Complete' if full else 'Incremental',
+                                                                           res[0], res[1]))
+        return res
+
+    def select(self, date=None):
+        """ probes connected for the first time before a given date, as atlas.get_pb() does
+
+        Args:
+            date (int): sec since epoch; None to select all probes
+
+        Returns:
+            numpy.array of bool, a mask over the probes of the store
+        """
+        if date is None:
+            return np.ones(len(self._rows), dtype=bool)
+        fc = self._rows['first_connected']
+        return (fc == -1) | (fc <= date)
+
+    def tagged(self, tag):
+        """ probes with a given system tag, e.g. system-ipv4-works
+
+        Returns:
+            numpy.array of bool, a mask over the probes of the store
+        """
+        if tag not in self.tags:
+            return np.zeros(len(self._rows), dtype=bool)
+        return (self._rows['tags'] >> np.uint64(self.tags.index(tag))) & np.uint64(1) > 0
+
+    def has_network(self, af):
+        """ probes with both a prefix and an ASN for an address family
+
+        Args:
+            af (int): 4 or 6
+
+        Returns:
+            numpy.array of bool, a mask over the probes of the store
+        """
+        return (self._rows['has'] & HAS['prefix_v%d' % af] > 0) & (self._rows['asn_v%d' % af] != -1)
+
+    def ids(self, mask=None):
+        """ ids of the probes selected by a mask, all the probes if not given
+
+        Returns:
+            list of int
+        """
+        return self._rows['id'].tolist() if mask is None else self._rows['id'][mask].tolist()
+
+    def records(self, mask=None):
+        """ probe tuples selected by a mask, all the probes if not given
+
+        Returns:
+            list of tuple, same format as atlas.get_pb()
+        """
+        rows = self._rows if mask is None else self._rows[mask]
+        return [self._decode(row) for row in rows]
+
+
+def load_store(data_dir):
+    """ load the probe store of a data directory, built from pb.csv if the cache file is missing
+
+    Args:
+        data_dir (string): where pb.cache and pb.csv are stored
+
+    Returns:
+        ProbeStore
+    """
+    store = ProbeStore(os.path.join(data_dir, CACHE))
+    if not len(store) and os.path.isfile(os.path.join(data_dir, 'pb.csv')):
+        store.merge(read_probe(os.path.join(data_dir, 'pb.csv')))
+        store.save()
+    return store
@@ -0,0 +1,135 @@
+"""
+snapshot.py compiles databases read from text files into binary snapshot files that processes map read-only
+"""
+import numpy as np
+import logging
+import struct
+import json
+import mmap
+import os
+
+# a snapshot file is MAGIC, the length of the json header, the header, then the arrays aligned to ALIGN bytes
+MAGIC = 'RTTSNAP1'
+EXT = '.snap'
+ALIGN = 16
+_HEADER_LEN = struct.Struct('<I')
+
+
+def stamp(sources):
+    """ identify the version of source files by their name, size and modification time
+
+    Args:
+        sources (list of string): paths to source files
+
+    Returns:
+        list of list: [name, size, mtime] for each source, size and mtime are None if the file is missing
+    """
+    res = []
+    for fn in sources:
+        try:
+            st = os.stat(fn)
+            res.append([os.path.basename(fn), st.st_size, st.st_mtime])
+        except OSError:
+            res.append([os.path.basename(fn), None, None])
+    return res
+
+
+def write(fn, kind, source_stamp, arrays):
+    """ write arrays to a snapshot file; the file is replaced atomically so that readers never see a partial one
+
+    Args:
+        fn (string): path to the snapshot file
+        kind (string): what the snapshot holds, with a version, e.g. 'as-rel/1'
+        source_stamp (list): see stamp()
+        arrays (dict): name (string) to numpy.array
+    """
+    specs = dict()
+    offset = 0
+    for name in sorted(arrays):
+        arr = np.ascontiguousarray(arrays[name])
+        arrays[name] = arr
+        specs[name] = [arr.dtype.str, list(arr.shape), offset]
+        offset += -(-arr.nbytes // ALIGN) * ALIGN
+    header = json.dumps(dict(kind=kind, stamp=source_stamp, arrays=specs))
+    start = -(-(len(MAGIC) + _HEADER_LEN.size + len(header)) // ALIGN) * ALIGN
+    tmp = '%s.%d.tmp' % (fn, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(_HEADER_LEN.pack(len(header)))
+        fp.write(header)
+        for name in sorted(arrays):
+            fp.seek(start + specs[name][2])
+            fp.write(arrays[name].tostring())
+        fp.truncate(start + offset)
+    os.rename(tmp, fn)
+
+
+def read(fn, kind=None, source_stamp=None):
+    """ map a snapshot file read-only
+
+    Args:
+        fn (string): path to the snapshot file
+        kind (string): expected kind, see write(); not checked if None
+        source_stamp (list): expected stamp of the sources, see stamp(); not checked if None
+
+    Returns:
+        dict: name (string) to read-only numpy.array backed by the map; None if the file is missing, broken,
+        of another kind or compiled from other versions of the sources
+    """
+    try:
+        with open(fn, 'rb') as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):  # ValueError for empty files
+        return None
+    try:
+        if mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("not a snapshot")
+        length, = _HEADER_LEN.unpack_from(mm, len(MAGIC))
+        header = json.loads(mm[len(MAGIC) + _HEADER_LEN.size:len(MAGIC) + _HEADER_LEN.size + length])
+        if (kind is not None and header['kind'] != kind) or \
+                (source_stamp is not None and header['stamp'] != json.loads(json.dumps(source_stamp))):
+            mm.close()
+            return None
+        start = -(-(len(MAGIC) + _HEADER_LEN.size + length) // ALIGN) * ALIGN
+        arrays = dict()
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            dtype = np.dtype(str(dtype))
+            count = int(np.prod(shape))
+            arrays[str(name)] = np.frombuffer(mm, dtype=dtype, count=count, offset=start + offset).reshape(shape)
+        return arrays
+    except (ValueError, KeyError, TypeError, struct.error) as e:
+        logging.warning("snapshot %s is broken and ignored: %s" % (fn, e))
+        mm.close()
+        return None
+
+
+def load(fn, kind, sources, compile_func):
+    """ map the snapshot of given source files, compiling it first if it is missing or stale
+
+    The snapshot is compiled once, then every process maps the same file: the pages are shared among
+    the workers of a pool and nothing is parsed at start-up.
+
+    Args:
+        fn (string): path to the snapshot file, normally next to the first source with EXT appended
+        kind (string): see write()
+        sources (list of string): paths to the source files
+        compile_func (callable): returns (dict of numpy.array, bool), the arrays compiled from the sources
+        and whether the sources are read entirely; a partial compilation is used but not saved
+
+    Returns:
+        dict: name (string) to numpy.array, read-only
+    """
+    source_stamp = stamp(sources)
+    arrays = read(fn, kind, source_stamp)
+    if arrays is not None:
+        return arrays
+    arrays, complete = compile_func()
+    if not complete:
+        return arrays
+    try:
+        write(fn, kind, source_stamp, arrays)
+    except (IOError, OSError) as e:
+        logging.warning("snapshot %s can not be written, kept in memory: %s" % (fn, e))
+        return arrays
+    mapped = read(fn, kind, source_stamp)
+    return mapped if mapped is not None else arrays
@@ -85,4 +85,20 @@ def epoch_to_string(epc):
     Returns:
         string, a formatted string for date, time
     """
-    return datetime_to_string(epoch_to_datetime(epc))
\ No newline at end of file
+    return datetime_to_string(epoch_to_datetime(epc))
+
+
+class LazyEpochString:
+    """ LazyEpochString formats seconds since epoch only when converted to string
+
+    Passed as argument to logging calls, the formatting is skipped when the record is not emitted, e.g.
+    logging.debug("measurement at %s", LazyEpochString(1470014924))
+
+    Attributes:
+        epc (int): seconds since epoch
+    """
+    def __init__(self, epc):
+        self.epc = epc
+
+    def __str__(self):
+        return epoch_to_string(self.epc)
@@ -1,109 +1,216 @@
 """
 This script translates IP path to AS path and detect changes in both paths for each probe
 """
-from localutils import pathtools as pt, dbtools as db
+from localutils import pathtools as pt, dbtools as db, chunkfile as cf, probestore as ps
 import localutils.misc as ms
 import logging
 import ConfigParser
 import os
 import multiprocessing
 import traceback
-import itertools
 import json
 import time
 
 
-def path(fn, pb_meta, data_dir, path_alyz_dir):
-    """ for each traceroute json in data, translate ip path to asn path, detect changes both in ip and asn path
+def is_v4_chunk(fn):
+    """ 5010 for ipv4 traceroute, 6010 for ipv6 """
+    return '6010.json' not in fn
+
+
+def probe_addr(pb, pb_meta, is_v4):
+    """ address of a probe, added at the beginning of its ip paths
+
+    Args:
+        pb (int): probe id
+        pb_meta (dict): see path()
+        is_v4 (bool): whether the traceroutes are ipv4 ones
+
+    Returns:
+        string, None if unknown
+    """
+    pb_addr = None
+    # get probe address from metadata
+    if pb in pb_meta:
+        pb_addr = pb_meta[pb][1] if is_v4 else pb_meta[pb][4]
+    return pb_addr
+
+
+def probe_path(fn, pb, rec, pb_addr, is_v4, ips, ip_info):
+    """ translate the ip paths of a probe to asn paths, detect changes both in ip and asn path
+
+    Args:
+        fn (string): name of the output json file, for logging
+        pb (int): probe id
+        rec (dict): epoch, paris_id and path (list of tuple of string) of each traceroute
+        pb_addr (string): probe address, see probe_addr()
+        is_v4 (bool): whether the traceroutes are ipv4 ones, IXPs are only detected in ipv4
+        ips (list of string): hop addresses resolved at once for each version of the routing databases in use
+        ip_info (dict): version, see pt.version_at(), to {address: Addr}; completed with the versions met
+
+    Returns:
+        dict: the analysis of the probe, see docs/path_analysis.md; None if its traceroutes are inconsistent
+    """
+    ip_path_seq_raw = rec.get('path')  # [(address,...),...]
+    ip_path_seq = []  # [address,...]
+    paris_id_seq = rec.get('paris_id')
+    if ip_path_seq_raw is None or paris_id_seq is None:
+        return None
+    if len(paris_id_seq) != len(ip_path_seq_raw):
+        logging.error("%r in %r, path and paris are of unequal length" % (pb, fn))
+        return None
+    asn_path_seq = []
+    # a probe cycles through a few distinct ip paths, each is translated only once
+    translated = dict()
+    in_use = None
+    # translate ip path to asn path
+    for ip_path, epoch in zip(ip_path_seq_raw, rec.get('epoch')):
+        ip_path_seq.append(list(ip_path))
+        # databases valid at the time of the traceroute
+        version = pt.version_at(epoch)
+        if version != in_use:
+            in_use = pt.use_versions_at(epoch)
+        if version not in ip_info:
+            ip_info[version] = dict(zip(ips, pt.get_ip_info_many(ips)))
+        key = (tuple(ip_path), pb_addr, is_v4, version)
+        asn_path = translated.get(key)
+        if asn_path is None:
+            # probe address is added at the beginning if not None, IXP detected for v4 traceroute
+            asn_path = translated[key] = pt.ip_to_asn_path(ip_path, pb_addr, ixp=is_v4, ip_info=ip_info[version])
+        asn_path_seq.append(asn_path)
+    # detect asn path changes
+    asn_path_change = pt.as_path_changes(asn_path_seq, ['as_path_change_cs', 'as_path_change_ixp_cs'])
+    # detect ip forwarding pattern change with three different methods
+    ifp_seg = pt.ip_path_changes(paris_id_seq, ip_path_seq, 16)
+    ifp_change_simple = pt.ifp_change(ifp_seg['simple'], len(paris_id_seq))
+    ifp_change_bck_ext = pt.ifp_change(ifp_seg['bck_ext'], len(paris_id_seq))
+    ifp_change_split = pt.ifp_change(ifp_seg['split'], len(paris_id_seq))
+    return dict(epoch=rec.get('epoch'), paris_id=paris_id_seq,
+                ip_path=ip_path_seq, asn_path=asn_path_seq,
+                ifp_simple=ifp_change_simple,
+                ifp_bck=ifp_change_bck_ext,
+                ifp_split=ifp_change_split,
+                as_path_change=asn_path_change['as_path_change_cs'],
+                as_path_change_ixp=asn_path_change['as_path_change_ixp_cs'])
+
+
+def read_probe(mes, pb):
+    """ traceroutes of a probe in a chunk, as expected by probe_path() """
+    return dict(epoch=mes.column(pb, 'epoch').tolist(), paris_id=mes.paris_id(pb), path=mes.paths(pb))
+
+
+def path(fn, mes, pb_meta, path_alyz_dir):
+    """ for each traceroute chunk in data, translate ip path to asn path, detect changes both in ip and asn path
 
     Args:
-        fn (string): traceroute json file name, e.g. '0_5010.json'
-        pb_meta (dict): probe_id (int) : tuple; initialized form pb.csv
-        data_dir: the directory containing fn
+        fn (string): name of the output json file, e.g. '0_5010.json'
+        mes (chunkfile.ChunkReader): the chunk file 0_5010.col, None if it could not be read
+        pb_meta (dict): probe_id (int) : tuple; initialized form the probe store, see localutils/probestore.py
         path_alyz_dir: the directory in which analysis results shall be stored
 
     """
-    # skip if already done
-    if os.path.exists(os.path.join(path_alyz_dir, fn)):
-        logging.info("%r already treated, thus skipped." % fn)
+    if mes is None:
         return
     t1 = time.time()
-    # 5010 for ipv4 traceroute, 6010 for ipv6
-    is_v4 = True
-    if '6010.json' in fn:
-        is_v4 = False
+    is_v4 = is_v4_chunk(fn)
 
-    with open(os.path.join(data_dir, fn), 'r') as fp:
-        mes = json.load(fp)
+    with mes:
+        records = [(pb, read_probe(mes, pb)) for pb in mes.probes]
+        ips = mes.ip_table.ips
+    # all the hop addresses of the chunk are resolved at once, for each version of the routing databases in use
+    ip_info = dict()
 
     output = dict()
-    for pb, rec in mes.items():
-        pb_addr = None
-        pb = int(pb)
-        # get probe address from metadata
-        if pb in pb_meta:
-            if is_v4:
-                pb_addr = pb_meta[pb][1]
-            else:
-                pd_addr = pb_meta[pb][4]
-        ip_path_seq_raw = rec.get('path')  # [[#hop, address, rtt],...]
-        ip_path_seq = []  # [address,...]
-        paris_id_seq = rec.get('paris_id')
-        if ip_path_seq is not None and paris_id_seq is not None:
-            if len(paris_id_seq) != len(ip_path_seq_raw):
-                logging.error("%r in %r, path and paris are of unequal length" % (pb, fn))
-            else:
-                asn_path_seq = []
-                # translate ip path to asn path
-                for ip_path in ip_path_seq_raw:
-                    # extract the address string
-                    ip_path = [str(i[1]) for i in ip_path]
-                    ip_path_seq.append(ip_path)
-                    # add probe address at the beginning if not None
-                    if pb_addr is not None:
-                        ip_path = [pb_addr] + ip_path
-                    enhanced_path = [pt.get_ip_info(i) for i in ip_path]  # query IP information
-                    enhanced_path = pt.bridge(enhanced_path)  # remove holes if possible
-                    if is_v4:  # for v4 traceroute, detect IXP
-                        enhanced_path = pt.insert_ixp(enhanced_path)
-                    asn_path = [hop.get_asn() for hop in enhanced_path]  # construct asn path
-                    asn_path = pt.remove_repeated_asn(asn_path)  # remove continuously repeated asn
-                    asn_path_seq.append(asn_path)
-                # detect asn path changes
-                asn_path_change = pt.as_path_change_cs(asn_path_seq)
-                asn_path_change_ixp = pt.as_path_change_ixp_cs(asn_path_seq)
-                # detect ip forwarding pattern change with three different methods
-                ifp_change_simple = pt.ifp_change(pt.ip_path_change_simple(paris_id_seq, ip_path_seq, 16),
-                                                  len(paris_id_seq))
-                ifp_change_bck_ext = pt.ifp_change(pt.ip_path_change_bck_ext(paris_id_seq, ip_path_seq, 16),
-                                                   len(paris_id_seq))
-                ifp_change_split = pt.ifp_change(pt.ip_path_change_split(paris_id_seq, ip_path_seq, 16),
-                                                 len(paris_id_seq))
-                output[pb] = dict(epoch=rec.get('epoch'), paris_id=paris_id_seq,
-                                  ip_path=ip_path_seq, asn_path=asn_path_seq,
-                                  ifp_simple=ifp_change_simple,
-                                  ifp_bck=ifp_change_bck_ext,
-                                  ifp_split=ifp_change_split,
-                                  as_path_change=asn_path_change,
-                                  as_path_change_ixp=asn_path_change_ixp)
+    for pb, rec in records:
+        res = probe_path(fn, pb, rec, probe_addr(pb, pb_meta, is_v4), is_v4, ips, ip_info)
+        if res is not None:
+            output[pb] = res
 
     with open(os.path.join(path_alyz_dir, fn), 'w') as fp:
         json.dump(output, fp)
 
     t2 = time.time()
     logging.info("%s handled in %.2f sec." % (fn, (t2 - t1)))
+    stats = pt.ip_info_cache.stats()
+    logging.debug("IP information cache: %d hits, %d misses, %d/%d addresses kept." %
+                  (stats['hits'], stats['misses'], stats['size'], stats['capacity']))
+
+
+def plan_probes(fns, data_dir):
+    """ split chunks into one task per probe, the probes with the most traceroutes first
 
+    A worker busy with the longest probe of the last chunk no longer holds the end of the run on its own:
+    the longest probes are handled first, shorter ones filling in the other workers meanwhile.
+
+    Args:
+        fns (list of string): names of the output json files, see path()
+        data_dir: the directory containing the chunk files
 
-def path_wrapper(args):
-    """ wrapper for path() that enables trouble shooting in worker and multiple args"""
+    Returns:
+        list of (string, int, int): output file name, probe id, number of traceroutes; longest first
+        dict: output file name to probe ids in the order of the chunk; chunks that could not be read are left out
+    """
+    tasks = []
+    probes = dict()
+    for fn in fns:
+        try:
+            with cf.ChunkReader(os.path.join(data_dir, os.path.splitext(fn)[0] + cf.EXT)) as mes:
+                probes[fn] = list(mes.probes)
+                tasks.extend([(fn, pb, mes.count(pb)) for pb in mes.probes])
+        except (IOError, cf.ChunkError) as e:
+            logging.error("Failed to read chunk for %s: %s" % (fn, e))
+    tasks.sort(key=lambda t: t[2], reverse=True)
+    return tasks, probes
+
+
+def path_probe(fn, pb, pb_addr, data_dir):
+    """ analyze a single probe of a chunk, see probe_path()
+
+    Only the probe is read from the chunk file, through its index.
+
+    Args:
+        fn (string): name of the output json file of the chunk
+        pb (int): probe id
+        pb_addr (string): see probe_addr()
+        data_dir: the directory containing the chunk files
+
+    Returns:
+        (string, int, string): fn, pb and the json encoded analysis of the probe, None if there is none
+    """
+    with cf.ChunkReader(os.path.join(data_dir, os.path.splitext(fn)[0] + cf.EXT), only=[pb]) as mes:
+        rec = read_probe(mes, pb)
+    # hop addresses of the probe are resolved at once, for each version of the routing databases in use
+    ips = sorted(set([ip for p in rec['path'] if p is not None for ip in p]))
+    res = probe_path(fn, pb, rec, pb_addr, is_v4_chunk(fn), ips, dict())
+    return fn, pb, None if res is None else json.dumps(res)
+
+
+def path_probe_wrapper(args):
+    """ wrapper for path_probe() that enables trouble shooting in worker and multiple args"""
     try:
-        return path(*args)
+        return path_probe(*args)
     except Exception:
         logging.critical("Exception in worker.")
         traceback.print_exc()
         raise
 
 
+def merge(fn, probes, encoded, path_alyz_dir):
+    """ write the analysis of a chunk from those of its probes
+
+    The file is the same as the one path() writes for the chunk.
+
+    Args:
+        fn (string): name of the output json file
+        probes (list of int): probe ids in the order of the chunk
+        encoded (dict): probe id to its json encoded analysis, None if there is none
+        path_alyz_dir: the directory in which analysis results shall be stored
+    """
+    # keys in the order json.dump() would give them for the dict path() builds
+    output = dict([(pb, encoded[pb]) for pb in probes if encoded[pb] is not None])
+    with open(os.path.join(path_alyz_dir, fn), 'w') as fp:
+        fp.write('{%s}' % ', '.join(['"%d": %s' % (pb, res) for pb, res in output.iteritems()]))
+
+
 def main():
     # log to data_collection.log file
     logging.basicConfig(filename='path_analysis.log', level=logging.DEBUG,
@@ -143,8 +250,9 @@ def main():
 
     task = (([5010], 'v4'), ([6010], 'v6'))
 
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-    probe_meta = {i[0]: i for i in ms.read_probe(os.path.join(data_dir, "pb.csv"))}
+    processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes=processes)
+    probe_meta = {i[0]: i for i in ps.load_store(data_dir).records()}
 
     for msm, tid in task:
         try:
@@ -153,10 +261,28 @@ def main():
             logging.critical("Failed to learn chunk numbers for task %s: %s" % (tid, e))
             return
         for mid in msm:
-            file_chunk = ["%d_%d.json" % (i, mid) for i in xrange(chunk_count)]
-            pool.map(path_wrapper,
-                     itertools.izip(file_chunk, itertools.repeat(probe_meta),
-                                    itertools.repeat(data_dir), itertools.repeat(path_alyz_dir)))
+            file_chunk = []
+            for fn in ["%d_%d.json" % (i, mid) for i in xrange(chunk_count)]:
+                # skip if already done
+                if os.path.exists(os.path.join(path_alyz_dir, fn)):
+                    logging.info("%r already treated, thus skipped." % fn)
+                else:
+                    file_chunk.append(fn)
+            # one task per probe, longest first; a chunk is written once all its probes are done
+            probe_task, chunk_probes = plan_probes(file_chunk, data_dir)
+            encoded = {fn: dict() for fn in chunk_probes}
+            for fn in chunk_probes:
+                if not chunk_probes[fn]:
+                    merge(fn, [], encoded[fn], path_alyz_dir)
+            t_chunk = time.time()
+            for fn, pb, res in pool.imap_unordered(
+                    path_probe_wrapper,
+                    [(fn, pb, probe_addr(pb, probe_meta, is_v4_chunk(fn)), data_dir) for fn, pb, _ in probe_task],
+                    chunksize=1):
+                encoded[fn][pb] = res
+                if len(encoded[fn]) == len(chunk_probes[fn]):
+                    merge(fn, chunk_probes[fn], encoded.pop(fn), path_alyz_dir)
+                    logging.info("%s handled after %.2f sec." % (fn, time.time() - t_chunk))
 
     t2 = time.time()
     logging.info("All chunks calculated in %.2f sec." % (t2 - t1))
@@ -0,0 +1,122 @@
+"""
+This script times path_analysis.path() on traceroute chunks, along with the value objects of dbtools and pathtools
+it relies on, e.g. to compare two versions of localutils/pathtools.py
+"""
+from localutils import pathtools as pt, dbtools as db, chunkfile as cf, probestore as ps
+import path_analysis as pa
+import ConfigParser
+import argparse
+import tempfile
+import shutil
+import timeit
+import glob
+import os
+
+
+def time_chunks(files, pb_meta, repeat):
+    """ time path_analysis.path() on each chunk file, the best of repeat runs
+
+    Args:
+        files (list of string): paths to traceroute chunk files, e.g. data/0_5010.col
+        pb_meta (dict): probe_id (int) : tuple, see path_analysis.path()
+        repeat (int): number of runs per chunk
+
+    Returns:
+        list of (string, int, float): file name, number of traceroutes, best time in sec
+    """
+    res = []
+    out_dir = tempfile.mkdtemp()
+    try:
+        for f in files:
+            fn = os.path.splitext(os.path.basename(f))[0] + '.json'
+            with cf.ChunkReader(f) as r:
+                count = sum([len(r.paris_id(pb)) for pb in r.probes])
+            best = None
+            for _ in xrange(repeat):
+                # a cold IP information cache in each run, as in a worker handling its first chunk
+                pt.ip_info_cache.clear()
+                mes = cf.ChunkReader(f, preload=True)
+                t1 = timeit.default_timer()
+                pa.path(fn, mes, pb_meta, out_dir)
+                t = timeit.default_timer() - t1
+                best = t if best is None else min(best, t)
+            res.append((os.path.basename(f), count, best))
+    finally:
+        shutil.rmtree(out_dir)
+    return res
+
+
+def time_value_objects(files, number):
+    """ time the operations on value objects found on the hot paths of path_analysis.path()
+
+    Args:
+        files (list of string): paths to traceroute chunk files, the traceroutes of the first probe found are used
+        number (int): number of executions of each operation
+
+    Returns:
+        list of (string, float): operation, time per execution in usec
+    """
+    paris_id, paths = [], []
+    for f in files:
+        with cf.ChunkReader(f) as r:
+            if r.probes:
+                paris_id = r.paris_id(r.probes[0])
+                paths = [list(p) for p in r.paths(r.probes[0])]
+                break
+    if not paths:
+        return []
+    ips = sorted(set([ip for p in paths for ip in p]))
+    addrs = [pt.lookup_ip_info(ip) for ip in ips]
+    ixp = db.IXP('AMS-IX', 'Amsterdam Internet Exchange', 'NL', 'Amsterdam')
+    seg = pt.ip_path_change_simple(paris_id, paths, 16)
+    patterns = [s.pattern for s in seg]
+    ops = [('hash of %d Addr' % len(addrs), lambda: set(addrs)),
+           ('IXP equality', lambda: ixp == db.IXP('AMS-IX', 'Amsterdam Internet Exchange', 'NL', 'Amsterdam')),
+           ('set of %d IpForwardingPattern' % len(patterns), lambda: set(patterns)),
+           ('PatternSegment in list of %d' % len(seg), lambda: seg[-1] in seg)]
+    return [(name, timeit.timeit(func, number=number) / number * 1e6) for name, func in ops]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs='*',
+                        help="traceroute chunk files; all the chunks of 5010 and 6010 in the data directory of "
+                             "./config by default.")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="runs per chunk, the best one is reported; 3 by default.")
+    parser.add_argument("-n", "--number", type=int, default=1000,
+                        help="executions of each value object operation; 1000 by default.")
+    args = parser.parse_args()
+
+    config = ConfigParser.ConfigParser()
+    config.read('./config')
+    try:
+        data_dir = config.get("dir", "data")
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        data_dir = 'data/'
+
+    files = args.files
+    if not files:
+        files = sorted(glob.glob(os.path.join(data_dir, '*_5010' + cf.EXT)) +
+                       glob.glob(os.path.join(data_dir, '*_6010' + cf.EXT)))
+    if not files:
+        print "No traceroute chunk to benchmark."
+        return
+
+    probe_meta = {i[0]: i for i in ps.load_store(data_dir).records()}
+
+    total_count = 0
+    total_time = 0
+    print "%-20s %12s %10s %14s" % ('chunk', 'traceroutes', 'sec', 'usec/trace')
+    for fn, count, t in time_chunks(files, probe_meta, args.repeat):
+        total_count += count
+        total_time += t
+        print "%-20s %12d %10.3f %14.1f" % (fn, count, t, t / max(count, 1) * 1e6)
+    print "%-20s %12d %10.3f %14.1f" % ('total', total_count, total_time, total_time / max(total_count, 1) * 1e6)
+    print
+    for name, t in time_value_objects(files, args.number):
+        print "%-40s %10.2f usec" % (name, t)
+
+
+if __name__ == '__main__':
+    main()
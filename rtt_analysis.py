@@ -3,6 +3,8 @@ This script translates IP path to AS path and detect changes in both paths for e
 """
 import localutils.changedetect as dc
 import localutils.misc as ms
+import localutils.chunkfile as cf
+import localutils.prefetch as pf
 import logging
 import ConfigParser
 import os
@@ -18,34 +20,24 @@ PENALTY = ["MBIC"]
 MINSEGLEN = 3
 
 
-def rtt(fn, data_dir, rtt_alyz_dir):
-    """ for each ping json in data, detect changes in min_rtt time series
+def rtt(fn, mes, rtt_alyz_dir):
+    """ for each ping chunk in data, detect changes in min_rtt time series
 
     Args:
-        fn (string): traceroute json file name, e.g. '0_1010.json'
-
-        data_dir: the directory containing fn
+        fn (string): name of the output json file, e.g. '0_1010.json'
+        mes (chunkfile.ChunkReader): the chunk file 0_1010.col, None if it could not be read
         rtt_alyz_dir: the directory in which analysis results shall be stored
 
     """
-    # skip if already done
-    if os.path.exists(os.path.join(rtt_alyz_dir, fn)):
-        logging.info("%r already treated, thus skipped." % fn)
+    if mes is None:
         return
     t1 = time.time()
 
-    try:
-        with open(os.path.join(data_dir, fn), 'r') as fp:
-            mes = json.load(fp)
-    except IOError as e:
-        logging.error(e)
-        return
-
     output = dict()
-    for pb, rec in mes.items():
-        pb = int(pb)
-        rtt_mes = rec.get('min_rtt')  # [[#hop, address, rtt],...]
-        output[pb] = dict(epoch=rec.get('epoch'), min_rtt=rtt_mes)
+    with mes:
+        records = [(pb, mes.column(pb, 'epoch').tolist(), mes.rtt_list(pb, 'min_rtt')) for pb in mes.probes]
+    for pb, epoch, rtt_mes in records:
+        output[pb] = dict(epoch=epoch, min_rtt=rtt_mes)
         for m, p in [(x, y) for x in METHOD for y in PENALTY]:
             method_caller = getattr(dc, m)
             try:
@@ -63,10 +55,20 @@ def rtt(fn, data_dir, rtt_alyz_dir):
     logging.info("%s handled in %.2f sec." % (fn, (t2 - t1)))
 
 
+def rtt_chunk(f, rtt_alyz_dir):
+    """ read a chunk file and detect changes in it, see rtt()
+
+    Args:
+        f (string): path to the chunk file, e.g. data/0_1010.col
+        rtt_alyz_dir: the directory in which analysis results shall be stored
+    """
+    rtt(os.path.splitext(os.path.basename(f))[0] + '.json', pf.load_item(f), rtt_alyz_dir)
+
+
 def rtt_wrapper(args):
-    """ wrapper for path() that enables trouble shooting in worker and multiple args"""
+    """ wrapper for rtt_chunk() that enables trouble shooting in worker and multiple args"""
     try:
-        return rtt(*args)
+        return rtt_chunk(*args)
     except Exception:
         logging.critical("Exception in worker.")
         traceback.print_exc()
@@ -107,12 +109,15 @@ def main():
     if not os.path.exists(rtt_alyz_dir):
         os.makedirs(rtt_alyz_dir)
 
+    depth, max_bytes = pf.read_config(config)
+
     logging.info("Finished loading libs and config.")
     t1 = time.time()
 
     task = (([1010], 'v4'), ([2010], 'v6'))
 
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+    processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes=processes)
 
     for msm, tid in task:
         try:
@@ -121,9 +126,18 @@ def main():
             logging.critical("Failed to learn chunk numbers for task %s: %s" % (tid, e))
             return
         for mid in msm:
-            file_chunk = ["%d_%d.json" % (i, mid) for i in xrange(chunk_count)]
-            pool.map(rtt_wrapper,
-                     itertools.izip(file_chunk, itertools.repeat(data_dir), itertools.repeat(rtt_alyz_dir)))
+            file_chunk = []
+            for fn in ["%d_%d.json" % (i, mid) for i in xrange(chunk_count)]:
+                # skip if already done
+                if os.path.exists(os.path.join(rtt_alyz_dir, fn)):
+                    logging.info("%r already treated, thus skipped." % fn)
+                else:
+                    file_chunk.append(os.path.join(data_dir, os.path.splitext(fn)[0] + cf.EXT))
+            # one task per chunk, taken by the first worker free; the next chunks are read ahead meanwhile
+            with pf.TaskFeed(file_chunk, processes, depth, max_bytes) as feed:
+                for _ in pool.imap_unordered(rtt_wrapper, itertools.izip(feed, itertools.repeat(rtt_alyz_dir)),
+                                             chunksize=1):
+                    feed.done()
 
     t2 = time.time()
     logging.info("All chunks calculated in %.2f sec." % (t2 - t1))
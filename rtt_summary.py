@@ -1,12 +1,11 @@
 """
 This script summarizes the per probe RTT for both ping and traceroute measurements
 """
-from localutils import misc as ms
+from localutils import misc as ms, chunkfile as cf, prefetch as pf
 import multiprocessing
 import ConfigParser
 import logging
 import os
-import json
 import numpy as np
 import traceback
 import time
@@ -19,11 +18,12 @@ TIMEOUT = 1000
 DST = ['192.228.79.201', '2001:500:84::b']
 
 
-def rtt(f):
+def rtt(f, mes):
     """ summarize RTT for ping and traceroute measurements with mean, median, etc.
 
     Args:
         f (string): file path to measurement chunks
+        mes (chunkfile.ChunkReader): the chunk read from f, None if it could not be read
 
     Returns:
         list of tuple
@@ -33,46 +33,47 @@ def rtt(f):
     summery = []
     t1 = time.time()
 
-    try:
-        with open(f, 'r') as fp:
-            mes = json.load(fp)
-    except IOError as e:
-        logging.error(e)
+    if mes is None:
         return []
 
-    for pb, rec in mes.items():
-        if 'min_rtt' in rec:
-            rtts = rec.get('min_rtt', None)
-            raw_len = len(rtts) # can be 0
-            pos_rtt = [i for i in rtts if (0 < i < TIMEOUT)]
-            #all_rtt = [i if (0 < i < TIMEOUT) else TIMEOUT for i in rtts]
-            if pos_rtt:
-                reached_len = len(pos_rtt) # if empty array is given, returns nan of type numpy.float64
-                mean_ = np.mean(pos_rtt)
-                mid = np.median(pos_rtt)
-                min_ = np.min(pos_rtt)
-                max_ = np.max(pos_rtt)
-                std_ = np.std(pos_rtt)
-            else:
-                raw_len = reached_len = mean_ = mid = min_ = max_ = std_ = None
-        elif 'path' in rec:
-            paths = rec.get('path', None)
-            raw_len = len(paths)
-            reached_path = [i for i in paths if (i[-1][1] in DST)]
-            reached_len = len(reached_path)
-            rtts_last = [i[-1][2] for i in reached_path]
-            if rtts_last:
-                mean_ = np.mean(rtts_last)
-                mid = np.median(rtts_last)
-                min_ = np.min(rtts_last)
-                max_ = np.max(rtts_last)
-                std_ = np.std(rtts_last)
+    with mes:
+        if mes.kind == 'traceroute':
+            dst_id = [mes.ip_table.ids[i] for i in DST if i in mes.ip_table.ids]
+        for pb in mes.probes:
+            if mes.kind == 'ping':
+                rtts = mes.rtt(pb, 'min_rtt')
+                raw_len = len(rtts)  # can be 0
+                with np.errstate(invalid='ignore'):  # missing values are NaN, thus excluded
+                    pos_rtt = rtts[(rtts > 0) & (rtts < TIMEOUT)]
+                if len(pos_rtt):
+                    reached_len = len(pos_rtt)
+                    mean_ = np.mean(pos_rtt)
+                    mid = np.median(pos_rtt)
+                    min_ = np.min(pos_rtt)
+                    max_ = np.max(pos_rtt)
+                    std_ = np.std(pos_rtt)
+                else:
+                    raw_len = reached_len = mean_ = mid = min_ = max_ = std_ = None
+            elif mes.kind == 'traceroute':
+                off = mes.column(pb, 'path_offset')
+                raw_len = len(off) - 1
+                # index of the last hop of each non-empty path
+                last = off[1:][(mes.column(pb, 'has_path') > 0) & (off[1:] > off[:-1])] - 1
+                reached = last[np.in1d(mes.column(pb, 'hop_ip')[last], dst_id)]
+                reached_len = len(reached)
+                rtts_last = mes.rtt(pb, 'hop_rtt')[reached]
+                if len(rtts_last):
+                    mean_ = np.mean(rtts_last)
+                    mid = np.median(rtts_last)
+                    min_ = np.min(rtts_last)
+                    max_ = np.max(rtts_last)
+                    std_ = np.std(rtts_last)
+                else:
+                    raw_len = reached_len = mean_ = mid = min_ = max_ = std_ = None
             else:
+                logging.warning("Probe %s with empty measurement result in %s" % (pb, f))
                 raw_len = reached_len = mean_ = mid = min_ = max_ = std_ = None
-        else:
-            logging.warning("Probe %s with empty measurement result in %s" % (pb, f))
-            raw_len = reached_len = mean_ = mid = min_ = max_ = std_ = None
-        summery.append((pb, raw_len, reached_len, mean_, mid, min_, max_, std_))
+            summery.append((pb, raw_len, reached_len, mean_, mid, min_, max_, std_))
 
     t2 = time.time()
     logging.info("%s handled in %d sec." % (f, (t2-t1)))
@@ -80,9 +81,13 @@ def rtt(f):
 
 
 def rtt_wrapper(f):
-    """ wrapper for rtt() that enables trouble shooting in worker"""
+    """ wrapper for rtt() that enables trouble shooting in worker and reads the chunk
+
+    Returns:
+        (string, list of tuple): file path and its summary, see rtt()
+    """
     try:
-        return rtt(f)
+        return f, rtt(f, pf.load_item(f))
     except Exception:
         logging.critical("Exception in worker.")
         traceback.print_exc()
@@ -122,6 +127,8 @@ def main():
         logging.critical("config for data collection is not right.")
         return
 
+    depth, max_bytes = pf.read_config(config)
+
     t1 = time.time()
 
     task = ((msmv4, 'v4'), (msmv6, 'v6'))
@@ -129,7 +136,8 @@ def main():
     # msmv4 contains all the measurements associated with v4 task
     # each task has a probe to chunk id indexing file
     # the number of chunks has to be learnt from indexing file first
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+    processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes=processes)
     for msm, tid in task:
         try:
             chunk_count = ms.get_chunk_count(os.path.join(data_dir, 'pb_chunk_index_%s.csv' % tid))
@@ -137,8 +145,14 @@ def main():
             logging.critical("Failed to learn chunk numbers for task %s: %s" % (tid, e))
             return
         for mid in msm:
-            file_chunk = [os.path.join(data_dir, "%d_%d.json" % (i, mid)) for i in xrange(chunk_count)]
-            summary = pool.map(rtt_wrapper, file_chunk)
+            file_chunk = [cf.chunk_file(data_dir, i, mid) for i in xrange(chunk_count)]
+            # one task per chunk, taken by the first worker free; the next chunks are read ahead meanwhile
+            res = dict()
+            with pf.TaskFeed(file_chunk, processes, depth, max_bytes) as feed:
+                for f, summary in pool.imap_unordered(rtt_wrapper, feed, chunksize=1):
+                    res[f] = summary
+                    feed.done()
+            summary = [res[f] for f in file_chunk]
             with open(os.path.join(data_dir, 'rtt_summary_%d_of_%s.csv' % (mid, tid)),'w') as fp:
                 fp.write('probe_id;raw_length;valid_length;mean;median;min;max;std\n')
                 if summary:
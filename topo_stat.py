@@ -7,45 +7,44 @@ import multiprocessing
 import ConfigParser
 import os
 import time
-import itertools
 import json
-from localutils import misc as ms
+from localutils import misc as ms, chunkfile as cf, prefetch as pf
 
 DST = ['192.228.79.201', '2001:500:84::b', 226]
 
 
-def worker(fn, data_dir, path_alyz_dir):
-    try:  # load traceroute file
-        with open(os.path.join(data_dir, fn), 'r') as fp:
-            traceroute = json.load(fp)
-    except IOError as e:
-        logging.error(e)
-        return [], set(), set(), set()
+def load(files):
+    """ load the traceroute chunk and its path analysis """
+    chunk_fn, alyz_fn = files
+    traceroute = cf.ChunkReader(chunk_fn, preload=True)
+    with open(alyz_fn, 'r') as fp:
+        path_alyz = json.load(fp)
+    return traceroute, path_alyz
+
 
-    try:  # load path analysis file
-        with open(os.path.join(path_alyz_dir, fn), 'r') as fp:
-            path_alyz = json.load(fp)
-    except IOError as e:
-        logging.error(e)
+def worker(fn, loaded):
+    if loaded is None:
         return [], set(), set(), set()
+    traceroute, path_alyz = loaded
 
-    pbs = set(traceroute.keys()) & set(path_alyz.keys())
+    pbs = set([str(pb) for pb in traceroute.probes]) & set(path_alyz.keys())
     logging.info("%d probes in common for %s" % (len(pbs), fn))
     pb_res = []
     unique_as_glb = set()
     unique_ixp_glb = set()
     unique_as_path_glb = set()
     for pb in pbs:
-        ip_paths = traceroute.get(pb).get('path')
-        #reached_ip = [[hop[1] for hop in path] for path in ip_paths if (path[-1][1] in DST)]
-        reached_ip = [[hop[1] for hop in path] for path in ip_paths]
+        ip_paths = traceroute.paths(int(pb))
+        #reached_ip = [path for path in ip_paths if (path[-1] in DST)]
+        reached_ip = ip_paths
         as_paths = path_alyz.get(pb).get('asn_path')
-        reached_as = [i for i in as_paths if len(i) >= 1 and i[-1] in DST]
+        # each distinct AS path is handled once, whatever the number of traceroutes following it
+        as_table = ms.PathTable()
+        as_table.intern_all([i for i in as_paths if len(i) >= 1 and i[-1] in DST])
+        reached_as = as_table.paths
 
-        unique_as = set([reached_as[i][j] for i in range(len(reached_as)) for j in range(len(reached_as[i])) if
-                         type(reached_as[i][j]) is int])
-        unique_ixp = set([reached_as[i][j] for i in range(len(reached_as)) for j in range(len(reached_as[i])) if
-                         type(reached_as[i][j]) is not int])
+        unique_as = set([hop for path in reached_as for hop in path if type(hop) is int])
+        unique_ixp = set([hop for path in reached_as for hop in path if type(hop) is not int])
         unique_ip_path = set([';'.join([str(hop) for hop in path]) for path in reached_ip])
         unique_as_path = set([';'.join([str(hop) for hop in path]) for path in reached_as])
 
@@ -54,12 +53,18 @@ def worker(fn, data_dir, path_alyz_dir):
         unique_ixp_glb.update(unique_ixp)
         unique_as_path_glb.update(unique_as_path)
 
+    traceroute.close()
     return pb_res, unique_as_glb, unique_ixp_glb, unique_as_path_glb
 
 
-def worker_wrapper(args):
+def worker_wrapper(files):
+    """ read the files of a chunk and count, see load() and worker()
+
+    Returns:
+        (tuple of string, tuple): the files and what worker() returns for them
+    """
     try:
-        return worker(*args)
+        return files, worker(os.path.basename(files[1]), pf.load_item(files, load=load))
     except Exception:
         logging.critical("Exception in worker.")
         traceback.print_exc()
@@ -101,12 +106,15 @@ def main():
         logging.critical("Repository %s storing measurement data is missing" % path_alyz_dir)
         return
 
+    depth, max_bytes = pf.read_config(config)
+
     logging.info("Finished loading libs and config.")
     t1 = time.time()
 
     task = (([5010], 'v4'), ([6010], 'v6'))
 
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+    processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes=processes)
 
     for msm, tid in task:
         try:
@@ -115,9 +123,15 @@ def main():
             logging.critical("Failed to learn chunk numbers for task %s: %s" % (tid, e))
             return
         for mid in msm:
-            file_chunk = ["%d_%d.json" % (i, mid) for i in xrange(chunk_count)]
-            res = pool.map(worker_wrapper,
-                           itertools.izip(file_chunk, itertools.repeat(data_dir), itertools.repeat(path_alyz_dir)))
+            file_chunk = [(cf.chunk_file(data_dir, i, mid), os.path.join(path_alyz_dir, "%d_%d.json" % (i, mid)))
+                          for i in xrange(chunk_count)]
+            # one task per chunk, taken by the first worker free; the next chunks are read ahead meanwhile
+            res = dict()
+            with pf.TaskFeed(file_chunk, processes, depth, max_bytes) as feed:
+                for files, r in pool.imap_unordered(worker_wrapper, feed, chunksize=1):
+                    res[files] = r
+                    feed.done()
+            res = [res[files] for files in file_chunk]
 
             # save results to file
             pb_summary = []